@@ -1,14 +1,19 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_from_directory, abort, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_from_directory, send_file, abort, make_response, g, has_request_context, Response, stream_with_context
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
 from functools import wraps
+from contextlib import contextmanager
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Email
 from waitress import serve
 import os
 import json
+import copy
+import atexit
 from datetime import datetime, timedelta, timezone
-from io import BytesIO
+from io import BytesIO, StringIO
+import csv
+import tempfile
 import uuid
 import hashlib
 import secrets
@@ -17,10 +22,16 @@ try:
     from weasyprint import HTML
 except Exception:
     HTML = None
+import math
 import re
 import random
 import time
 import threading
+import weakref
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
@@ -31,6 +42,13 @@ from openpyxl import Workbook, load_workbook
 from werkzeug.utils import secure_filename
 from markupsafe import Markup, escape
 import base64
+from collections import OrderedDict
+from collections.abc import Mapping
+from company_search import CompanySearchIndex
+from pricing_engine import price_line, price_lines
+from mpack_rates import load_mpack_rate_table, parse_thickness_micron, polipack_adhesive_flag
+from rule_catalog import RuleCatalogIndex
+from pack_solver import OBJECTIVES as PACK_OBJECTIVES, PackCatalog
 
 # Import MongoDB users module
 try:
@@ -258,37 +276,23 @@ def recalc_rule_pricing(product):
     if gst_percent is None or gst_percent < 0:
         gst_percent = 18.0
 
-    unit_price = to_float(product.get('unit_price'))
-    if unit_price is None or unit_price <= 0:
-        unit_price = length * rate
-
-    subtotal = unit_price * quantity
-    discount_amount = subtotal * (discount_percent / 100)
-    discounted_subtotal = subtotal - discount_amount
-    gst_amount = (discounted_subtotal * gst_percent) / 100
-    final_total = discounted_subtotal + gst_amount
-    total_length = length * quantity
+    calculations = price_line(
+        product,
+        unit_price=None if (to_float(product.get('unit_price')) or 0) > 0 else length * rate,
+        quantity=quantity,
+        discount_percent=discount_percent,
+        gst_percent=gst_percent
+    )
 
-    product['unit_price'] = round(unit_price, 2)
-    product['total_price'] = round(final_total, 2)
+    product['unit_price'] = calculations['unit_price']
+    product['total_price'] = calculations['final_total']
     product['quantity'] = quantity
     product['discount_percent'] = discount_percent
     product['gst_percent'] = gst_percent
     product['length_per_unit_m'] = length
     product['rate_per_meter'] = rate
-    product['total_length_m'] = round(total_length, 2)
-
-    product['calculations'] = {
-        'unit_price': round(unit_price, 2),
-        'quantity': quantity,
-        'subtotal': round(subtotal, 2),
-        'discount_percent': discount_percent,
-        'discount_amount': round(discount_amount, 2),
-        'discounted_subtotal': round(discounted_subtotal, 2),
-        'gst_percent': gst_percent,
-        'gst_amount': round(gst_amount, 2),
-        'final_total': round(final_total, 2)
-    }
+    product['total_length_m'] = round(length * quantity, 2)
+    product['calculations'] = calculations
 
     return product
 
@@ -396,8 +400,7 @@ def render_company_product_page(template_name, extra_context=None):
     company_email = ''
 
     if company_id:
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         selected_company = session.get('selected_company', {})
         company_name = selected_company.get('name') or session.get('company_name')
@@ -734,6 +737,55 @@ def is_custom_role(role_name: str) -> bool:
     return normalized in {role['name'] for role in get_custom_role_definitions()}
 
 
+# Assigned company ids per user: memoized for the request on flask.g and kept
+# in a short per-worker TTL cache.  Admin writes invalidate entries directly.
+ASSIGNED_COMPANIES_CACHE_TTL = float(os.getenv('ASSIGNED_COMPANIES_CACHE_TTL', '30'))
+_assigned_companies_lock = threading.Lock()
+_assigned_companies_cache = {}
+
+
+def remember_user_assigned_companies(user_id, assigned_companies):
+    """Record a freshly read assignment list for ``user_id`` and return it normalized."""
+    user_id = str(user_id)
+    assigned_ids = tuple(normalize_assigned_companies(assigned_companies))
+    if has_request_context():
+        g.setdefault('assigned_company_ids', {})[user_id] = assigned_ids
+    with _assigned_companies_lock:
+        _assigned_companies_cache[user_id] = (time.time() + ASSIGNED_COMPANIES_CACHE_TTL, assigned_ids)
+    return list(assigned_ids)
+
+
+def invalidate_user_assigned_companies(user_ids=None):
+    """Forget cached assignments for ``user_ids`` (all users when None)."""
+    memo = g.get('assigned_company_ids') if has_request_context() else None
+    with _assigned_companies_lock:
+        if user_ids is None:
+            _assigned_companies_cache.clear()
+        else:
+            for user_id in user_ids:
+                _assigned_companies_cache.pop(str(user_id), None)
+    if memo:
+        if user_ids is None:
+            memo.clear()
+        else:
+            for user_id in user_ids:
+                memo.pop(str(user_id), None)
+
+
+def _cached_user_assigned_companies(user_id):
+    user_id = str(user_id)
+    if has_request_context():
+        memo = g.get('assigned_company_ids')
+        if memo and user_id in memo:
+            return memo[user_id]
+    entry = _assigned_companies_cache.get(user_id)
+    if entry and entry[0] > time.time():
+        if has_request_context():
+            g.setdefault('assigned_company_ids', {})[user_id] = entry[1]
+        return entry[1]
+    return None
+
+
 def get_user_assigned_company_ids(user):
     """Return list of company IDs the user may access.
 
@@ -745,11 +797,15 @@ def get_user_assigned_company_ids(user):
     if role in COMPANY_FULL_ACCESS_ROLES:
         return None
 
+    cached_ids = _cached_user_assigned_companies(user.id)
+    if cached_ids is not None:
+        user.assigned_companies = list(cached_ids)
+        return [cid for cid in cached_ids if cid]
+
     assigned_ids = None
 
     if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
         try:
-            mongo_db.command('ping')
             user_doc = mu_find_user_by_id(str(user.id))
             if user_doc and user_doc.get('assigned_companies'):
                 assigned_ids = normalize_assigned_companies(user_doc.get('assigned_companies'))
@@ -759,7 +815,7 @@ def get_user_assigned_company_ids(user):
     if assigned_ids is None:
         assigned_ids = normalize_assigned_companies(getattr(user, 'assigned_companies', []))
 
-    user.assigned_companies = assigned_ids
+    user.assigned_companies = remember_user_assigned_companies(user.id, assigned_ids)
     return [str(cid) for cid in assigned_ids if cid]
 
 # -----------------------------------------------------------------------
@@ -795,10 +851,13 @@ def send_alert_email(subject: str, body: str):
     return success
 
 # MongoDB Configuration
-from pymongo import MongoClient, ReturnDocument
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from pymongo import DeleteOne, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure, ServerSelectionTimeoutError
 import time
 
+# Case-insensitive collation backing the email_ci / company_name_ci indexes
+COMPANY_CI_COLLATION = {'locale': 'en', 'strength': 2}
+
 MONGO_URI = (
     os.environ.get('MONGO_URI')
     or os.environ.get('MONGODB_URI')
@@ -846,10 +905,11 @@ def init_mongodb():
             # Ensure efficient lookups during company import
             companies_col = mongo_db.get_collection('companies')
             try:
-                companies_col.create_index('EmailID', name='email_ci', unique=False, collation={'locale': 'en', 'strength': 2})
-                companies_col.create_index('Company Name', name='company_name_ci', unique=False, collation={'locale': 'en', 'strength': 2})
+                companies_col.create_index('EmailID', name='email_ci', unique=False, collation=COMPANY_CI_COLLATION)
+                companies_col.create_index('Company Name', name='company_name_ci', unique=False, collation=COMPANY_CI_COLLATION)
             except Exception as idx_err:
                 app.logger.warning(f"Index creation on companies failed: {idx_err}")
+            ensure_cart_indexes(mongo_db)
             
             MONGO_AVAILABLE = True
             print("Successfully connected to MongoDB")
@@ -876,6 +936,8 @@ def ensure_mongo_connection_initialized():
 
         init_mongodb()
         mongo_initialized = True
+        if MONGO_AVAILABLE and mongo_db is not None:
+            start_cart_pricing_migration()
 
 
 @app.before_request
@@ -1168,6 +1230,7 @@ def admin_update_user(user_id):
                 result = mongo_db.users.update_one({'_id': ObjectId(user_id)}, {'$set': update_fields})
                 if result.matched_count == 0:
                     return jsonify({'success': False, 'error': 'User not found'}), 404
+                invalidate_user_assigned_companies([user_id])
 
                 user_doc = mongo_db.users.find_one({'_id': ObjectId(user_id)})
                 user_doc['id'] = str(user_doc.pop('_id'))
@@ -1203,6 +1266,7 @@ def admin_update_user(user_id):
         user['updated_at'] = datetime.utcnow().isoformat()
         users[user_id] = user
         save_users(users)
+        invalidate_user_assigned_companies([user_id])
         sync_user_company_links(user_id, user.get('assigned_companies', []))
         return jsonify({'success': True, 'user': serialize_admin_user(user)})
     except Exception as e:
@@ -1319,11 +1383,9 @@ def admin_list_companies():
 @admin_required
 def admin_get_company(company_id):
     try:
-        companies = load_companies_data()
-        for company in companies:
-            serialized = serialize_admin_company(company)
-            if serialized.get('id') == str(company_id):
-                return jsonify({'success': True, 'company': serialized})
+        company = find_company_by_id(company_id)
+        if company:
+            return jsonify({'success': True, 'company': serialize_admin_company(company)})
         return jsonify({'success': False, 'error': 'Company not found'}), 404
     except Exception as e:
         app.logger.error(f"Error in admin_get_company: {e}")
@@ -1385,6 +1447,7 @@ def admin_create_company():
                 result = mongo_db.companies.insert_one(company_data)
                 company_data['id'] = str(result.inserted_id)
                 sync_company_user_links(company_data['id'], assigned_to)
+                invalidate_companies_cache()
                 return jsonify({'success': True, 'company': serialize_admin_company(company_data)})
             except Exception as mongo_error:
                 app.logger.error(f"Mongo error in admin_create_company: {mongo_error}")
@@ -1464,43 +1527,43 @@ def admin_update_company(company_id):
                 company_doc['id'] = str(company_doc.pop('_id'))
                 serialized_company = serialize_admin_company(company_doc)
                 sync_company_user_links(serialized_company.get('id'), serialized_company.get('assigned_to', []))
+                invalidate_companies_cache()
                 return jsonify({'success': True, 'company': serialized_company})
             except Exception as mongo_error:
                 app.logger.error(f"Mongo error in admin_update_company: {mongo_error}")
                 return jsonify({'success': False, 'error': 'Database error'}), 500
 
-        companies = load_companies_data()
+        directory, position = _find_company_position('by_id', str(company_id))
+        companies = [_copy_company_record(company) for company in directory['companies']]
         updated = None
-        for company in companies:
-            serialized = serialize_admin_company(company)
-            if serialized.get('id') == str(company_id):
-                if 'name' in data:
-                    company['Company Name'] = data['name']
-                if 'email' in data:
-                    company['EmailID'] = data['email']
-                if 'phone' in data:
-                    company['Phone'] = data['phone']
-                if 'last_payment_terms' in data:
-                    company['last_payment_terms'] = data['last_payment_terms']
-                if 'billing_attention' in data:
-                    company['Billing Attention'] = data['billing_attention']
-                if 'billing_address' in data:
-                    company['Billing Address'] = data['billing_address']
-                    company['Address'] = data['billing_address']
-                if 'billing_street' in data:
-                    company['Billing Street'] = data['billing_street']
-                if 'billing_city' in data:
-                    company['Billing City'] = data['billing_city']
-                if 'billing_state' in data:
-                    company['Billing State'] = data['billing_state']
-                if 'billing_postal_code' in data:
-                    company['Billing Postal Code'] = data['billing_postal_code']
-                if 'billing_phone' in data:
-                    company['Billing Phone'] = data['billing_phone']
-                if 'assigned_to' in data:
-                    company['assigned_to'] = normalize_assigned_companies(data.get('assigned_to', []))
-                updated = serialize_admin_company(company)
-                break
+        if position is not None:
+            company = companies[position]
+            if 'name' in data:
+                company['Company Name'] = data['name']
+            if 'email' in data:
+                company['EmailID'] = data['email']
+            if 'phone' in data:
+                company['Phone'] = data['phone']
+            if 'last_payment_terms' in data:
+                company['last_payment_terms'] = data['last_payment_terms']
+            if 'billing_attention' in data:
+                company['Billing Attention'] = data['billing_attention']
+            if 'billing_address' in data:
+                company['Billing Address'] = data['billing_address']
+                company['Address'] = data['billing_address']
+            if 'billing_street' in data:
+                company['Billing Street'] = data['billing_street']
+            if 'billing_city' in data:
+                company['Billing City'] = data['billing_city']
+            if 'billing_state' in data:
+                company['Billing State'] = data['billing_state']
+            if 'billing_postal_code' in data:
+                company['Billing Postal Code'] = data['billing_postal_code']
+            if 'billing_phone' in data:
+                company['Billing Phone'] = data['billing_phone']
+            if 'assigned_to' in data:
+                company['assigned_to'] = normalize_assigned_companies(data.get('assigned_to', []))
+            updated = serialize_admin_company(company)
 
         if not updated:
             return jsonify({'success': False, 'error': 'Company not found'}), 404
@@ -1525,24 +1588,22 @@ def admin_delete_company(company_id):
                 if result.deleted_count == 0:
                     return jsonify({'success': False, 'error': 'Company not found'}), 404
                 sync_company_user_links(company_id, [])
+                invalidate_companies_cache()
                 return jsonify({'success': True})
             except Exception as mongo_error:
                 app.logger.error(f"Mongo error in admin_delete_company: {mongo_error}")
                 return jsonify({'success': False, 'error': 'Database error'}), 500
 
-        companies = load_companies_data()
-        new_companies = []
-        deleted = False
-        for company in companies:
-            serialized = serialize_admin_company(company)
-            if serialized.get('id') == str(company_id):
-                deleted = True
-                continue
-            new_companies.append(company)
-
-        if not deleted:
+        directory, position = _find_company_position('by_id', str(company_id))
+        if position is None:
             return jsonify({'success': False, 'error': 'Company not found'}), 404
 
+        new_companies = [
+            _copy_company_record(company)
+            for index, company in enumerate(directory['companies'])
+            if index != position
+        ]
+
         save_companies_data(new_companies)
         sync_company_user_links(company_id, [])
         return jsonify({'success': True})
@@ -1560,13 +1621,9 @@ def admin_search_companies():
         if len(query) < 2:
             return jsonify({'success': True, 'companies': []})
 
-        companies = load_companies_data()
-        filtered = []
-        for company in companies:
-            serialized = serialize_admin_company(company)
-            if query in serialized.get('name', '').lower():
-                filtered.append(serialized)
-        return jsonify({'success': True, 'companies': filtered})
+        limit = min(max(request.args.get('limit', default=50, type=int) or 50, 1), 200)
+        companies = search_company_directory(query, limit=limit)
+        return jsonify({'success': True, 'companies': [serialize_admin_company(company) for company in companies]})
     except Exception as e:
         app.logger.error(f"Error in admin_search_companies: {e}")
         return jsonify({'success': False, 'error': 'Failed to search companies'}), 500
@@ -1589,78 +1646,73 @@ def admin_import_companies():
             return jsonify({'success': False, 'error': 'Unsupported file type'}), 400
 
         upload.stream.seek(0)
-        workbook = load_workbook(upload.stream, data_only=True)
-        sheet = workbook.active
-        rows = list(sheet.iter_rows(values_only=True))
-        if not rows:
-            return jsonify({'success': False, 'error': 'Workbook is empty'}), 400
-
-        headers_normalized, missing_headers = _validate_company_import_headers(rows[0])
-        if missing_headers:
-            return jsonify({'success': False, 'error': f"Missing required columns: {', '.join(missing_headers)}"}), 400
-
-        insert_count = 0
-        update_count = 0
-        errors = []
-        processed = []
-
-        use_mongo = MONGO_AVAILABLE and USE_MONGO and mongo_db is not None
-        if use_mongo:
-            try:
-                mongo_db.command('ping')
-            except Exception as ping_error:
-                app.logger.error(f"Mongo ping failed in admin_import_companies: {ping_error}")
-                use_mongo = False
-
-        for row_index, row in enumerate(rows[1:], start=2):
-            try:
-                record = _extract_row_data(headers_normalized, row)
-            except Exception as extract_error:
-                app.logger.error(f"Row {row_index} parsing error: {extract_error}", exc_info=True)
-                errors.append(f"Row {row_index}: Failed to parse row data")
-                continue
-            if not any(str(value).strip() for value in record.values()):
-                continue
-
-            identifier_key, identifier_value = _resolve_company_identifier(record)
-            if not identifier_value:
-                errors.append(f"Row {row_index}: Missing company name/email")
-                continue
-
-            try:
-                payload, created_at, assigned_to = _convert_record_to_storage(record)
-            except Exception as convert_error:
-                app.logger.error(f"Row {row_index} conversion error: {convert_error}", exc_info=True)
-                errors.append(f"Row {row_index}: Failed to normalize data")
-                continue
-
-            try:
-                if use_mongo:
-                    company_id, was_inserted, previous_assigned = _upsert_company_mongo(identifier_key, identifier_value, payload, assigned_to, created_at)
-                else:
-                    company_id, was_inserted, previous_assigned = _upsert_company_json(identifier_key, identifier_value, payload, assigned_to, created_at)
+        workbook = load_workbook(upload.stream, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header_row = next(rows, None)
+            if header_row is None:
+                return jsonify({'success': False, 'error': 'Workbook is empty'}), 400
+
+            headers_normalized, missing_headers = _validate_company_import_headers(header_row)
+            if missing_headers:
+                return jsonify({'success': False, 'error': f"Missing required columns: {', '.join(missing_headers)}"}), 400
+
+            insert_count = 0
+            update_count = 0
+            row_errors = []
+            processed = []
+
+            use_mongo = MONGO_AVAILABLE and USE_MONGO and mongo_db is not None
+            if use_mongo:
+                try:
+                    mongo_db.command('ping')
+                except Exception as ping_error:
+                    app.logger.error(f"Mongo ping failed in admin_import_companies: {ping_error}")
+                    use_mongo = False
+
+            entries = _iter_company_import_entries(rows, headers_normalized, row_errors)
+            if use_mongo:
+                known = {}
+                batches = (
+                    _bulk_upsert_companies_mongo(batch, known, row_errors)
+                    for batch in _chunked(entries, COMPANY_IMPORT_BATCH_SIZE)
+                )
+            else:
+                batches = [_upsert_companies_json(entries, row_errors)]
+
+            assignment_changes = {}
+            for results in batches:
+                for entry, company_id, was_inserted, previous_assigned in results:
+                    change = assignment_changes.get(company_id)
+                    if change is None:
+                        assignment_changes[company_id] = [set(previous_assigned), set(entry['assigned_to'])]
+                    else:
+                        change[1] = set(entry['assigned_to'])
 
-                if not company_id:
-                    errors.append(f"Row {row_index}: Failed to upsert company")
-                    continue
+                    if was_inserted:
+                        insert_count += 1
+                        processed.append({'row': entry['row'], 'company_id': company_id, 'status': 'inserted'})
+                    else:
+                        update_count += 1
+                        processed.append({'row': entry['row'], 'company_id': company_id, 'status': 'updated'})
 
-                _sync_assigned_users(company_id, assigned_to, previous_assigned)
+            if use_mongo:
+                _sync_company_assignments_mongo(assignment_changes)
+            else:
+                _sync_company_assignments_json(assignment_changes)
+        finally:
+            workbook.close()
 
-                if was_inserted:
-                    insert_count += 1
-                    processed.append({'row': row_index, 'company_id': company_id, 'status': 'inserted'})
-                else:
-                    update_count += 1
-                    processed.append({'row': row_index, 'company_id': company_id, 'status': 'updated'})
-            except Exception as row_error:
-                app.logger.error(f"Error importing row {row_index}: {row_error}")
-                errors.append(f"Row {row_index}: {row_error}")
+        if insert_count or update_count:
+            invalidate_companies_cache()
+            invalidate_user_assigned_companies()
 
+        row_errors.sort(key=lambda item: item[0])
         return jsonify({
             'success': True,
             'inserted': insert_count,
             'updated': update_count,
-            'errors': errors,
+            'errors': [f"Row {row_index}: {message}" for row_index, message in row_errors],
             'processed': processed
         })
     except Exception as e:
@@ -1672,50 +1724,40 @@ def admin_import_companies():
 @login_required
 @admin_required
 def admin_export_companies():
+    """Export the company directory as XLSX (default), CSV or NDJSON (?format=csv|ndjson).
+
+    Rows are read straight from a Mongo cursor (or the cached directory in
+    JSON mode).  CSV and NDJSON are streamed as they are produced; XLSX rows
+    go through a write-only worksheet into a temp file that is then streamed.
+    """
     try:
-        companies = [serialize_admin_company(company) for company in load_companies_data()]
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'Companies'
-
-        headers = [
-            'Sr No',
-            'Company Name',
-            'Phone',
-            'Billing Attention',
-            'Billing Address',
-            'Billing Street',
-            'Billing City',
-            'Billing State',
-            'Postal Code',
-            'Billing Phone',
-            'EmailID',
-            'Users Assigned To',
-            'Created Time'
-        ]
-        ws.append(headers)
-
-        for idx, company in enumerate(companies, start=1):
-            ws.append([
-                idx,
-                company.get('name', COMPANY_PLACEHOLDER),
-                company.get('phone', COMPANY_PLACEHOLDER),
-                company.get('billing_attention', COMPANY_PLACEHOLDER),
-                company.get('billing_address', COMPANY_PLACEHOLDER),
-                company.get('billing_street', COMPANY_PLACEHOLDER),
-                company.get('billing_city', COMPANY_PLACEHOLDER),
-                company.get('billing_state', COMPANY_PLACEHOLDER),
-                company.get('billing_postal_code', COMPANY_PLACEHOLDER),
-                company.get('billing_phone', COMPANY_PLACEHOLDER),
-                company.get('email', COMPANY_PLACEHOLDER),
-                ','.join(company.get('assigned_to', [])) or COMPANY_PLACEHOLDER,
-                company.get('created_at', COMPANY_PLACEHOLDER)
-            ])
-
-        output = BytesIO()
+        export_format = (request.args.get('format') or 'xlsx').strip().lower()
+        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+
+        if export_format == 'csv':
+            return Response(
+                stream_with_context(_stream_companies_csv()),
+                mimetype='text/csv',
+                headers={'Content-Disposition': f'attachment; filename=companies_export_{timestamp}.csv'}
+            )
+        if export_format == 'ndjson':
+            return Response(
+                stream_with_context(_stream_companies_ndjson()),
+                mimetype='application/x-ndjson',
+                headers={'Content-Disposition': f'attachment; filename=companies_export_{timestamp}.ndjson'}
+            )
+        if export_format not in ('xlsx', 'excel'):
+            return jsonify({'success': False, 'error': 'Unsupported export format'}), 400
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Companies')
+        ws.append(COMPANY_EXPORT_HEADERS)
+        for idx, company in enumerate(_iter_export_companies(), start=1):
+            ws.append(_company_export_row(idx, company))
+
+        output = tempfile.TemporaryFile()
         wb.save(output)
         output.seek(0)
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
         filename = f'companies_export_{timestamp}.xlsx'
         return send_file(
             output,
@@ -1728,6 +1770,91 @@ def admin_export_companies():
         return jsonify({'success': False, 'error': 'Failed to export companies'}), 500
 
 
+COMPANY_EXPORT_HEADERS = [
+    'Sr No',
+    'Company Name',
+    'Phone',
+    'Billing Attention',
+    'Billing Address',
+    'Billing Street',
+    'Billing City',
+    'Billing State',
+    'Postal Code',
+    'Billing Phone',
+    'EmailID',
+    'Users Assigned To',
+    'Created Time'
+]
+
+COMPANY_EXPORT_CHUNK_ROWS = 500
+
+
+def _iter_export_companies():
+    """Yield serialized companies one at a time without materializing the directory."""
+    if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
+        cursor = mongo_db.companies.find({}, COMPANY_DIRECTORY_PROJECTION).sort('Company Name', 1).batch_size(1000)
+        for doc in cursor:
+            mapped = _map_mongo_company(doc)
+            if mapped:
+                yield serialize_admin_company(mapped)
+        return
+
+    for company in _get_company_directory()['companies']:
+        yield serialize_admin_company(company)
+
+
+def _company_export_row(idx, company):
+    return [
+        idx,
+        company.get('name', COMPANY_PLACEHOLDER),
+        company.get('phone', COMPANY_PLACEHOLDER),
+        company.get('billing_attention', COMPANY_PLACEHOLDER),
+        company.get('billing_address', COMPANY_PLACEHOLDER),
+        company.get('billing_street', COMPANY_PLACEHOLDER),
+        company.get('billing_city', COMPANY_PLACEHOLDER),
+        company.get('billing_state', COMPANY_PLACEHOLDER),
+        company.get('billing_postal_code', COMPANY_PLACEHOLDER),
+        company.get('billing_phone', COMPANY_PLACEHOLDER),
+        company.get('email', COMPANY_PLACEHOLDER),
+        ','.join(company.get('assigned_to', [])) or COMPANY_PLACEHOLDER,
+        company.get('created_at', COMPANY_PLACEHOLDER)
+    ]
+
+
+def _stream_companies_csv():
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COMPANY_EXPORT_HEADERS)
+    yield buffer.getvalue()
+
+    buffer.seek(0)
+    buffer.truncate()
+    for idx, company in enumerate(_iter_export_companies(), start=1):
+        writer.writerow(_company_export_row(idx, company))
+        if idx % COMPANY_EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _stream_companies_ndjson():
+    companies = _iter_export_companies()
+    # The first row goes out on its own so the response starts before a chunk fills
+    for company in companies:
+        yield json.dumps(company, ensure_ascii=False, default=str) + '\n'
+        break
+    lines = []
+    for company in companies:
+        lines.append(json.dumps(company, ensure_ascii=False, default=str))
+        if len(lines) >= COMPANY_EXPORT_CHUNK_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
 @app.route('/api/admin/quotations', methods=['GET'])
 @login_required
 @admin_required
@@ -1838,21 +1965,30 @@ def admin_quotation_pdf(quotation_id):
             'email': doc.get('company_email') or ''
         }
 
-        subtotal_before_discount = doc.get('subtotal_before_discount') or 0
-        total_discount = doc.get('total_discount') or 0
-        subtotal_after_discount = doc.get('subtotal_after_discount') or doc.get('total_amount_pre_gst') or max(0, float(subtotal_before_discount or 0) - float(total_discount or 0))
-        total_gst = doc.get('total_gst') or doc.get('gst_amount') or 0
-        total_after_gst = doc.get('total_amount_post_gst') or (float(subtotal_after_discount or 0) + float(total_gst or 0))
-
-        calculations = {
-            'subtotal_before_discount': subtotal_before_discount,
-            'total_discount': total_discount,
-            'subtotal_after_discount': subtotal_after_discount,
-            'gst_breakdown': {
-                'total_gst': total_gst
-            },
-            'total': total_after_gst
-        }
+        if isinstance(doc.get('summary'), dict):
+            # Quotations store the summary they were sent with
+            calculations = doc['summary']
+        else:
+            if doc.get('subtotal_before_discount') is None and doc.get('total_amount_pre_gst') is None:
+                # Older quotations stored no totals; price their lines instead of showing zeros
+                fallback = price_lines([p for p in products if isinstance(p, dict)], litres=True).summary()
+            else:
+                fallback = {}
+            subtotal_before_discount = doc.get('subtotal_before_discount') or fallback.get('subtotal') or 0
+            total_discount = doc.get('total_discount') or fallback.get('discount') or 0
+            subtotal_after_discount = doc.get('subtotal_after_discount') or doc.get('total_amount_pre_gst') or max(0, float(subtotal_before_discount or 0) - float(total_discount or 0))
+            total_gst = doc.get('total_gst') or doc.get('gst_amount') or fallback.get('gst') or 0
+            total_after_gst = doc.get('total_amount_post_gst') or (float(subtotal_after_discount or 0) + float(total_gst or 0))
+
+            calculations = {
+                'subtotal_before_discount': subtotal_before_discount,
+                'total_discount': total_discount,
+                'subtotal_after_discount': subtotal_after_discount,
+                'gst_breakdown': {
+                    'total_gst': total_gst
+                },
+                'total': total_after_gst
+            }
 
         payment_terms = doc.get('payment_terms') or doc.get('paymentTerms') or ''
 
@@ -2196,7 +2332,7 @@ RESEND_FROM_ADDRESS = os.getenv('RESEND_FROM') or (
 # Frontend URL for email links
 FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:3000')
 
-# Persistent file paths (Render users can attach a Disk at /var/data or set USERS_FILE_PATH/CART_FILE_PATH)
+# Persistent file paths (Render users can attach a Disk at /var/data or set USERS_FILE_PATH/CART_DIR_PATH)
 def _resolve_data_dir():
     # Determine writable directory for persistence
     preferred = os.getenv('DATA_DIR', '/var/data')
@@ -2214,7 +2350,7 @@ def _resolve_data_dir():
 
 DATA_DIR = _resolve_data_dir()
 USERS_FILE = os.getenv('USERS_FILE_PATH', os.path.join(DATA_DIR, 'users.json'))
-CART_FILE = os.getenv('CART_FILE_PATH', os.path.join(DATA_DIR, 'cart.json'))
+CART_DIR = os.getenv('CART_DIR_PATH', os.path.join(DATA_DIR, 'carts'))
 
 # User class
 def _parse_datetime(value):
@@ -2430,25 +2566,13 @@ def build_quotation_company_details(selected_company=None, session_company_id=No
 
     company_record = None
     try:
-        companies = load_companies_data()
+        if company_id:
+            company_record = find_company_by_id(company_id)
+        if company_record is None and company_email:
+            company_record = find_company_by_email(company_email)
     except Exception as e:
         app.logger.error(f"Failed to load companies for quotation details: {e}")
-        companies = []
-
-    if company_id and companies:
-        company_id_str = str(company_id)
-        for record in companies:
-            if str(record.get('id')) == company_id_str or str(record.get('_id')) == company_id_str:
-                company_record = record
-                break
-
-    if company_record is None and company_email and companies:
-        email_lower = company_email.strip().lower()
-        for record in companies:
-            record_email = (record.get('email') or record.get('EmailID') or '').strip().lower()
-            if record_email and record_email == email_lower:
-                company_record = record
-                break
+        company_record = None
 
     name = (company_record.get('name') or company_record.get('Company Name')) if company_record else None
     if not name:
@@ -2522,6 +2646,8 @@ COMPANY_IMPORT_REQUIRED_HEADERS = [
     'Users Assigned To'
 ]
 
+COMPANY_IMPORT_BATCH_SIZE = 500
+
 COMPANY_IMPORT_OPTIONAL_HEADERS = [
     'Sr No',
     'Billing Street',
@@ -2636,88 +2762,296 @@ def _convert_record_to_storage(record):
     return payload, created_at, assigned_to
 
 
-def _upsert_company_mongo(identifier_key, identifier_value, payload, assigned_to, created_at):
-    query = {}
-    if identifier_key == 'email':
-        query['EmailID'] = {'$regex': f'^{re.escape(identifier_value)}$', '$options': 'i'}
-    elif identifier_key == 'name':
-        query['Company Name'] = {'$regex': f'^{re.escape(identifier_value)}$', '$options': 'i'}
-    else:
-        return None, False, []
+def _iter_company_import_entries(rows, headers, row_errors):
+    """Yield normalized import entries for data rows, recording row-level errors as (row, message)."""
+    for row_index, row in enumerate(rows, start=2):
+        try:
+            record = _extract_row_data(headers, row)
+        except Exception as extract_error:
+            app.logger.error(f"Row {row_index} parsing error: {extract_error}", exc_info=True)
+            row_errors.append((row_index, 'Failed to parse row data'))
+            continue
+        if not any(str(value).strip() for value in record.values()):
+            continue
 
-    existing_doc = mongo_db.companies.find_one(query, {'_id': 1, 'assigned_to': 1})
-    previous_assigned = normalize_assigned_companies(existing_doc.get('assigned_to', [])) if existing_doc else []
-    created_at_value = created_at or datetime.utcnow()
+        identifier_key, identifier_value = _resolve_company_identifier(record)
+        if not identifier_value:
+            row_errors.append((row_index, 'Missing company name/email'))
+            continue
 
-    update_doc = {
-        '$set': {
-            **payload,
-            'assigned_to': assigned_to,
-            'updated_at': datetime.utcnow()
-        },
-        '$setOnInsert': {
-            'created_at': created_at_value,
-            'created_by': str(current_user.id)
+        try:
+            payload, created_at, assigned_to = _convert_record_to_storage(record)
+        except Exception as convert_error:
+            app.logger.error(f"Row {row_index} conversion error: {convert_error}", exc_info=True)
+            row_errors.append((row_index, 'Failed to normalize data'))
+            continue
+
+        yield {
+            'row': row_index,
+            'identifier_key': identifier_key,
+            'identifier_value': identifier_value,
+            'lookup': (identifier_key, identifier_value.lower()),
+            'payload': payload,
+            'created_at': created_at,
+            'assigned_to': normalize_assigned_companies(assigned_to),
         }
-    }
 
-    updated_doc = mongo_db.companies.find_one_and_update(
-        query,
-        update_doc,
-        upsert=True,
-        return_document=ReturnDocument.AFTER,
-        projection={'_id': 1}
-    )
 
-    company_id = str(updated_doc['_id']) if updated_doc else None
-    was_inserted = existing_doc is None and company_id is not None
+def _chunked(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    return company_id, was_inserted, previous_assigned
 
+def _company_identifier_filter(identifier_key, identifier_value):
+    field = 'EmailID' if identifier_key == 'email' else 'Company Name'
+    return {field: identifier_value}
 
-def _upsert_company_json(identifier_key, identifier_value, payload, assigned_to, created_at):
-    companies = load_companies_data()
-    identifier_value_lower = (identifier_value or '').lower()
-    assigned_normalized = normalize_assigned_companies(assigned_to)
-    created_at_iso = created_at.isoformat() if isinstance(created_at, datetime) else (created_at or datetime.utcnow().isoformat())
 
-    for company in companies:
-        if identifier_key == 'email':
-            compare_value = (company.get('EmailID') or company.get('email') or '').lower()
+def _prefetch_import_companies_mongo(entries, known):
+    """Load _id / assigned_to for batch identifiers not seen yet, via the case-insensitive indexes."""
+    wanted = {'email': set(), 'name': set()}
+    for entry in entries:
+        if entry['lookup'] not in known:
+            wanted[entry['identifier_key']].add(entry['identifier_value'])
+
+    for identifier_key, values in wanted.items():
+        if not values:
+            continue
+        field = 'EmailID' if identifier_key == 'email' else 'Company Name'
+        cursor = mongo_db.companies.find(
+            {field: {'$in': sorted(values)}},
+            {'_id': 1, field: 1, 'assigned_to': 1}
+        ).collation(COMPANY_CI_COLLATION)
+        for doc in cursor:
+            value = doc.get(field)
+            if isinstance(value, str) and value:
+                known.setdefault((identifier_key, value.lower()), {
+                    '_id': doc['_id'],
+                    'assigned_to': normalize_assigned_companies(doc.get('assigned_to', []))
+                })
+
+
+def _bulk_upsert_companies_mongo(entries, known, row_errors):
+    """Upsert one batch of import entries with ordered bulk_write calls.
+
+    ``known`` maps (identifier_key, lower-cased value) to the stored _id and
+    assigned_to and is carried across batches.  Returns
+    (entry, company_id, was_inserted, previous_assigned) for each row written.
+    """
+    _prefetch_import_companies_mongo(entries, known)
+
+    now = datetime.utcnow()
+    created_by = str(current_user.id)
+    operations = []
+    for entry in entries:
+        update_doc = {
+            '$set': {
+                **entry['payload'],
+                'assigned_to': entry['assigned_to'],
+                'updated_at': now
+            }
+        }
+        state = known.get(entry['lookup'])
+        if state is not None:
+            operations.append(UpdateOne({'_id': state['_id']}, update_doc))
         else:
-            compare_value = (company.get('Company Name') or company.get('name') or '').lower()
-
-        if compare_value and compare_value == identifier_value_lower:
-            previous_assigned = normalize_assigned_companies(company.get('assigned_to', []))
-            company.update(payload)
-            company['assigned_to'] = assigned_normalized
-            company['updated_at'] = datetime.utcnow().isoformat()
-            if created_at:
-                company['created_at'] = created_at_iso
-            save_companies_data(companies)
-            return company.get('id') or company.get('_id'), False, previous_assigned
-
-    new_company = payload.copy()
-    new_company['id'] = str(uuid.uuid4())
-    new_company['assigned_to'] = assigned_normalized
-    new_company['created_at'] = created_at_iso
-    new_company['created_by'] = str(current_user.id)
-    companies.append(new_company)
-    save_companies_data(companies)
-    return new_company['id'], True, []
-
-
-def _sync_assigned_users(company_id, assigned_to, previous_assigned=None):
-    if not company_id:
+            update_doc['$setOnInsert'] = {
+                'created_at': entry['created_at'] or now,
+                'created_by': created_by
+            }
+            operations.append(UpdateOne(
+                _company_identifier_filter(entry['identifier_key'], entry['identifier_value']),
+                update_doc,
+                upsert=True,
+                collation=COMPANY_CI_COLLATION
+            ))
+
+    upserted = {}
+    failed = set()
+    start = 0
+    while start < len(operations):
+        try:
+            result = mongo_db.companies.bulk_write(operations[start:], ordered=True)
+            for index, upserted_id in result.upserted_ids.items():
+                upserted[start + index] = upserted_id
+            break
+        except BulkWriteError as bulk_error:
+            details = bulk_error.details or {}
+            for item in details.get('upserted', []):
+                upserted[start + item['index']] = item['_id']
+            write_errors = details.get('writeErrors') or []
+            if not write_errors:
+                raise
+            failed_index = start + write_errors[0]['index']
+            failed.add(failed_index)
+            row_errors.append((entries[failed_index]['row'], write_errors[0].get('errmsg', 'Failed to upsert company')))
+            start = failed_index + 1
+        except Exception as batch_error:
+            app.logger.error(f"Error importing rows {entries[start]['row']}-{entries[-1]['row']}: {batch_error}")
+            for index in range(start, len(entries)):
+                failed.add(index)
+                row_errors.append((entries[index]['row'], str(batch_error)))
+            break
+
+    results = []
+    for index, entry in enumerate(entries):
+        if index in failed:
+            continue
+        state = known.get(entry['lookup'])
+        previous_assigned = state['assigned_to'] if state else []
+        was_inserted = index in upserted
+        if was_inserted:
+            company_oid = upserted[index]
+        elif state is not None:
+            company_oid = state['_id']
+        else:
+            # Matched a document written earlier in this batch under another identifier
+            doc = mongo_db.companies.find_one(
+                _company_identifier_filter(entry['identifier_key'], entry['identifier_value']),
+                {'_id': 1},
+                collation=COMPANY_CI_COLLATION
+            )
+            company_oid = doc['_id'] if doc else None
+        if company_oid is None:
+            row_errors.append((entry['row'], 'Failed to upsert company'))
+            continue
+
+        known[entry['lookup']] = {'_id': company_oid, 'assigned_to': entry['assigned_to']}
+        results.append((entry, str(company_oid), was_inserted, previous_assigned))
+    return results
+
+
+def _sync_company_assignments_mongo(assignment_changes):
+    """Apply the net user<->company link changes of an import in one pass.
+
+    ``assignment_changes`` maps company id to [assigned before import, assigned after].
+    """
+    changed = {cid: (before, after) for cid, (before, after) in assignment_changes.items() if before != after}
+    if not changed:
         return
 
-    normalized_current = normalize_assigned_companies(assigned_to)
-    normalized_previous = normalize_assigned_companies(previous_assigned or [])
+    pulls = {}
+    adds = {}
+    try:
+        for company_ids in _chunked(list(changed), 1000):
+            company_set = set(company_ids)
+            for user in mongo_db.users.find({'assigned_companies': {'$in': company_ids}}, {'assigned_companies': 1}):
+                uid = str(user['_id'])
+                for cid in company_set.intersection(normalize_assigned_companies(user.get('assigned_companies', []))):
+                    if uid not in changed[cid][1]:
+                        pulls.setdefault(uid, set()).add(cid)
+
+        for cid, (_, after) in changed.items():
+            for uid in after:
+                adds.setdefault(uid, set()).add(cid)
+
+        operations = []
+        for uid in set(pulls) | set(adds):
+            user_key = ObjectId(uid) if ObjectId.is_valid(uid) else uid
+            if adds.get(uid):
+                operations.append(UpdateOne({'_id': user_key}, {'$addToSet': {'assigned_companies': {'$each': sorted(adds[uid])}}}))
+            if pulls.get(uid):
+                operations.append(UpdateOne({'_id': user_key}, {'$pull': {'assigned_companies': {'$in': sorted(pulls[uid])}}}))
+
+        for batch in _chunked(operations, 1000):
+            mongo_db.users.bulk_write(batch, ordered=False)
+    except Exception as e:
+        app.logger.error(f"Error syncing imported company assignments: {e}", exc_info=True)
+    finally:
+        invalidate_user_assigned_companies(set(pulls) | set(adds))
+
+
+def _upsert_companies_json(entries, row_errors):
+    """Apply all import entries to the JSON company file in a single pass.
+
+    Rows are matched through the cached directory's email / name indexes
+    (plus the companies this import adds), and companies.json is rewritten
+    once at the end.  Returns (entry, company_id, was_inserted,
+    previous_assigned) per row written; if the save fails every row is
+    reported in ``row_errors`` and nothing is returned.
+    """
+    directory = _get_company_directory()
+    companies = [_copy_company_record(company) for company in directory['companies']]
+    added = {}
+
+    def lookup_key(entry):
+        if entry['identifier_key'] == 'email':
+            return 'by_email', _company_email_key(entry['identifier_value'])
+        return 'by_name', _company_name_key(entry['identifier_value'])
+
+    now_iso = datetime.utcnow().isoformat()
+    created_by = str(current_user.id)
+    results = []
+    for entry in entries:
+        try:
+            created_at = entry['created_at']
+            created_at_iso = created_at.isoformat() if isinstance(created_at, datetime) else (created_at or now_iso)
+            key = lookup_key(entry)
+            position = added.get(key)
+            if position is None:
+                position = directory[key[0]].get(key[1])
+
+            if position is not None:
+                company = companies[position]
+                previous_assigned = normalize_assigned_companies(company.get('assigned_to', []))
+                company.update(entry['payload'])
+                company['assigned_to'] = list(entry['assigned_to'])
+                company['updated_at'] = now_iso
+                if created_at:
+                    company['created_at'] = created_at_iso
+                results.append((entry, company.get('id') or company.get('_id'), False, previous_assigned))
+                continue
 
-    if set(normalized_current) == set(normalized_previous):
+            new_company = entry['payload'].copy()
+            new_company['id'] = str(uuid.uuid4())
+            new_company['assigned_to'] = list(entry['assigned_to'])
+            new_company['created_at'] = created_at_iso
+            new_company['created_by'] = created_by
+            companies.append(new_company)
+            added[key] = len(companies) - 1
+            results.append((entry, new_company['id'], True, []))
+        except Exception as row_error:
+            app.logger.error(f"Error importing row {entry['row']}: {row_error}")
+            row_errors.append((entry['row'], str(row_error)))
+
+    if results and not save_companies_data(companies):
+        row_errors.extend((entry['row'], 'Could not save the companies file') for entry, _, _, _ in results)
+        return []
+    return results
+
+
+def _sync_company_assignments_json(assignment_changes):
+    """JSON counterpart of _sync_company_assignments_mongo: one load and one save of the users file."""
+    changed = {cid: (before, after) for cid, (before, after) in assignment_changes.items() if before != after}
+    if not changed:
         return
 
-    sync_company_user_links(str(company_id), normalized_current)
+    try:
+        users_dict = load_users()
+        updated = False
+        for uid, record in users_dict.items():
+            uid_str = str(getattr(record, 'id', uid))
+            current = _extract_user_assigned_companies(record)
+            new_assignments = [cid for cid in current if cid not in changed or uid_str in changed[cid][1]]
+            for cid, (_, after) in changed.items():
+                if uid_str in after and cid not in new_assignments:
+                    new_assignments.append(cid)
+            if new_assignments != current:
+                _set_user_assigned_companies(record, new_assignments)
+                updated = True
+
+        if updated:
+            save_users(users_dict)
+    except Exception as e:
+        app.logger.error(f"Error syncing imported company assignments (json): {e}", exc_info=True)
+    finally:
+        invalidate_user_assigned_companies()
 
 
 def serialize_admin_user(user_doc):
@@ -2766,6 +3100,8 @@ def sync_user_company_links(user_id, assigned_company_ids):
     if not user_id:
         return
 
+    invalidate_user_assigned_companies([user_id])
+
     try:
         if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
             try:
@@ -2798,6 +3134,8 @@ def sync_user_company_links(user_id, assigned_company_ids):
 
             if invalid_ids:
                 app.logger.warning(f"Cannot sync company assignment for user {user_id} due to invalid company ids: {invalid_ids}")
+
+            invalidate_companies_cache()
         else:
             companies = load_companies_data()
             updated = False
@@ -2870,6 +3208,8 @@ def sync_company_user_links(company_id, assigned_user_ids):
                             mongo_db.users.update_one({'_id': uid}, {'$addToSet': {'assigned_companies': company_id}})
                     except Exception as add_error:
                         app.logger.error(f"Error syncing company {company_id} to user {uid}: {add_error}")
+
+                invalidate_user_assigned_companies(processed | assigned_set)
             except Exception as mongo_error:
                 app.logger.error(f"Error syncing company-user links (mongo): {mongo_error}")
         else:
@@ -2891,6 +3231,7 @@ def sync_company_user_links(company_id, assigned_user_ids):
 
             if updated:
                 save_users(users_dict)
+                invalidate_user_assigned_companies()
     except Exception as e:
         app.logger.error(f"Unexpected error in sync_company_user_links: {e}", exc_info=True)
 
@@ -2958,13 +3299,23 @@ def load_admin_users():
 # ----- Company JSON saver for fallback -----
 
 def save_companies_data(companies):
-    """Save companies list to JSON file as fallback when Mongo not used."""
+    """Save companies list to JSON file as fallback when Mongo not used.
+
+    Writes a uniquely named temporary file and swaps it in, so readers never
+    see a partial file and concurrent writers never share a temp file."""
     try:
-        data_dir = os.path.join(app.root_path, 'static', 'data')
-        os.makedirs(data_dir, exist_ok=True)
-        target = os.path.join(data_dir, 'companies.json')
-        with open(target, 'w', encoding='utf-8') as f:
-            json.dump({'companies': companies}, f, ensure_ascii=False, indent=2, default=str)
+        target = _companies_json_path()
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.companies-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'companies': companies}, f, ensure_ascii=False, indent=2, default=str)
+            os.replace(temp_file, target)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        invalidate_companies_cache()
         return True
     except Exception as e:
         app.logger.error(f"Error saving companies JSON: {e}")
@@ -3058,6 +3409,7 @@ def load_user(user_id):
                 created_at=_parse_datetime(doc.get('created_at')),
                 assigned_companies=doc.get('assigned_companies', [])
             )
+            remember_user_assigned_companies(user.id, user.assigned_companies)
             print(f'Successfully loaded user: {user.email} (ID: {user.id})')
             return user
         except Exception as e:
@@ -3305,6 +3657,140 @@ app.logger.info("Flask app initialized")
 
 # Initialize cart store
 # -------------------- Cart storage abstractions --------------------
+# Each cart document carries a ``totals`` sub-document (subtotal, discount, GST
+# per rate and grand total) that item writes adjust with $inc in the same
+# update, so readers never have to walk the products array.
+
+CART_TOTAL_FIELDS = ('subtotal', 'discount', 'grand_total')
+CART_WRITE_RETRIES = 3
+
+
+class CartConflictError(Exception):
+    """A versioned cart write lost the race; ``cart`` is the document that won."""
+
+    def __init__(self, cart):
+        super().__init__('Cart was changed by another request')
+        self.cart = cart
+
+
+def cart_conflict_response(error):
+    """409 response carrying the current cart so the client can re-apply its edit."""
+    cart = error.cart or {}
+    return jsonify({
+        'success': False,
+        'error': 'Cart was changed by another request',
+        'message': 'Your cart was changed elsewhere. Please review it and try again.',
+        'cart': {
+            'products': cart.get('products') or [],
+            'totals': cart.get('totals'),
+            'version': cart.get('version') or 0
+        }
+    }), 409
+
+
+def _cart_number(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _gst_rate_key(rate):
+    """Field-safe key for a GST rate: 18 -> '18', 2.5 -> '2_5'."""
+    return ('%g' % _cart_number(rate)).replace('.', '_')
+
+
+def cart_line_totals(product):
+    """Return one line's contribution to the cart totals sub-document.
+
+    ``total_price`` is the line's total.  The breakdown comes from
+    ``calculations`` while its final_total agrees with it; otherwise GST and
+    discount are backed out of total_price with the line's own rates.
+    """
+    if not isinstance(product, dict):
+        return {'subtotal': 0.0, 'discount': 0.0, 'gst': {}, 'grand_total': 0.0}
+    calculations = product.get('calculations') if isinstance(product.get('calculations'), dict) else {}
+    gst_rate = calculations.get('gst_percent', product.get('gst_percent', 18))
+    if _line_total_current(product):
+        grand_total = _cart_number(calculations.get('final_total'))
+        discount = _cart_number(calculations.get('discount_amount'))
+        gst_amount = _cart_number(calculations.get('gst_amount'))
+        if 'subtotal' in calculations:
+            subtotal = _cart_number(calculations.get('subtotal'))
+        else:
+            subtotal = grand_total - gst_amount + discount
+    else:
+        gst_rate = product.get('gst_percent', gst_rate)
+        discount_rate = _cart_number(product.get('discount_percent'))
+        grand_total = _cart_number(product.get('total_price'))
+        taxable = grand_total / (1 + _cart_number(gst_rate) / 100)
+        gst_amount = grand_total - taxable
+        subtotal = taxable / (1 - discount_rate / 100) if 0 <= discount_rate < 100 else taxable
+        discount = subtotal - taxable
+    return {
+        'subtotal': subtotal,
+        'discount': discount,
+        'gst': {_gst_rate_key(gst_rate): gst_amount} if gst_amount else {},
+        'grand_total': grand_total
+    }
+
+
+def round_cart_totals(totals):
+    totals = totals if isinstance(totals, dict) else {}
+    gst = totals.get('gst') if isinstance(totals.get('gst'), dict) else {}
+    rounded = {field: round(_cart_number(totals.get(field)), 2) for field in CART_TOTAL_FIELDS}
+    rounded['gst'] = {rate: round(_cart_number(amount), 2) for rate, amount in gst.items() if round(_cart_number(amount), 2)}
+    return rounded
+
+
+def compute_cart_totals(products):
+    """Build the totals sub-document from scratch."""
+    totals = {field: 0.0 for field in CART_TOTAL_FIELDS}
+    totals['gst'] = {}
+    for product in products:
+        line = cart_line_totals(product)
+        for field in CART_TOTAL_FIELDS:
+            totals[field] += line[field]
+        for rate, amount in line['gst'].items():
+            totals['gst'][rate] = totals['gst'].get(rate, 0.0) + amount
+    return round_cart_totals(totals)
+
+
+def cart_totals_increments(added=None, removed=None):
+    """$inc document moving the totals from ``removed`` line to ``added`` line."""
+    increments = {}
+    for line, sign in ((added, 1), (removed, -1)):
+        if line is None:
+            continue
+        contribution = cart_line_totals(line)
+        for field in CART_TOTAL_FIELDS:
+            key = f"totals.{field}"
+            increments[key] = increments.get(key, 0.0) + sign * contribution[field]
+        for rate, amount in contribution['gst'].items():
+            key = f"totals.gst.{rate}"
+            increments[key] = increments.get(key, 0.0) + sign * amount
+    return increments
+
+
+def check_cart_totals(cart, tolerance=0.01):
+    """Compare a cart's stored totals with a full recomputation.
+
+    Returns ``{field: (stored, expected)}`` for every field that disagrees by
+    more than ``tolerance``; an empty dict means the totals are consistent.
+    """
+    stored = round_cart_totals((cart or {}).get('totals'))
+    expected = compute_cart_totals((cart or {}).get('products') or [])
+    mismatches = {}
+    for field in CART_TOTAL_FIELDS:
+        if abs(stored[field] - expected[field]) > tolerance:
+            mismatches[field] = (stored[field], expected[field])
+    for rate in set(stored['gst']) | set(expected['gst']):
+        have, want = stored['gst'].get(rate, 0.0), expected['gst'].get(rate, 0.0)
+        if abs(have - want) > tolerance:
+            mismatches[f"gst.{rate}"] = (have, want)
+    return mismatches
+
+
 class MongoCartStore:
     """MongoDB-backed cart store with one cart document per user."""
 
@@ -3321,6 +3807,16 @@ class MongoCartStore:
         )
         return doc or {}
 
+    @staticmethod
+    def _version_filter(version):
+        """Match a cart at ``version``; carts written before versioning count as 0."""
+        return {"version": version} if version else {"version": {"$in": [0, None]}}
+
+    def get_cart_document(self, user_id):
+        """Return ``{'products': [...], 'totals': {...} or None, 'version': int}`` for the user."""
+        doc = self._doc(user_id)
+        return {'products': doc.get('products', []), 'totals': doc.get('totals'), 'version': int(doc.get('version') or 0)}
+
     def get_cart(self, user_id):
         app.logger.debug("[DEBUG] get_cart(user_id=%s)", user_id)
         doc = self._doc(user_id)
@@ -3334,7 +3830,8 @@ class MongoCartStore:
             app.logger.debug("[DEBUG] Sample product data: %s", str(products[0])[:200])
         return products
 
-    def save_cart(self, user_id, products):
+    def save_cart(self, user_id, products, expected_version=None):
+        """Overwrite the cart; with ``expected_version`` only if nobody wrote it since."""
         app.logger.debug(
             "[DEBUG] save_cart(user_id=%s) - Saving %d products",
             user_id,
@@ -3343,17 +3840,22 @@ class MongoCartStore:
         if products:
             app.logger.debug("[DEBUG] Sample product being saved: %s", str(products[0])[:200])
             
-        result = self.col.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "products": products,
-                    "updated_at": datetime.utcnow(),
-                    "user_id": user_id  # Ensure user_id is set
-                }
+        update = {
+            "$set": {
+                "products": products,
+                "totals": compute_cart_totals(products),
+                "updated_at": datetime.utcnow(),
+                "user_id": user_id  # Ensure user_id is set
             },
-            upsert=True
-        )
+            "$inc": {"version": 1}
+        }
+        if expected_version is not None:
+            result = self.col.update_one({"user_id": user_id, **self._version_filter(expected_version)}, update)
+            if result.matched_count:
+                return True
+            if expected_version or self.col.find_one({"user_id": user_id}, {"_id": 1}) is not None:
+                raise CartConflictError(self.get_cart_document(user_id))
+        result = self.col.update_one({"user_id": user_id}, update, upsert=True)
         app.logger.debug(
             "[DEBUG] Cart save result - Matched: %d, Modified: %d, Upserted ID: %s",
             result.matched_count,
@@ -3366,49 +3868,322 @@ class MongoCartStore:
         app.logger.info("[DEBUG] Clearing cart for user: %s", user_id)
         return self.save_cart(user_id, [])
 
+    def get_summary(self, user_id):
+        """Return ``(item_count, cart_total)`` without shipping the products array.
 
-# Fallback JSON/in-memory version ----------------------------------
-class CartStore:
-    _instance = None
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance.cart = cls._load_cart()
-        return cls._instance
-    
-    @staticmethod
-    def _load_cart():
-        try:
-            if os.path.exists(CART_FILE):
-                with open(CART_FILE, 'r') as f:
-                    return json.load(f)
-            return {"products": []}
-        except Exception as e:
-            print(f"Error loading cart: {e}")
-            return {"products": []}
-    
-    @staticmethod
-    def _save_cart(cart):
-        try:
-            os.makedirs(os.path.dirname(CART_FILE), exist_ok=True)
-            with open(CART_FILE, 'w') as f:
-                json.dump(cart, f, indent=2)
-            return True
-        except Exception as e:
-            print(f"Error saving cart: {e}")
-            return False
-    
-    def get_cart(self, *_args, **_kwargs):
-        """Return stored cart; ignores user since json cart is global."""
-        return self.cart
-    
-    def save_cart(self, cart):
-        self.cart = cart
-        return self._save_cart(cart)
+        Uses the maintained totals; carts written before they existed fall
+        back to summing the line totals server-side.
+        """
+        line_total = {
+            "$ifNull": ["$$p.total_price", {"$ifNull": ["$$p.calculations.final_total", 0]}]
+        }
+        rows = list(self.col.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$project": {
+                "_id": 0,
+                "count": {"$size": {"$ifNull": ["$products", []]}},
+                "total": {"$ifNull": ["$totals.grand_total", {"$sum": {"$map": {
+                    "input": {"$ifNull": ["$products", []]},
+                    "as": "p",
+                    "in": {"$convert": {"input": line_total, "to": "double", "onError": 0, "onNull": 0}}
+                }}}]}
+            }}
+        ]))
+        if not rows:
+            return 0, 0.0
+        return int(rows[0].get("count") or 0), round(float(rows[0].get("total") or 0), 2)
+
+    # Item-level writes touch one array element, so concurrent tabs editing
+    # different lines do not overwrite each other.  The totals sub-document is
+    # adjusted with $inc in the same update; remove/update match the exact
+    # stored line so the increment is always taken from what is replaced.
+    # Each returns the updated cart document, or None when the item is not
+    # in the cart.  Every write bumps ``version``; update_item can be made a
+    # compare-and-swap on it with ``expected_version``.
+
+    _ITEM_PROJECTION = {"products": 1, "totals": 1, "version": 1}
+
+    def _ensure_totals(self, user_id):
+        """Create the cart, or backfill totals on a cart written before they existed."""
+        doc = self.col.find_one({"user_id": user_id}, {"products": 1, "totals": 1})
+        if doc is None:
+            self.col.update_one(
+                {"user_id": user_id},
+                {"$setOnInsert": {"products": [], "totals": compute_cart_totals([]), "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+        elif doc.get("totals") is None:
+            products = doc.get("products") or []
+            self.col.update_one(
+                {"_id": doc["_id"], "products": products, "totals": {"$exists": False}},
+                {"$set": {"totals": compute_cart_totals(products)}}
+            )
 
-# Choose the appropriate cart store implementation dynamically
-cart_store = None
+    def _line(self, user_id, item_id):
+        """Return the stored line for ``item_id`` (None if absent), backfilling totals first."""
+        doc = self.col.find_one({"user_id": user_id, "products.id": item_id}, {"products.$": 1, "totals": 1})
+        if doc is not None and doc.get("totals") is None:
+            self._ensure_totals(user_id)
+            doc = self.col.find_one({"user_id": user_id, "products.id": item_id}, {"products.$": 1})
+        products = (doc or {}).get("products") or []
+        return products[0] if products else None
+
+    def add_item(self, user_id, product):
+        for _attempt in range(CART_WRITE_RETRIES):
+            doc = self.col.find_one_and_update(
+                {"user_id": user_id, "totals": {"$exists": True}},
+                {
+                    "$push": {"products": product},
+                    "$inc": {**cart_totals_increments(added=product), "version": 1},
+                    "$set": {"updated_at": datetime.utcnow()}
+                },
+                projection=self._ITEM_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is not None:
+                return doc
+            self._ensure_totals(user_id)
+        return None
+
+    def remove_item(self, user_id, item_id):
+        for _attempt in range(CART_WRITE_RETRIES):
+            line = self._line(user_id, item_id)
+            if line is None:
+                return None
+            doc = self.col.find_one_and_update(
+                {"user_id": user_id, "products": line},
+                {
+                    "$pull": {"products": {"id": item_id}},
+                    "$inc": {**cart_totals_increments(removed=line), "version": 1},
+                    "$set": {"updated_at": datetime.utcnow()}
+                },
+                projection=self._ITEM_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is not None:
+                return doc
+        return None
+
+    def update_item(self, user_id, item_id, fields, expected_version=None):
+        """Set ``fields`` on one line.
+
+        With ``expected_version`` the write only applies to that cart version
+        and raises CartConflictError instead of retrying, since the caller has
+        to re-apply its edit to the newer line.
+        """
+        for _attempt in range(CART_WRITE_RETRIES):
+            line = self._line(user_id, item_id)
+            if line is None:
+                return None
+            updates = {f"products.$.{key}": value for key, value in fields.items()}
+            updates["updated_at"] = datetime.utcnow()
+            query = {"user_id": user_id, "products": line}
+            if expected_version is not None:
+                query.update(self._version_filter(expected_version))
+            doc = self.col.find_one_and_update(
+                query,
+                {
+                    "$set": updates,
+                    "$inc": {**cart_totals_increments(added={**line, **fields}, removed=line), "version": 1}
+                },
+                projection=self._ITEM_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is not None:
+                return doc
+            if expected_version is not None:
+                if self._line(user_id, item_id) is None:
+                    return None
+                raise CartConflictError(self.get_cart_document(user_id))
+        return None
+
+
+# Fallback JSON version ---------------------------------------------
+class CartStore:
+    """JSON cart store used without MongoDB: one file per user under CART_DIR.
+
+    Files are sharded by a hash of the user id.  Writes go to a temp file that
+    is renamed over the cart while holding an flock on the user's lock file, so
+    several gunicorn workers can share the directory.  Setting
+    CART_WRITE_BEHIND_SECONDS buffers writes in memory and flushes them in the
+    background; that is only safe with a single worker process.
+
+    Threads serialise on a per-user lock; ``_lock`` only guards the write-behind
+    buffer and the lock table, so no file I/O happens while it is held.
+    """
+
+    def __init__(self, base_dir=None, write_behind=None):
+        self.base_dir = base_dir or CART_DIR
+        if write_behind is None:
+            write_behind = float(os.getenv('CART_WRITE_BEHIND_SECONDS', '0') or 0)
+        self.write_behind = write_behind
+        self._lock = threading.Lock()
+        self._user_locks = weakref.WeakValueDictionary()
+        self._pending = {}
+        self._timer = None
+        os.makedirs(self.base_dir, exist_ok=True)
+        if self.write_behind > 0:
+            atexit.register(self.flush)
+
+    def _path(self, user_id):
+        digest = hashlib.sha1(str(user_id).encode('utf-8')).hexdigest()
+        return os.path.join(self.base_dir, digest[:2], f"{digest}.json")
+
+    def _thread_lock(self, user_id):
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    @contextmanager
+    def _user_lock(self, user_id):
+        path = self._path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._thread_lock(user_id), open(path + '.lock', 'a') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_document(self, user_id):
+        with self._lock:
+            pending = self._pending.get(user_id)
+        if pending is not None:
+            products, version = pending
+            products = copy.deepcopy(products)
+            return {'products': products, 'totals': compute_cart_totals(products), 'version': version}
+        try:
+            with open(self._path(user_id), 'r', encoding='utf-8') as f:
+                doc = json.load(f)
+        except FileNotFoundError:
+            doc = {}
+        except (OSError, ValueError) as e:
+            app.logger.error(f"Error reading cart file for user {user_id}: {str(e)}")
+            doc = {}
+        products = doc.get('products') if isinstance(doc, dict) else None
+        products = products if isinstance(products, list) else []
+        totals = doc.get('totals') if isinstance(doc, dict) else None
+        if not isinstance(totals, dict):
+            totals = compute_cart_totals(products)
+        version = doc.get('version') if isinstance(doc, dict) else 0
+        return {'products': products, 'totals': totals, 'version': int(version or 0)}
+
+    def _read(self, user_id):
+        return self._read_document(user_id)['products']
+
+    def _write(self, user_id, products, version):
+        path = self._path(user_id)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.cart-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'user_id': str(user_id),
+                    'products': products,
+                    'totals': compute_cart_totals(products),
+                    'version': version,
+                    'updated_at': datetime.utcnow().isoformat()
+                }, f, separators=(',', ':'), default=str)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _store(self, user_id, products, version):
+        if self.write_behind <= 0:
+            self._write(user_id, products, version)
+            return
+        pending = (copy.deepcopy(products), version)
+        with self._lock:
+            self._pending[user_id] = pending
+            if self._timer is None:
+                self._timer = threading.Timer(self.write_behind, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _modify(self, user_id, change, expected_version=None):
+        """Apply ``change(products)`` under the user's lock and store the result.
+
+        ``change`` returns the new products list, or None to leave the cart
+        alone.  Returns ``{'products': ...}`` like MongoCartStore, or None.
+        Raises CartConflictError if ``expected_version`` is given and stale.
+        """
+        with self._user_lock(user_id):
+            current = self._read_document(user_id)
+            stale = expected_version is not None and current['version'] != expected_version
+            products = change(copy.deepcopy(current['products']) if stale else current['products'])
+            if products is None:
+                return None
+            if stale:
+                raise CartConflictError(current)
+            version = current['version'] + 1
+            self._store(user_id, products, version)
+            return {'products': products, 'totals': compute_cart_totals(products), 'version': version}
+
+    def flush(self):
+        """Write any buffered carts to disk.
+
+        Each cart stays buffered (and is what readers see) until its file has
+        been replaced, so a read never falls back to the older file mid-flush.
+        """
+        with self._lock:
+            user_ids = list(self._pending)
+            self._timer = None
+        for user_id in user_ids:
+            try:
+                with self._user_lock(user_id):
+                    with self._lock:
+                        pending = self._pending.get(user_id)
+                    if pending is None:
+                        continue
+                    self._write(user_id, *pending)
+                    with self._lock:
+                        if self._pending.get(user_id) is pending:
+                            del self._pending[user_id]
+            except Exception as e:
+                app.logger.error(f"Error flushing cart for user {user_id}: {str(e)}")
+
+    def get_cart_document(self, user_id):
+        return self._read_document(user_id)
+
+    def get_cart(self, user_id):
+        return self._read(user_id)
+
+    def save_cart(self, user_id, products, expected_version=None):
+        self._modify(user_id, lambda _current: list(products), expected_version)
+        return True
+
+    def clear_cart(self, user_id):
+        return self.save_cart(user_id, [])
+
+    def get_summary(self, user_id):
+        doc = self.get_cart_document(user_id)
+        return len(doc['products']), round_cart_totals(doc['totals'])['grand_total']
+
+    def add_item(self, user_id, product):
+        return self._modify(user_id, lambda products: products + [product])
+
+    def remove_item(self, user_id, item_id):
+        def change(products):
+            remaining = [p for p in products if not (isinstance(p, dict) and p.get('id') == item_id)]
+            return remaining if len(remaining) < len(products) else None
+        return self._modify(user_id, change)
+
+    def update_item(self, user_id, item_id, fields, expected_version=None):
+        def change(products):
+            for product in products:
+                if isinstance(product, dict) and product.get('id') == item_id:
+                    product.update(fields)
+                    return products
+            return None
+        return self._modify(user_id, change, expected_version)
+
+# Choose the appropriate cart store implementation dynamically
+cart_store = None
 
 
 def get_cart_store():
@@ -3427,8 +4202,903 @@ def get_cart_store():
 
 # -------------------- Cart helper wrappers --------------------
 
+# Bump when the stored pricing of cart lines changes shape or rates, so
+# migrate_cart_pricing() and the read path re-price older lines once.
+# 2: carts carry a maintained totals sub-document (backfilled by the migration).
+# 3: lines carry a duplicate-detection fingerprint.
+# 4: non-adhesive polipack lines re-priced from the compiled MPack rate table.
+# 5: chemical / maintenance lines re-priced in litres (merges had priced packs).
+# 6: lines whose calculations.final_total went stale on quantity / discount edits.
+# 7: fingerprints cover the discount and the spray powder format.
+CART_PRICING_VERSION = 7
+
+
+# Fields that, with the type and dimensions, make two lines "the same product"
+CART_FINGERPRINT_FIELDS = ('thickness', 'bar_type', 'machine', 'underpacking_type')
+CART_FINGERPRINT_IDENTITY = {
+    'blanket': ('name',),
+    'mpack': ('size',),
+    'chemical': ('product_id', 'format_id'),
+    'maintenance': ('product_id', 'format_id'),
+    'spray_powder': ('product_id', 'format_id'),
+    'rule': ('rule_category', 'profile_id', 'packaging_type'),
+}
+_UNIT_TO_MM = {'mm': 1.0, 'cm': 10.0, 'in': 25.4, 'm': 1000.0}
+# A repeated add of the same line either merges into it or returns is_duplicate
+# so the page can ask the user and resend with force_add.  The blanket and MPack
+# pages ask; the others have no duplicate dialog, so their types merge by default
+# (CART_MERGE_TYPES, comma separated).  CART_MERGE_DUPLICATES=true merges every
+# type, and a request's merge_duplicates overrides both.
+CART_MERGE_DUPLICATES = os.getenv('CART_MERGE_DUPLICATES', 'false').lower() in ('1', 'true', 'yes')
+CART_MERGE_TYPES = frozenset(
+    product_type.strip() for product_type in
+    os.getenv('CART_MERGE_TYPES', 'chemical,maintenance,spray_powder,rule,creasing_matrix').split(',')
+    if product_type.strip()
+)
+
+
+def _fingerprint_text(value):
+    return ' '.join(str(value).casefold().split()) if value not in (None, '') else ''
+
+
+def _fingerprint_dimensions(product):
+    """(length, width) in mm rounded to 0.01, or (None, None) when the line has no size."""
+    if product.get('type') == 'blanket':
+        factor = _UNIT_TO_MM.get(str(product.get('unit') or 'mm').lower(), 1.0)
+        length, width = to_float(product.get('length')), to_float(product.get('width'))
+    else:
+        factor = 1.0
+        length = to_float(product.get('display_length_mm') or product.get('height'))
+        width = to_float(product.get('display_width_mm') or product.get('width'))
+    return tuple(round(value * factor, 2) if value else None for value in (length, width))
+
+
+def cart_item_fingerprint(product):
+    """Stable hash of what makes a cart line a duplicate of another.
+
+    Covers the type, normalized dimensions, thickness, bar type, machine and
+    underpacking, plus the per-type identity fields in CART_FINGERPRINT_IDENTITY
+    (name and size for types not listed) and the discount, so lines that
+    merge always share a format and a discount.
+    """
+    product_type = _fingerprint_text(product.get('type'))
+    key = [product_type, *_fingerprint_dimensions(product)]
+    key += [_fingerprint_text(product.get(field)) for field in CART_FINGERPRINT_FIELDS]
+    key += [_fingerprint_text(product.get(field)) for field in CART_FINGERPRINT_IDENTITY.get(product_type, ('name', 'size'))]
+    key.append('%g' % _cart_number(product.get('discount_percent')))
+    return hashlib.sha1(json.dumps(key, separators=(',', ':')).encode('utf-8')).hexdigest()[:20]
+
+
+def merge_cart_line(item, product):
+    """Fold ``product``'s quantity into its duplicate line ``item`` and re-price the line.
+
+    Chemical and maintenance lines add their requested litres and re-solve the
+    packs for the combined volume; spray powder re-solves its kg packs.
+    """
+    item_type = item.get('type')
+    if item_type in ('chemical', 'maintenance'):
+        litres = _cart_number(item.get('quantity_litre')) + _cart_number(product.get('quantity_litre'))
+        return apply_litre_quantity(item, litres)
+
+    quantity = _cart_number(item.get('quantity') or 1) + _cart_number(product.get('quantity') or 1)
+    quantity = int(quantity) if float(quantity).is_integer() else round(quantity, 3)
+    item['quantity'] = quantity
+    if item_type == 'spray_powder' and item.get('quantity_kg') is not None and product.get('quantity_kg') is not None:
+        item['quantity_kg'] = round(_cart_number(item['quantity_kg']) + _cart_number(product['quantity_kg']), 3)
+        apply_pack_check(item, log_mismatch=False)
+    if item_type == 'rule':
+        item['total_length_m'] = None
+        recalc_rule_pricing(item)
+    elif item_type == 'blanket':
+        apply_cart_quantity(item, quantity, None)
+    else:
+        apply_cart_discount(item, _cart_number(item.get('discount_percent')))
+    return item
+
+
+_mpack_rate_tables = {}
+_mpack_rate_tables_lock = threading.Lock()
+
+
+def get_mpack_rate_table(pricing_mode=None):
+    """Compiled MPack rate table for the pricing mode's mpack.json, loaded once per worker."""
+    if pricing_mode is None:
+        pricing_mode = get_active_pricing_mode() if has_request_context() else 'standard'
+    parts = ('static', 'data', 'gm', 'mpack.json') if pricing_mode == 'gm' else ('static', 'data', 'mpack.json')
+    table = _mpack_rate_tables.get(parts)
+    if table is None:
+        with _mpack_rate_tables_lock:
+            table = _mpack_rate_tables.get(parts)
+            if table is None:
+                table = _mpack_rate_tables[parts] = load_mpack_rate_table(os.path.join(app.root_path, *parts))
+    return table
+
+
+_rule_catalogs = {}
+_rule_catalogs_lock = threading.Lock()
+
+
+def get_rule_catalog(pricing_mode=None):
+    """Cutting / creasing rule catalogue index for the pricing mode, loaded once per worker."""
+    if pricing_mode is None:
+        pricing_mode = get_active_pricing_mode() if has_request_context() else 'standard'
+    catalog = _rule_catalogs.get(pricing_mode)
+    if catalog is None:
+        with _rule_catalogs_lock:
+            catalog = _rule_catalogs.get(pricing_mode)
+            if catalog is None:
+                parts = ('static', 'data', *(['gm'] if pricing_mode == 'gm' else []),
+                         'Creasing_cutting_rule', 'cutting_creasing_rules.json')
+                try:
+                    with open(os.path.join(app.root_path, *parts), 'r', encoding='utf-8') as f:
+                        catalog = RuleCatalogIndex(json.load(f))
+                except (OSError, ValueError) as e:
+                    app.logger.error(f"Error loading {pricing_mode} rule catalogue: {str(e)}")
+                    catalog = RuleCatalogIndex({})
+                _rule_catalogs[pricing_mode] = catalog
+    return catalog
+
+
+def apply_rule_catalog_price(product):
+    """Take a rule line's length and rate from the catalogue; returns the RuleProfile, or None if unknown."""
+    profile = get_rule_catalog().get(product.get('profile_id'), product.get('packaging_type'))
+    if profile is None:
+        return None
+    product['rule_category'] = product.get('rule_category') or profile.rule_category
+    product['length_per_unit_m'] = profile.length_per_unit_m
+    product['rate_per_meter'] = profile.rate_per_meter
+    product['unit_price'] = profile.unit_price
+    product['total_length_m'] = round(profile.length_per_unit_m * (_cart_number(product.get('quantity')) or 1), 2)
+    return profile
+
+
+_pack_catalogs = {}
+_pack_catalogs_lock = threading.Lock()
+
+# line type -> (catalogue file under static/data, unit, stored field suffix)
+PACK_LINE_TYPES = {
+    'chemical': ('chemicals', 'litre', 'litre'),
+    'spray_powder': ('spray_powder', 'kg', 'kg'),
+}
+
+
+def get_pack_catalog(pricing_mode=None):
+    """Pack solvers for the pricing mode's chemical and spray powder catalogues, built once per worker."""
+    if pricing_mode is None:
+        pricing_mode = get_active_pricing_mode() if has_request_context() else 'standard'
+    catalog = _pack_catalogs.get(pricing_mode)
+    if catalog is None:
+        with _pack_catalogs_lock:
+            catalog = _pack_catalogs.get(pricing_mode)
+            if catalog is None:
+                data_dir = os.path.join(app.root_path, 'static', 'data', *(['gm'] if pricing_mode == 'gm' else []))
+                sources = []
+                for folder, unit, _ in PACK_LINE_TYPES.values():
+                    try:
+                        with open(os.path.join(data_dir, folder, 'products.json'), 'r', encoding='utf-8') as f:
+                            sources.append((json.load(f), unit))
+                    except (OSError, ValueError) as e:
+                        app.logger.error(f"Error loading {folder} pack formats: {str(e)}")
+                catalog = _pack_catalogs[pricing_mode] = PackCatalog(*sources)
+    return catalog
+
+
+def apply_pack_check(product, log_mismatch=True):
+    """Recompute a chemical / spray powder line's pack numbers from its catalogue format.
+
+    The page works out packs_needed, total and surplus itself; the stored line
+    keeps the server's figures and a mismatch is logged (unless
+    ``log_mismatch`` is False, for lines whose volume the server just changed).
+    Returns the PackSolution, or None when the product or format is not in the
+    catalogue.
+    """
+    suffix = PACK_LINE_TYPES.get(product.get('type'), PACK_LINE_TYPES['chemical'])[2]
+    solver = get_pack_catalog().get(product.get('product_id'))
+    if solver is None:
+        return None
+    solution = solver.single_format(product.get('format_id'), product.get(f'quantity_{suffix}'))
+    if solution is None:
+        return None
+
+    fmt, packs_needed = solution.packs[0]
+    expected = {
+        f'pack_size_{suffix}': fmt.size,
+        'packs_needed': packs_needed,
+        f'total_{suffix}': solution.total,
+        f'surplus_{suffix}': solution.surplus
+    }
+    mismatched = [key for key, value in expected.items()
+                  if product.get(key) is None or abs(_cart_number(product.get(key)) - value) > 0.001]
+    if mismatched and log_mismatch:
+        app.logger.warning(
+            f"Pack numbers for {product.get('product_id')} / {product.get('format_id')} "
+            f"did not match the catalogue ({', '.join(mismatched)}); using server values"
+        )
+    product.update(expected)
+    return solution
+
+
+def apply_litre_quantity(item, quantity_litre):
+    """Set a chemical / maintenance line's requested litres and re-price it; returns the line.
+
+    The packs are re-solved for the new volume (from the catalogue, or from the
+    line's own pack size for products not in it), the line is priced as litres
+    x price per litre, and only then does ``quantity`` take the pack count.
+    """
+    quantity_litre = round(_cart_number(quantity_litre), 3)
+    item['quantity_litre'] = quantity_litre
+    if apply_pack_check(item, log_mismatch=False) is None:
+        pack_size = _cart_number(item.get('pack_size_litre'))
+        if pack_size > 0:
+            item['packs_needed'] = max(1, math.ceil(round(quantity_litre / pack_size, 6)))
+            item['total_litre'] = round(item['packs_needed'] * pack_size, 3)
+        else:
+            item['packs_needed'] = item.get('packs_needed') or 1
+            item['total_litre'] = quantity_litre
+        item['surplus_litre'] = round(item['total_litre'] - quantity_litre, 3)
+
+    calculations = price_line(
+        item,
+        unit_price=item.get('price_per_litre') or item.get('unit_price') or 0,
+        quantity=quantity_litre
+    )
+    item.update({
+        'subtotal': calculations['subtotal'],
+        'discount_amount': calculations['discount_amount'],
+        'discounted_subtotal': calculations['discounted_subtotal'],
+        'gst_amount': calculations['gst_amount'],
+        'total': calculations['final_total'],
+        'total_price': calculations['final_total'],
+        'calculations': {**(item.get('calculations') or {}), **calculations}
+    })
+    item['quantity'] = item['packs_needed']
+    return item
+
+
+def _mpack_reprice_inputs(product):
+    """Polipack rate check for an MPack line: (unit_price, rate_per_sqm, sqm_per_sheet), or None if it is current."""
+    underpacking_type = (product.get('underpacking_type') or '').strip().lower()
+    adhesive = polipack_adhesive_flag(product.get('format_label'), product.get('name'))
+    thickness_micron = parse_thickness_micron(product.get('thickness'))
+
+    rate_per_sqm, sqm_per_sheet = get_mpack_rate_table().lookup(
+        underpacking_type, adhesive, thickness_micron,
+        product.get('standard_width_mm'), product.get('standard_length_mm')
+    )
+
+    if not sqm_per_sheet:
+        # Not a stocked size: use the area the line was added with
+        sqm_per_sheet = _cart_number(product.get('standard_area_sqm') or product.get('custom_area_sqm'))
+
+    if not sqm_per_sheet:
+        w = _cart_number(product.get('display_width_mm') or product.get('standard_width_mm') or product.get('custom_width_mm'))
+        l = _cart_number(product.get('display_length_mm') or product.get('standard_length_mm') or product.get('custom_length_mm'))
+        if w and l:
+            sqm_per_sheet = (w * l) / 1_000_000
+
+    calculations = product.get('calculations') if isinstance(product.get('calculations'), dict) else {}
+    stored_rate = calculations.get('rate_per_sqm')
+    stored_unit_price = calculations.get('unit_price', product.get('unit_price', 0))
+    try:
+        stored_unit_price = float(stored_unit_price) if stored_unit_price is not None else 0.0
+    except (TypeError, ValueError):
+        stored_unit_price = 0.0
+
+    should_recalc = False
+    if stored_unit_price <= 0 or not sqm_per_sheet or thickness_micron <= 0:
+        should_recalc = True
+    if underpacking_type == 'polipack':
+        try:
+            stored_rate_val = float(stored_rate) if stored_rate is not None else 0.0
+        except (TypeError, ValueError):
+            stored_rate_val = 0.0
+        if rate_per_sqm and (not stored_rate_val or abs(stored_rate_val - rate_per_sqm) > 0.01):
+            should_recalc = True
+
+    if not should_recalc:
+        return None
+    return rate_per_sqm * sqm_per_sheet, rate_per_sqm, sqm_per_sheet
+
+
+def _stored_line_inputs(product):
+    """(quantity, discount_percent, gst_percent) as the re-pricing fallbacks read them."""
+    try:
+        quantity = int(product.get('quantity', 1) or 1)
+    except (TypeError, ValueError):
+        quantity = 1
+    try:
+        discount_percent = float(product.get('discount_percent', 0) or 0)
+    except (TypeError, ValueError):
+        discount_percent = 0.0
+    try:
+        gst_percent = float(product.get('gst_percent', 18) or 18)
+    except (TypeError, ValueError):
+        gst_percent = 18.0
+    return quantity, discount_percent, gst_percent
+
+
+def _line_total_current(product):
+    """True when a line's ``calculations`` carry a final_total that matches its total_price."""
+    calculations = product.get('calculations')
+    if not isinstance(calculations, dict) or 'final_total' not in calculations:
+        return False
+    final_total = _cart_number(calculations['final_total'])
+    return abs(_cart_number(product.get('total_price', final_total)) - final_total) < 0.005
+
+
+def reprice_cart_lines(products):
+    """Bring cart lines' stored pricing up to CART_PRICING_VERSION in place.
+
+    Re-derives MPack polipack rates, re-prices chemical lines in litres and
+    rebuilds ``calculations`` that are missing or stale; the other lines that need new figures
+    are priced together in one pricing_engine pass.
+    Returns one flag per line, True when any of its pricing fields was rewritten.
+    """
+    before = [(p.get('unit_price'), p.get('total_price'), p.get('calculations')) for p in products]
+    jobs = []  # (product, extra calculations, mpack rate fields or None)
+    unit_prices, quantities, discounts, gst_rates = [], [], [], []
+
+    def queue(product, unit_price, extra=None, mpack=None):
+        quantity, discount_percent, gst_percent = _stored_line_inputs(product)
+        jobs.append((product, extra or {}, mpack))
+        unit_prices.append(unit_price)
+        quantities.append(quantity)
+        discounts.append(discount_percent)
+        gst_rates.append(gst_percent)
+
+    for product in products:
+        if product.get('type') == 'mpack':
+            try:
+                mpack = _mpack_reprice_inputs(product)
+            except Exception as _mpack_recalc_error:
+                app.logger.warning(f"MPack recalc skipped due to error: {_mpack_recalc_error}")
+                mpack = None
+            if mpack is not None:
+                unit_price, rate_per_sqm, sqm_per_sheet = mpack
+                queue(product, unit_price, {
+                    'rate_per_sqm': round(rate_per_sqm, 2),
+                    'sqm_per_sheet': round(sqm_per_sheet, 3)
+                }, mpack)
+                continue
+
+        if product.get('type') in ('chemical', 'maintenance'):
+            apply_litre_quantity(product, product.get('quantity_litre') or product.get('quantity'))
+            continue
+
+        if _line_total_current(product):
+            continue
+        # If calculations are missing or disagree with total_price, recalculate them
+        if product.get('type') == 'rule':
+            recalc_rule_pricing(product)
+        elif product.get('type') == 'blanket':
+            base_price = float(product.get('base_price', 0))
+            bar_price = float(product.get('bar_price', 0))
+            product['unit_price'] = round(base_price + bar_price, 2)
+            queue(product, base_price + bar_price, {
+                'base_price': round(base_price, 2),
+                'bar_price': round(bar_price, 2)
+            })
+        else:
+            queue(product, float(product.get('unit_price', 0)))
+
+    if jobs:
+        priced = price_lines([job[0] for job in jobs], unit_prices, quantities, discounts, gst_rates)
+        for index, (product, extra, mpack) in enumerate(jobs):
+            calculations = dict(extra, **priced.calculations(index))
+            if product.get('type') == 'mpack':
+                calculations['price_after_discount'] = calculations['discounted_subtotal']
+            set_line_pricing(product, calculations)
+            if mpack is not None:
+                sqm_per_sheet = mpack[2]
+                product['standard_area_sqm'] = round(sqm_per_sheet, 6) if sqm_per_sheet else product.get('standard_area_sqm')
+                product['discount_amount'] = calculations['discount_amount']
+                product['discounted_subtotal'] = calculations['discounted_subtotal']
+                product['gst_amount'] = calculations['gst_amount']
+                product['total'] = product['total_price']
+
+    for product in products:
+        product['fingerprint'] = cart_item_fingerprint(product)
+        product['pricing_version'] = CART_PRICING_VERSION
+    return [
+        previous != (product.get('unit_price'), product.get('total_price'), product.get('calculations'))
+        for previous, product in zip(before, products)
+    ]
+
+
+CART_PRICING_MIGRATION_ID = 'cart_pricing_version'
+CART_PRICING_MIGRATION_BATCH = 200
+
+
+def migrate_cart_pricing(db=None, batch_size=CART_PRICING_MIGRATION_BATCH):
+    """Re-price and stamp every stored cart line older than CART_PRICING_VERSION.
+
+    Carts without a totals sub-document get one computed from their lines.
+
+    A cart is only rewritten if its products are unchanged since they were
+    read, so carts edited meanwhile are picked up by the next run (or the read
+    path).  Returns the number of carts updated.
+    """
+    db = mongo_db if db is None else db
+    if db is None:
+        return 0
+
+    marker = db.counters.find_one({'_id': CART_PRICING_MIGRATION_ID}, {'version': 1}) or {}
+    if marker.get('version', 0) >= CART_PRICING_VERSION:
+        return 0
+
+    carts = db.get_collection('carts')
+    stale = {'$or': [
+        {'products': {'$elemMatch': {'pricing_version': {'$ne': CART_PRICING_VERSION}}}},
+        {'totals': {'$exists': False}}
+    ]}
+    updated = 0
+    ops = []
+
+    def flush_ops():
+        nonlocal updated
+        if ops:
+            result = carts.bulk_write(ops, ordered=False)
+            updated += result.modified_count
+            ops.clear()
+
+    for doc in carts.find(stale, {'products': 1}).batch_size(batch_size):
+        products = doc.get('products')
+        if not isinstance(products, list):
+            continue
+        repriced = [dict(product) if isinstance(product, dict) else product for product in products]
+        _reprice_for_write([
+            product for product in repriced
+            if isinstance(product, dict) and product.get('pricing_version') != CART_PRICING_VERSION
+        ])
+        ops.append(UpdateOne(
+            {'_id': doc['_id'], 'products': products},
+            {'$set': {'products': repriced, 'totals': compute_cart_totals(repriced)}, '$inc': {'version': 1}}
+        ))
+        if len(ops) >= batch_size:
+            flush_ops()
+    flush_ops()
+
+    remaining = carts.count_documents(stale)
+    if remaining:
+        app.logger.warning(f"Cart pricing migration left {remaining} cart(s) below version {CART_PRICING_VERSION}")
+    else:
+        db.counters.update_one(
+            {'_id': CART_PRICING_MIGRATION_ID},
+            {'$max': {'version': CART_PRICING_VERSION}},
+            upsert=True
+        )
+    app.logger.info(f"Cart pricing migration updated {updated} cart(s)")
+    return updated
+
+
+def start_cart_pricing_migration():
+    """Run migrate_cart_pricing() once in a daemon thread (disable with CART_PRICING_MIGRATION=false)."""
+    if os.environ.get('CART_PRICING_MIGRATION', 'true').lower() != 'true':
+        return
+
+    def run():
+        try:
+            migrate_cart_pricing()
+        except Exception as e:
+            app.logger.error(f"Cart pricing migration failed: {str(e)}")
+
+    threading.Thread(target=run, name='cart-pricing-migration', daemon=True).start()
+
+
+# Carts untouched for this many days are deleted by a TTL index on updated_at
+# (0 leaves any existing TTL index alone and adds none).
+CART_TTL_DAYS = int(os.getenv('CART_TTL_DAYS', '90') or 0)
+CART_TTL_INDEX = 'cart_ttl'
+CART_USER_INDEX = 'cart_user_id_unique'
+
+# Top-level line fields that only repeat ``calculations``, and calculations
+# entries that only repeat top-level fields.  compact_cart_line() drops them
+# when the two copies agree.
+CART_LINE_REDUNDANT_FIELDS = ('subtotal', 'discount_amount', 'discounted_subtotal', 'gst_amount')
+CART_CALCULATION_REDUNDANT_FIELDS = (
+    'machine', 'thickness', 'size', 'standard_size_label', 'custom_size_label',
+    'display_size_label', 'cut_to_custom_size'
+)
+
+
+def ensure_cart_indexes(db):
+    """Create the unique user_id index and the updated_at TTL index on carts.
+
+    The unique index fails while duplicate carts exist; compact_carts()
+    removes them and calls this again.
+    """
+    carts = db.get_collection('carts')
+    try:
+        carts.create_index('user_id', name=CART_USER_INDEX, unique=True)
+    except OperationFailure as e:
+        app.logger.warning(f"Unique cart index not created ({e}); run migrations/compact_carts.py")
+    if CART_TTL_DAYS <= 0:
+        return
+    ttl_seconds = CART_TTL_DAYS * 86400
+    try:
+        carts.create_index('updated_at', name=CART_TTL_INDEX, expireAfterSeconds=ttl_seconds)
+    except OperationFailure:
+        # Index exists with another expiry: change it in place
+        try:
+            db.command('collMod', 'carts', index={'name': CART_TTL_INDEX, 'expireAfterSeconds': ttl_seconds})
+        except Exception as e:
+            app.logger.warning(f"Cart TTL index not updated: {e}")
+
+
+def compact_cart_line(product):
+    """Drop fields that duplicate each other between a line and its calculations; True if changed."""
+    calculations = product.get('calculations')
+    if not isinstance(calculations, dict):
+        return False
+    changed = False
+    for field in CART_LINE_REDUNDANT_FIELDS:
+        if field in product and field in calculations and \
+                abs(_cart_number(product[field]) - _cart_number(calculations[field])) < 0.005:
+            del product[field]
+            changed = True
+    for field in CART_CALCULATION_REDUNDANT_FIELDS:
+        if field in calculations and calculations[field] == product.get(field):
+            del calculations[field]
+            changed = True
+    return changed
+
+
+def compact_carts(db=None, batch_size=CART_PRICING_MIGRATION_BATCH):
+    """Shrink the carts collection so the working set stays small.
+
+    Removes duplicate carts per user (keeping the oldest, which is the one
+    ``find_one`` has been returning), strips redundant line fields, stamps
+    ``updated_at`` on carts that lack it so the TTL index can expire them,
+    and finally (re)creates the cart indexes.  Returns a dict of counts.
+    """
+    db = mongo_db if db is None else db
+    if db is None:
+        return {}
+    carts = db.get_collection('carts')
+    stats = {'duplicates_removed': 0, 'carts_compacted': 0}
+
+    duplicates = carts.aggregate([
+        {'$group': {'_id': '$user_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+    deletes = [DeleteOne({'_id': doc_id}) for group in duplicates for doc_id in sorted(group['ids'])[1:]]
+    for start in range(0, len(deletes), batch_size):
+        stats['duplicates_removed'] += carts.bulk_write(deletes[start:start + batch_size], ordered=False).deleted_count
+
+    ops = []
+
+    def flush_ops():
+        if ops:
+            stats['carts_compacted'] += carts.bulk_write(ops, ordered=False).modified_count
+            ops.clear()
+
+    for doc in carts.find({}, {'products': 1, 'updated_at': 1}).batch_size(batch_size):
+        products = doc.get('products')
+        update = {}
+        if isinstance(products, list):
+            compacted = [copy.deepcopy(product) if isinstance(product, dict) else product for product in products]
+            if any([compact_cart_line(product) for product in compacted if isinstance(product, dict)]):
+                update['products'] = compacted
+        if not isinstance(doc.get('updated_at'), datetime):
+            update['updated_at'] = datetime.utcnow()
+        if update:
+            # Only if nobody wrote the cart since it was read.  Compaction
+            # does not change what the cart means, so its version is kept.
+            ops.append(UpdateOne({'_id': doc['_id'], 'products': products}, {'$set': update}))
+        if len(ops) >= batch_size:
+            flush_ops()
+    flush_ops()
+
+    ensure_cart_indexes(db)
+    app.logger.info(f"Cart compaction: {stats}")
+    return stats
+
+
+def repair_cart_totals(db=None, batch_size=CART_PRICING_MIGRATION_BATCH, dry_run=False):
+    """Find carts whose maintained ``totals`` drifted from their lines and rebuild them.
+
+    Each cart is compared with check_cart_totals(); drifted totals are logged
+    and, unless ``dry_run``, replaced by compute_cart_totals() if the cart is
+    unchanged since it was read.  Returns a dict of counts.
+    """
+    db = mongo_db if db is None else db
+    if db is None:
+        return {}
+    carts = db.get_collection('carts')
+    stats = {'carts_checked': 0, 'carts_drifted': 0, 'carts_repaired': 0}
+    ops = []
+
+    def flush_ops():
+        if ops:
+            stats['carts_repaired'] += carts.bulk_write(ops, ordered=False).modified_count
+            ops.clear()
+
+    for doc in carts.find({}, {'user_id': 1, 'products': 1, 'totals': 1}).batch_size(batch_size):
+        stats['carts_checked'] += 1
+        products = doc.get('products')
+        if not isinstance(products, list):
+            continue
+        mismatches = check_cart_totals(doc)
+        if not mismatches:
+            continue
+        stats['carts_drifted'] += 1
+        app.logger.warning(f"Cart totals drifted for user {doc.get('user_id')}: {mismatches}")
+        if not dry_run:
+            ops.append(UpdateOne(
+                {'_id': doc['_id'], 'products': products},
+                {'$set': {'totals': compute_cart_totals(products)}}
+            ))
+        if len(ops) >= batch_size:
+            flush_ops()
+    flush_ops()
+
+    app.logger.info(f"Cart totals check: {stats}")
+    return stats
+
+
+def _reprice_for_write(products):
+    """reprice_cart_lines() for write paths: bad lines are stored as-is and retried on read."""
+    try:
+        return any(reprice_cart_lines(products))
+    except Exception as e:
+        app.logger.warning(f"Cart line re-pricing skipped on write: {e}")
+        return False
+
+
+
+class CartSnapshot:
+    """The current user's cart, loaded at most once per request.
+
+    get_user_cart() re-prices every line on load, so routes that read, mutate
+    and then count the cart share this snapshot instead of hitting the store
+    again.  Mutations mark it dirty; flush() persists it once.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.dirty = False
+        self._cart = None
+        self._fingerprints = None
+
+    @property
+    def cart(self):
+        if self._cart is None:
+            self._cart = _load_user_cart()
+        return self._cart
+
+    @property
+    def products(self):
+        products = self.cart.setdefault('products', [])
+        if not isinstance(products, list):
+            products = self.cart['products'] = []
+        return products
+
+    def replace(self, products):
+        self.cart['products'] = list(products)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self.dirty = True
+        self._fingerprints = None
+
+    def reload(self):
+        """Drop the loaded cart so the next access reads the store again."""
+        self._cart = None
+        self._fingerprints = None
+        self.dirty = False
+
+    def find_duplicate(self, product):
+        """Index of the first line with ``product``'s fingerprint, or None.
+
+        The fingerprint -> index map is built once per loaded cart from the
+        fingerprints stamped on each line, so every check after that is a
+        dict lookup.
+        """
+        if self._fingerprints is None:
+            self._fingerprints = {}
+            for index, line in enumerate(self.products):
+                if isinstance(line, dict):
+                    self._fingerprints.setdefault(line.get('fingerprint') or cart_item_fingerprint(line), index)
+        return self._fingerprints.get(product.get('fingerprint') or cart_item_fingerprint(product))
+
+    @property
+    def version(self):
+        """Store version the loaded cart was read at (None if unknown)."""
+        return self.cart.get('version')
+
+    def count(self):
+        return len(self.products)
+
+    def totals(self):
+        """The cart's totals sub-document; recomputed only after in-memory edits."""
+        totals = self.cart.get('totals')
+        if self.dirty or not isinstance(totals, dict):
+            totals = self.cart['totals'] = compute_cart_totals(self.products)
+        return round_cart_totals(totals)
+
+    def total(self):
+        return self.totals()['grand_total']
+
+    def summary(self):
+        """Return ``(item_count, cart_total)``, from memory if the cart is already loaded."""
+        store = self._item_store()
+        if self._cart is None and store is not None:
+            try:
+                return store.get_summary(self.user_id)
+            except Exception as e:
+                app.logger.error(f"Error reading cart summary: {str(e)}")
+        return self.count(), self.total()
+
+    def flush(self):
+        if self.dirty:
+            save_user_cart(self.cart)
+        return True
+
+    def _item_store(self):
+        return get_cart_store() if self.user_id else None
+
+    def _adopt(self, doc):
+        """Replace the in-memory products with the document a store write returned."""
+        if doc is None:
+            return False
+        products = doc.get('products')
+        products = products if isinstance(products, list) else []
+        totals = doc.get('totals')
+        self._cart = {
+            'products': products,
+            'totals': totals if isinstance(totals, dict) else compute_cart_totals(products),
+            'version': doc.get('version')
+        }
+        self._fingerprints = None
+        self.dirty = False
+        return True
+
+    def add_item(self, product):
+        _reprice_for_write([product])
+        compact_cart_line(product)
+        store = self._item_store()
+        if store is None:
+            self.products.append(product)
+            self.mark_dirty()
+            return self.flush()
+        return self._adopt(store.add_item(self.user_id, product))
+
+    def remove_item(self, item_id):
+        """Remove the line whose ``id`` is ``item_id``; False if it is not in the cart."""
+        store = self._item_store()
+        if store is None:
+            products = self.products
+            remaining = [p for p in products if p.get('id') != item_id]
+            if len(remaining) == len(products):
+                return False
+            self.replace(remaining)
+            return self.flush()
+        return self._adopt(store.remove_item(self.user_id, item_id))
+
+    def update_item(self, item, fields=None, item_id=None, expected_version=None):
+        """Persist ``fields`` (default: all of ``item``) for a line already edited in place.
+
+        ``item_id`` is the line's stored id when the edit replaced ``item['id']``.
+        With ``expected_version`` the write raises CartConflictError if the
+        cart changed since that version was read.
+        """
+        store = self._item_store()
+        item_id = item.get('id') if item_id is None else item_id
+        if store is None or item_id in (None, ''):
+            self.mark_dirty()
+            return self.flush()
+        if _reprice_for_write([item]):
+            fields = None
+        elif fields is not None:
+            fields = list(fields) + ['pricing_version', 'fingerprint']
+        changes = {key: item[key] for key in (fields or item.keys()) if key in item}
+        return self._adopt(store.update_item(self.user_id, item_id, changes, expected_version=expected_version))
+
+    def modify_item(self, item_id, mutate, fields=None):
+        """Apply ``mutate(line)`` to the line ``item_id`` and save it as a compare-and-swap.
+
+        When another request wrote the cart first, the cart is re-read and
+        ``mutate`` re-applied, up to CART_WRITE_RETRIES times; the last
+        CartConflictError is raised.  Returns the updated line, or None if it
+        is not in the cart.
+        """
+        for attempt in range(CART_WRITE_RETRIES):
+            index = find_cart_line(self.products, item_id)
+            if index is None:
+                return None
+            item = self.products[index]
+            mutate(item)
+            try:
+                if not self.update_item(item, fields, expected_version=self.version):
+                    return None
+                return item
+            except CartConflictError:
+                self.reload()
+                if attempt == CART_WRITE_RETRIES - 1:
+                    raise
+        return None
+
+    def apply_edits(self, edits):
+        """Apply ``(item_id, mutate)`` edits in order and save the cart in one write.
+
+        ``mutate(line)`` edits a line in place and its return value is
+        collected; ``mutate`` None removes the line.  The save is a single
+        compare-and-swap of the whole cart, retried on conflict like
+        modify_item().  Raises LookupError with the item id if a line is
+        missing, in which case nothing is written.
+        """
+        for attempt in range(CART_WRITE_RETRIES):
+            products = copy.deepcopy(self.products)
+            results = []
+            for item_id, mutate in edits:
+                index = find_cart_line(products, item_id)
+                if index is None:
+                    raise LookupError(item_id)
+                if mutate is None:
+                    products.pop(index)
+                    results.append(None)
+                else:
+                    results.append(mutate(products[index]))
+            try:
+                self._save_products(products)
+                return results
+            except CartConflictError:
+                self.reload()
+                if attempt == CART_WRITE_RETRIES - 1:
+                    raise
+        return None
+
+    def _save_products(self, products):
+        _reprice_for_write([product for product in products if isinstance(product, dict)])
+        version = self.version
+        get_cart_store().save_cart(self.user_id, products, expected_version=version)
+        self._cart = {
+            'products': products,
+            'totals': compute_cart_totals(products),
+            'version': version + 1 if version is not None else None
+        }
+        self._fingerprints = None
+        self.dirty = False
+
+
+def find_cart_line(products, item_id):
+    """Index of the line whose ``id`` (or legacy ``_id``) is ``item_id``, else None."""
+    item_id = str(item_id)
+    for index, product in enumerate(products):
+        if isinstance(product, dict) and item_id in (str(product.get('id')), str(product.get('_id'))):
+            return index
+    return None
+
+
+def get_cart_snapshot():
+    """Return the request's CartSnapshot for current_user, creating it on first use."""
+    user_id = getattr(current_user, 'id', None)
+    if not has_request_context():
+        return CartSnapshot(user_id)
+    snapshot = g.get('cart_snapshot')
+    if snapshot is None or snapshot.user_id != user_id:
+        snapshot = g.cart_snapshot = CartSnapshot(user_id)
+    return snapshot
+
+
+@app.after_request
+def _flush_cart_snapshot(response):
+    snapshot = g.get('cart_snapshot')
+    if snapshot is not None and snapshot.dirty:
+        try:
+            snapshot.flush()
+        except CartConflictError:
+            app.logger.warning(f"Dropped stale cart write for user {snapshot.user_id}: cart changed by another request")
+    return response
+
+
 def get_user_cart():
-    """Return a dict with a products list for the current user using MongoDB."""
+    """Return the current user's cart dict, loaded once per request."""
+    return get_cart_snapshot().cart
+
+
+def _load_user_cart():
+    """Return a dict with a products list for the current user from the cart store."""
     try:
         app.logger.info(f"[DEBUG] get_user_cart() called for user: {getattr(current_user, 'id', 'no-user')}")
         
@@ -3438,227 +5108,47 @@ def get_user_cart():
             
         store = get_cart_store()
 
-        if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None and isinstance(store, MongoCartStore):
+        if isinstance(store, MongoCartStore):
             app.logger.info("[DEBUG] Using MongoDB for cart storage")
             app.logger.info(f"[DEBUG] MongoDB status - MONGO_AVAILABLE: {MONGO_AVAILABLE}, USE_MONGO: {USE_MONGO}, mongo_db: {'available' if mongo_db is not None else 'None'}")
-            
-            try:
-                products = store.get_cart(current_user.id)
-                app.logger.info(f"[DEBUG] Retrieved {len(products) if products else 0} products from MongoDB")
-                if products:
-                    app.logger.debug(f"[DEBUG] Sample product from MongoDB: {str(products[0])[:200]}...")
-            except Exception as e:
-                app.logger.error(f"[DEBUG] Error fetching cart from MongoDB: {str(e)}")
-                products = []
-            # Ensure products is a list; fallback if malformed
-            if not isinstance(products, list):
-                app.logger.warning("[DEBUG] Expected list from cart, got %s. Resetting to empty list.", type(products).__name__)
-                products = []
-
-            # Ensure all items in products are dicts with calculations
-            sanitized_products = []
-            for product in products:
-                if not isinstance(product, dict):
-                    app.logger.warning("[DEBUG] Skipping malformed product entry: %s", str(product)[:100])
-                    continue
-                sanitized_products.append(product)
-
-                if product.get('type') == 'mpack':
-                    try:
-                        underpacking_type = (product.get('underpacking_type') or '').strip().lower()
-                        format_label = (product.get('format_label') or '').strip().lower()
-                        name_lower = (product.get('name') or '').strip().lower()
-
-                        base_rate_per_100 = 75.0
-                        if underpacking_type == 'polipack':
-                            if 'self' in format_label or 'adhesive' in format_label or 'self' in name_lower:
-                                base_rate_per_100 = 925.0
-                            elif 'non' in format_label or 'wa' in format_label or 'non' in name_lower:
-                                base_rate_per_100 = 425.0
-
-                        thickness_raw = product.get('thickness') or ''
-                        thickness_digits = ''.join(ch for ch in str(thickness_raw) if ch.isdigit() or ch == '.')
-                        try:
-                            thickness_micron = float(thickness_digits) if thickness_digits else 0.0
-                        except ValueError:
-                            thickness_micron = 0.0
-
-                        sqm_per_sheet = product.get('standard_area_sqm') or product.get('custom_area_sqm')
-                        try:
-                            sqm_per_sheet = float(sqm_per_sheet) if sqm_per_sheet is not None else 0.0
-                        except (TypeError, ValueError):
-                            sqm_per_sheet = 0.0
-
-                        if not sqm_per_sheet:
-                            w = product.get('display_width_mm') or product.get('standard_width_mm') or product.get('custom_width_mm')
-                            l = product.get('display_length_mm') or product.get('standard_length_mm') or product.get('custom_length_mm')
-                            try:
-                                w = float(w) if w is not None else 0.0
-                            except (TypeError, ValueError):
-                                w = 0.0
-                            try:
-                                l = float(l) if l is not None else 0.0
-                            except (TypeError, ValueError):
-                                l = 0.0
-                            if w and l:
-                                sqm_per_sheet = (w * l) / 1_000_000
-
-                        calculations = product.get('calculations') if isinstance(product.get('calculations'), dict) else {}
-                        stored_rate = calculations.get('rate_per_sqm')
-                        stored_unit_price = calculations.get('unit_price', product.get('unit_price', 0))
-                        try:
-                            stored_unit_price = float(stored_unit_price) if stored_unit_price is not None else 0.0
-                        except (TypeError, ValueError):
-                            stored_unit_price = 0.0
-
-                        should_recalc = False
-                        if stored_unit_price <= 0 or not sqm_per_sheet or thickness_micron <= 0:
-                            should_recalc = True
-                        if underpacking_type == 'polipack':
-                            try:
-                                stored_rate_val = float(stored_rate) if stored_rate is not None else 0.0
-                            except (TypeError, ValueError):
-                                stored_rate_val = 0.0
-                            desired_rate = base_rate_per_100 * (thickness_micron / 100.0) if thickness_micron else 0.0
-                            if desired_rate and (not stored_rate_val or abs(stored_rate_val - desired_rate) > 0.01):
-                                should_recalc = True
-
-                        if should_recalc:
-                            rate_per_sqm = base_rate_per_100 * (thickness_micron / 100.0) if thickness_micron else 0.0
-                            unit_price = rate_per_sqm * sqm_per_sheet
-                            try:
-                                quantity = int(product.get('quantity', 1) or 1)
-                            except (TypeError, ValueError):
-                                quantity = 1
-                            try:
-                                discount_percent = float(product.get('discount_percent', 0) or 0)
-                            except (TypeError, ValueError):
-                                discount_percent = 0.0
-                            try:
-                                gst_percent = float(product.get('gst_percent', 18) or 18)
-                            except (TypeError, ValueError):
-                                gst_percent = 18.0
-
-                            subtotal = unit_price * quantity
-                            discount_amount = subtotal * (discount_percent / 100.0)
-                            discounted_subtotal = subtotal - discount_amount
-                            gst_amount = discounted_subtotal * (gst_percent / 100.0)
-                            final_total = discounted_subtotal + gst_amount
-
-                            product['unit_price'] = round(unit_price, 2)
-                            product['standard_area_sqm'] = round(sqm_per_sheet, 6) if sqm_per_sheet else product.get('standard_area_sqm')
-                            product['discount_amount'] = round(discount_amount, 2)
-                            product['discounted_subtotal'] = round(discounted_subtotal, 2)
-                            product['gst_amount'] = round(gst_amount, 2)
-                            product['total_price'] = round(final_total, 2)
-                            product['total'] = product['total_price']
-
-                            product['calculations'] = {
-                                'rate_per_sqm': round(rate_per_sqm, 2),
-                                'sqm_per_sheet': round(sqm_per_sheet, 3),
-                                'unit_price': round(unit_price, 2),
-                                'quantity': quantity,
-                                'subtotal': round(subtotal, 2),
-                                'discount_percent': discount_percent,
-                                'discount_amount': round(discount_amount, 2),
-                                'discounted_subtotal': round(discounted_subtotal, 2),
-                                'gst_percent': gst_percent,
-                                'gst_amount': round(gst_amount, 2),
-                                'final_total': round(final_total, 2)
-                            }
-                    except Exception as _mpack_recalc_error:
-                        app.logger.warning(f"MPack recalc skipped due to error: {_mpack_recalc_error}")
-
-                if 'calculations' not in product or not isinstance(product.get('calculations'), dict):
-                    # If calculations are missing or invalid, recalculate them
-                    if product.get('type') == 'blanket':
-                        base_price = float(product.get('base_price', 0))
-                        bar_price = float(product.get('bar_price', 0))
-                        quantity = int(product.get('quantity', 1))
-                        discount_percent = float(product.get('discount_percent', 0))
-                        gst_percent = float(product.get('gst_percent', 18))
-                        
-                        price_per_unit = base_price + bar_price
-                        subtotal = price_per_unit * quantity
-                        discount_amount = subtotal * (discount_percent / 100)
-                        discounted_subtotal = subtotal - discount_amount
-                        gst_amount = (discounted_subtotal * gst_percent) / 100
-                        final_total = discounted_subtotal + gst_amount
-                        
-                        product['unit_price'] = round(price_per_unit, 2)
-                        product['calculations'] = {
-                            'base_price': round(base_price, 2),
-                            'bar_price': round(bar_price, 2),
-                            'unit_price': round(price_per_unit, 2),
-                            'quantity': quantity,
-                            'subtotal': round(subtotal, 2),
-                            'discount_percent': discount_percent,
-                            'discount_amount': round(discount_amount, 2),
-                            'discounted_subtotal': round(discounted_subtotal, 2),
-                            'gst_percent': gst_percent,
-                            'gst_amount': round(gst_amount, 2),
-                            'final_total': round(final_total, 2)
-                        }
-                    elif product.get('type') == 'mpack':
-                        price = float(product.get('unit_price', 0))
-                        quantity = int(product.get('quantity', 1))
-                        discount_percent = float(product.get('discount_percent', 0))
-                        gst_percent = float(product.get('gst_percent', 18))
-                        
-                        subtotal = price * quantity
-                        discount_amount = (subtotal * discount_percent / 100) if discount_percent else 0
-                        price_after_discount = subtotal - discount_amount
-                        gst_amount = (price_after_discount * gst_percent / 100) if gst_percent else 0
-                        final_total = price_after_discount + gst_amount
-                        
-                        product['calculations'] = {
-                            'unit_price': round(price, 2),
-                            'quantity': quantity,
-                            'subtotal': round(subtotal, 2),
-                            'discount_percent': discount_percent,
-                            'discount_amount': round(discount_amount, 2),
-                            'price_after_discount': round(price_after_discount, 2),
-                            'gst_percent': gst_percent,
-                            'gst_amount': round(gst_amount, 2),
-                            'final_total': round(final_total, 2)
-                        }
-                    elif product.get('type') == 'rule':
-                        recalc_rule_pricing(product)
-                    else:
-                        # Generic fallback for any other item type with missing/zero calculations
-                        unit_price = float(product.get('unit_price', 0))
-                        quantity = int(product.get('quantity', 1))
-                        discount_percent = float(product.get('discount_percent', 0))
-                        gst_percent = float(product.get('gst_percent', 18))
-                        
-                        subtotal = unit_price * quantity
-                        discount_amount = (subtotal * discount_percent / 100) if discount_percent else 0
-                        discounted_subtotal = subtotal - discount_amount
-                        gst_amount = (discounted_subtotal * gst_percent / 100) if gst_percent else 0
-                        final_total = discounted_subtotal + gst_amount
-                        
-                        product['calculations'] = {
-                            'unit_price': round(unit_price, 2),
-                            'quantity': quantity,
-                            'subtotal': round(subtotal, 2),
-                            'discount_percent': discount_percent,
-                            'discount_amount': round(discount_amount, 2),
-                            'discounted_subtotal': round(discounted_subtotal, 2),
-                            'gst_percent': gst_percent,
-                            'gst_amount': round(gst_amount, 2),
-                            'final_total': round(final_total, 2)
-                        }
-            
-            products = sanitized_products
-            return {"products": products}
+        else:
+            app.logger.info("[DEBUG] Using JSON cart store for cart storage")
 
-        # Fallback to JSON cart store when Mongo is unavailable
-        app.logger.warning("[DEBUG] MongoDB is not available for cart storage")
-        app.logger.warning(f"[DEBUG] MONGO_AVAILABLE: {MONGO_AVAILABLE}, USE_MONGO: {USE_MONGO}, mongo_db: {'available' if 'mongo_db' in globals() and mongo_db is not None else 'None'}")
-        products = store.get_cart()
+        try:
+            document = store.get_cart_document(current_user.id)
+            products = document.get('products')
+            totals = document.get('totals')
+            version = document.get('version')
+            app.logger.info(f"[DEBUG] Retrieved {len(products) if products else 0} products from cart store")
+            if products:
+                app.logger.debug(f"[DEBUG] Sample product from cart store: {str(products[0])[:200]}...")
+        except Exception as e:
+            app.logger.error(f"[DEBUG] Error fetching cart: {str(e)}")
+            products = []
+            totals = None
+            version = None
+        # Ensure products is a list; fallback if malformed
         if not isinstance(products, list):
+            app.logger.warning("[DEBUG] Expected list from cart, got %s. Resetting to empty list.", type(products).__name__)
             products = []
-        return {"products": products}
+
+        # Ensure all items in products are dicts with calculations
+        sanitized_products = []
+        for product in products:
+            if not isinstance(product, dict):
+                app.logger.warning("[DEBUG] Skipping malformed product entry: %s", str(product)[:100])
+                totals = None
+                continue
+            sanitized_products.append(product)
+
+        stale = [product for product in sanitized_products if product.get('pricing_version') != CART_PRICING_VERSION]
+        if stale and any(reprice_cart_lines(stale)):
+            totals = None
+
+        products = sanitized_products
+        if not isinstance(totals, dict):
+            totals = compute_cart_totals(products)
+        return {"products": products, "totals": totals, "version": version}
         
     except Exception as e:
         print(f"Error in get_user_cart: {e}")
@@ -3675,18 +5165,7 @@ def get_active_sessions_snapshot():
         if not current_user.is_authenticated:
             return sessions
 
-        cart_data = get_user_cart() or {}
-        products = cart_data.get('products', []) if isinstance(cart_data, dict) else []
-
-        cart_total = 0.0
-        for product in products:
-            calculations = product.get('calculations', {}) if isinstance(product, dict) else {}
-            if 'final_total' in calculations:
-                cart_total += float(calculations.get('final_total', 0) or 0)
-            elif 'total_price' in product:
-                cart_total += float(product.get('total_price', 0) or 0)
-
-        cart_items_count = len(products)
+        cart_items_count, cart_total = get_cart_snapshot().summary()
 
         selected_company = session.get('selected_company') if isinstance(session.get('selected_company'), dict) else {}
         company_name = session.get('company_name') or selected_company.get('name') or 'Not selected'
@@ -3712,7 +5191,7 @@ def get_active_sessions_snapshot():
     return sessions
 
 def save_user_cart(cart_dict):
-    """Persist cart for current user using MongoDB."""
+    """Persist cart for current user (MongoDB, or the per-user JSON store)."""
     try:
         if not hasattr(current_user, 'id'):
             print("Cannot save cart: No user ID available")
@@ -3722,11 +5201,22 @@ def save_user_cart(cart_dict):
             print("Invalid cart format")
             return
             
-        if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
-            cart_store.save_cart(current_user.id, cart_dict['products'])
-        else:
-            print("MongoDB is not available for cart storage")
+        _reprice_for_write([product for product in cart_dict['products'] if isinstance(product, dict)])
+
+        expected_version = cart_dict.get('version')
+        get_cart_store().save_cart(current_user.id, cart_dict['products'], expected_version=expected_version)
+        cart_dict['version'] = expected_version + 1 if expected_version is not None else None
+
+        if has_request_context():
+            snapshot = g.get('cart_snapshot')
+            if snapshot is not None and snapshot.user_id == current_user.id:
+                cart_dict['totals'] = compute_cart_totals(cart_dict['products'])
+                snapshot._cart = cart_dict
+                snapshot._fingerprints = None
+                snapshot.dirty = False
             
+    except CartConflictError:
+        raise
     except Exception as e:
         print(f"Error in save_user_cart: {e}")
         import traceback
@@ -3763,6 +5253,7 @@ def load_user(user_id):
                 created_at=_parse_datetime(doc.get('created_at')),
                 assigned_companies=doc.get('assigned_companies', [])
             )
+            remember_user_assigned_companies(user.id, user.assigned_companies)
             print(f'Successfully loaded user: {user.email} (ID: {user.id})')
             return user
         except Exception as e:
@@ -3813,31 +5304,12 @@ def cart():
         # Ensure products list exists
         cart_data.setdefault("products", [])
 
-        # Calculate cart totals using the actual total field from each product
-        total = 0
+        # Cart totals are maintained on the cart document as lines change
         if cart_data.get('products'):
-            total = sum(
-                float(p.get('calculations', {}).get('final_total', 0))
-                for p in cart_data['products']
-            )
-            
-            # If no calculations exist, fall back to total field
-            if not total:
-                total = sum(
-                    float(p.get('total', 0))
-                    for p in cart_data['products']
-                )
-            
-            # Calculate discount amount if needed
-            discount_amount = sum(
-                float(p.get('calculations', {}).get('discount_amount', 0))
-                for p in cart_data['products']
-            )
-            
-            # Add calculated totals to the cart data
+            totals = get_cart_snapshot().totals()
             cart_data['calculations'] = {
-                'discount_amount': round(discount_amount, 2),
-                'total': round(total, 2)
+                'discount_amount': totals['discount'],
+                'total': totals['grand_total']
             }
         
         # Company details must come from an explicit selection (enforced by company_required)
@@ -3893,12 +5365,13 @@ def clear_cart():
             if USE_MONGO and MONGO_AVAILABLE and mongo_db is not None:
                 mongo_db.carts.update_one(
                     {'user_id': str(current_user.id)},
-                    {'$set': {'products': []}},
+                    {'$set': {'products': [], 'totals': compute_cart_totals([]), 'updated_at': datetime.utcnow()}, '$inc': {'version': 1}},
                     upsert=True
                 )
             else:
-                # Fallback to session for non-MongoDB
-                session['cart'] = {'products': []}
+                get_cart_store().clear_cart(current_user.id)
+            g.pop('cart_snapshot', None)
+            forget_quotation_summary(current_user.id)
         else:
             # For non-logged-in users, clear the session cart
             session['cart'] = {'products': []}
@@ -3952,12 +5425,12 @@ def add_to_cart():
             gst_percent = float(data.get('gst_percent', 18))
             
             # Calculate prices
-            unit_price = base_price + bar_price
-            subtotal = unit_price * quantity
-            discount_amount = subtotal * (discount_percent / 100)
-            discounted_subtotal = subtotal - discount_amount
-            gst_amount = (discounted_subtotal * gst_percent) / 100
-            final_total = discounted_subtotal + gst_amount
+            pricing = price_line(
+                {'type': 'blanket', 'base_price': base_price, 'bar_price': bar_price},
+                quantity=quantity,
+                discount_percent=discount_percent,
+                gst_percent=gst_percent
+            )
             
             # Get dimensions and other details
             length = float(data.get('length', 0))
@@ -3988,20 +5461,21 @@ def add_to_cart():
                 'base_price': base_price,
                 'discount_percent': discount_percent,
                 'gst_percent': gst_percent,
-                'unit_price': round(unit_price, 2),
-                'total_price': round(final_total, 2),
+                'unit_price': pricing['unit_price'],
+                'total_price': pricing['final_total'],
                 'calculations': {
                     'areaSqM': round(area_sq_m, 4),
                     'ratePerSqMt': round(base_price / area_sq_m, 2) if area_sq_m > 0 else 0,
                     'basePrice': round(base_price, 2),
-                    'pricePerUnit': round(unit_price, 2),
-                    'subtotal': round(subtotal, 2),
+                    'pricePerUnit': pricing['unit_price'],
+                    'subtotal': pricing['subtotal'],
                     'discount_percent': discount_percent,
-                    'discount_amount': round(discount_amount, 2),
-                    'discounted_subtotal': round(discounted_subtotal, 2),
+                    'discount_amount': pricing['discount_amount'],
+                    'discounted_subtotal': pricing['discounted_subtotal'],
                     'gst_percent': gst_percent,
-                    'gst_amount': round(gst_amount, 2),
-                    'final_price': round(final_total, 2)
+                    'gst_amount': pricing['gst_amount'],
+                    'final_total': pricing['final_total'],
+                    'final_price': pricing['final_total']
                 },
                 'added_at': datetime.utcnow().isoformat()
             }
@@ -4085,14 +5559,6 @@ def add_to_cart():
                 except (TypeError, ValueError):
                     packs_needed = product.get('quantity')
 
-                subtotal = product['unit_price'] * product.get('quantity', 1)
-                discount_percent = product.get('discount_percent', 0.0)
-                discount_amount = subtotal * (discount_percent / 100)
-                discounted_subtotal = subtotal - discount_amount
-                gst_percent = product.get('gst_percent', 18.0)
-                gst_amount = discounted_subtotal * (gst_percent / 100)
-                final_total = discounted_subtotal + gst_amount
-
                 product.update({
                     'category': data.get('category', ''),
                     'product_id': data.get('product_id'),
@@ -4103,60 +5569,48 @@ def add_to_cart():
                     'packs_needed': packs_needed,
                     'total_litre': total_litre,
                     'surplus_litre': surplus_litre,
-                    'pricing_tier': data.get('pricing_tier', 'standard'),
-                    'subtotal': round(subtotal, 2),
-                    'discount_amount': round(discount_amount, 2),
-                    'discounted_subtotal': round(discounted_subtotal, 2),
-                    'gst_amount': round(gst_amount, 2),
-                    'total': round(final_total, 2),
-                    'total_price': round(final_total, 2)
+                    'price_per_litre': to_float(data.get('price_per_litre')) or product['unit_price'],
+                    'pricing_tier': data.get('pricing_tier', 'standard')
                 })
+                apply_pack_check(product)
 
-                product['calculations'] = {
-                    'unit_price': round(product['unit_price'], 2),
-                    'quantity': product.get('quantity', 1),
-                    'subtotal': round(subtotal, 2),
-                    'discount_percent': discount_percent,
-                    'discount_amount': round(discount_amount, 2),
-                    'discounted_subtotal': round(discounted_subtotal, 2),
-                    'gst_percent': gst_percent,
-                    'gst_amount': round(gst_amount, 2),
-                    'final_total': round(final_total, 2)
-                }
+                # Priced as litres x price per litre; quantity then holds the pack count
+                apply_litre_quantity(product, quantity_litre if quantity_litre is not None else data.get('quantity'))
 
-                # Ensure pack-specific metrics are reflected in quantity fields
-                product['quantity'] = packs_needed
+            if product_type == 'spray_powder':
+                product.update({
+                    'category': data.get('category', ''),
+                    'product_id': data.get('product_id'),
+                    'format_id': data.get('format_id'),
+                    'format_label': data.get('format_label'),
+                    'pack_size_kg': to_float(data.get('pack_size_kg')),
+                    'quantity_kg': to_float(data.get('quantity_kg')),
+                    'packs_needed': data.get('packs_needed'),
+                    'total_kg': to_float(data.get('total_kg')),
+                    'surplus_kg': to_float(data.get('surplus_kg'))
+                })
+                apply_pack_check(product)
 
             # Calculate prices for other product types if needed
             if product_type == 'mpack':
-                unit_price = float(product.get('unit_price', 0) or 0)
-                quantity = int(product.get('quantity', 1) or 1)
-                discount_percent = float(product.get('discount_percent', 0) or 0)
-                gst_percent = float(product.get('gst_percent', 18) or 18)
-
-                subtotal = unit_price * quantity
-                discount_amount = subtotal * (discount_percent / 100)
-                discounted_subtotal = subtotal - discount_amount
-                gst_amount = discounted_subtotal * (gst_percent / 100)
-                final_total = discounted_subtotal + gst_amount
-
-                product['unit_price'] = round(unit_price, 2)
-                product['discount_amount'] = round(discount_amount, 2)
-                product['discounted_subtotal'] = round(discounted_subtotal, 2)
-                product['gst_amount'] = round(gst_amount, 2)
-                product['total_price'] = round(final_total, 2)
+                quantity, discount_percent, gst_percent = _stored_line_inputs(product)
+                calculations = price_line(
+                    product,
+                    unit_price=float(product.get('unit_price', 0) or 0),
+                    quantity=quantity,
+                    discount_percent=discount_percent,
+                    gst_percent=gst_percent
+                )
+
+                product['unit_price'] = calculations['unit_price']
+                product['discount_amount'] = calculations['discount_amount']
+                product['discounted_subtotal'] = calculations['discounted_subtotal']
+                product['gst_amount'] = calculations['gst_amount']
+                product['total_price'] = calculations['final_total']
                 product['total'] = product['total_price']
 
                 product['calculations'] = {
-                    'unit_price': product['unit_price'],
-                    'quantity': quantity,
-                    'subtotal': round(subtotal, 2),
-                    'discount_percent': discount_percent,
-                    'discount_amount': product['discount_amount'],
-                    'discounted_subtotal': product['discounted_subtotal'],
-                    'gst_percent': gst_percent,
-                    'gst_amount': product['gst_amount'],
-                    'final_total': product['total_price'],
+                    **calculations,
                     'machine': product.get('machine', ''),
                     'thickness': product.get('thickness', ''),
                     'size': product.get('size', ''),
@@ -4167,15 +5621,13 @@ def add_to_cart():
                 }
             elif product_type == 'rule':
                 patch_rule_metadata(product, data)
+                apply_rule_catalog_price(product)
                 recalc_rule_pricing(product)
         
         # Get existing cart or create new one
         try:
-            cart = get_user_cart()
-            if not isinstance(cart, dict):
-                cart = {'products': []}
-            if 'products' not in cart:
-                cart['products'] = []
+            snapshot = get_cart_snapshot()
+            cart = {'products': snapshot.products}
             
             # Check if this is an update to an existing item
             item_id = data.get('item_id')
@@ -4185,8 +5637,9 @@ def add_to_cart():
                 for idx, item in enumerate(cart['products']):
                     if str(item.get('_id', '')) == str(item_id) or str(item.get('id', '')) == str(item_id):
                         # Update all fields from the new product data
+                        stored_id = item.get('id')
                         cart['products'][idx].update(product)
-                        item_updated = True
+                        item_updated = snapshot.update_item(cart['products'][idx], product.keys(), item_id=stored_id)
                         break
                 
                 if not item_updated:
@@ -4196,33 +5649,28 @@ def add_to_cart():
                         'message': 'The item you are trying to update was not found in your cart.'
                     }), 404
             else:
-                # Check for duplicate products with same dimensions if force_add is not True
+                # Check for duplicate products with the same fingerprint if force_add is not True
                 if not data.get('force_add'):
-                    duplicate_index = -1
-                    product_type = product.get('type')
-                    
-                    if product_type == 'blanket':
-                        for idx, item in enumerate(cart['products']):
-                            if (item.get('type') == 'blanket' and 
-                                abs(float(item.get('length', 0)) - float(product.get('length', 0))) < 0.01 and 
-                                abs(float(item.get('width', 0)) - float(product.get('width', 0))) < 0.01 and 
-                                item.get('thickness') == product.get('thickness') and
-                                item.get('bar_type') == product.get('bar_type')):
-                                duplicate_index = idx
-                                break
-                    
-                    # Check for duplicate MPacks with same specifications
-                    elif product_type == 'mpack':
-                        for idx, item in enumerate(cart['products']):
-                            if (item.get('type') == 'mpack' and 
-                                item.get('machine') == product.get('machine') and
-                                item.get('thickness') == product.get('thickness') and
-                                item.get('size') == product.get('size') and
-                                item.get('underpacking_type') == product.get('underpacking_type')):
-                                duplicate_index = idx
-                                break
-                    
-                    if duplicate_index >= 0:
+                    product['fingerprint'] = cart_item_fingerprint(product)
+                    duplicate_index = snapshot.find_duplicate(product)
+
+                    merge_default = CART_MERGE_DUPLICATES or product.get('type') in CART_MERGE_TYPES
+                    if duplicate_index is not None and to_bool(data.get('merge_duplicates', merge_default)):
+                        # Merge mode: add the quantity to the existing line instead
+                        duplicate = cart['products'][duplicate_index]
+                        merged = snapshot.modify_item(
+                            duplicate.get('id') or duplicate.get('_id'),
+                            lambda item: merge_cart_line(item, product))
+                        if merged is not None:
+                            return jsonify({
+                                'success': True,
+                                'is_duplicate': False,
+                                'merged': True,
+                                'duplicate_index': duplicate_index,
+                                'message': 'Quantity added to the matching item in your cart',
+                                'cart_count': snapshot.count()
+                            })
+                    elif duplicate_index is not None:
                         # Return info about duplicate product
                         return jsonify({
                             'success': False,
@@ -4232,14 +5680,9 @@ def add_to_cart():
                         })
                 
                 # If no duplicate found and not an update, add the product to cart
-                cart['products'].append(product)
-            
-            # Save updated cart
-            save_user_cart(cart)
+                snapshot.add_item(product)
             
-            # Get updated cart count
-            updated_cart = get_user_cart()
-            cart_count = len(updated_cart.get('products', [])) if updated_cart and isinstance(updated_cart, dict) else 0
+            cart_count = snapshot.count()
             
             return jsonify({
                 'success': True,
@@ -4247,6 +5690,8 @@ def add_to_cart():
                 'message': 'Product added to cart successfully',
                 'cart_count': cart_count
             })
+        except CartConflictError as e:
+            return cart_conflict_response(e)
         except Exception as e:
             app.logger.error(f"Error saving cart: {str(e)}")
             return jsonify({
@@ -4261,16 +5706,170 @@ def add_to_cart():
         }), 500
         return jsonify({'error': str(e), 'trace': traceback.format_exc()}), 500
 
-@app.route('/get_cart')
-@login_required
-def get_cart():
-    """Return the current user's cart as JSON."""
-    try:
-        cart = get_user_cart()
-        return jsonify(cart)
-    except Exception as e:
-        print(f"Error get_cart: {e}")
-        return jsonify({'error': 'Failed to get cart', 'products': []}), 500
+@app.route('/get_cart')
+@login_required
+def get_cart():
+    """Return the current user's cart as JSON."""
+    try:
+        cart = get_user_cart()
+        return jsonify(cart)
+    except Exception as e:
+        print(f"Error get_cart: {e}")
+        return jsonify({'error': 'Failed to get cart', 'products': []}), 500
+
+# -------------------- Cart line edits --------------------
+# Shared by the single-edit routes and /cart/batch.  Each applies an edit to a
+# cart line in place and recalculates its price fields.
+
+CART_EDITABLE_FIELDS = (
+    'quantity', 'length', 'width', 'thickness', 'size', 'machine', 'bar_type',
+    'discount_percent', 'gst_percent', 'unit_price', 'base_price', 'bar_price', 'name', 'type',
+    'unit', 'blanket_name', 'underpacking_type', 'category', 'format_label',
+    'custom_length_mm', 'custom_width_mm', 'custom_area_sqm',
+    'standard_length_mm', 'standard_width_mm', 'standard_area_sqm',
+    'display_length_mm', 'display_width_mm', 'display_size_label',
+    'standard_size_label', 'custom_size_label', 'cut_to_custom_size',
+    'along_mm', 'across_mm'
+)
+
+
+def parse_cart_quantity(data):
+    """Return ``(product_type, quantity)`` from a quantity edit; ValueError if invalid."""
+    product_type = data.get('type', 'mpack')
+    if product_type in ('chemical', 'maintenance'):
+        quantity_value = to_float(data.get('quantity_litre') or data.get('quantity') or 0)
+        quantity = quantity_value if quantity_value is not None else 0
+        if quantity <= 0:
+            raise ValueError('Quantity must be greater than 0 for chemical items')
+        return product_type, quantity
+    try:
+        quantity = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        raise ValueError('Quantity must be a whole number')
+    if quantity < 1:
+        raise ValueError('Quantity must be at least 1')
+    return product_type, quantity
+
+
+def parse_cart_discount(data):
+    """Return the discount percentage from a discount edit; ValueError if out of range."""
+    try:
+        discount_percent = float(data.get('discount_percent', 0))
+    except (TypeError, ValueError):
+        raise ValueError('Discount percentage must be a number')
+    if discount_percent < 0 or discount_percent > 100:
+        raise ValueError('Discount percentage must be between 0 and 100')
+    return discount_percent
+
+
+# Line fields a quantity edit can change
+CART_QUANTITY_FIELDS = (
+    'quantity', 'quantity_litre', 'packs_needed', 'total_litre', 'surplus_litre', 'pack_size_litre',
+    'unit_price', 'subtotal', 'discount_amount', 'discounted_subtotal', 'gst_amount', 'total',
+    'total_price', 'calculations'
+)
+
+
+def apply_cart_quantity(item, quantity, product_type):
+    """Set a line's quantity and recalculate its price fields; returns the line.
+
+    For chemical and maintenance lines ``quantity`` is the requested litres.
+    """
+    if item.get('type') in ('chemical', 'maintenance'):
+        return apply_litre_quantity(item, quantity)
+
+    # Update the quantity
+    item['quantity'] = quantity
+
+    # Recalculate prices if needed (for blankets)
+    if item.get('type') == 'blanket':
+        set_line_pricing(item, price_line(item, quantity=quantity))
+    return item
+
+
+def set_line_pricing(item, pricing):
+    """Store price_line() results on a line; returns the line.
+
+    ``calculations`` takes the whole result, with ``final_price`` kept as a
+    legacy alias of ``final_total``; ``total_price`` and any flat copies of
+    the amounts the line still carries are updated to match.
+    """
+    item['unit_price'] = pricing['unit_price']
+    item['total_price'] = pricing['final_total']
+    for field in CART_LINE_REDUNDANT_FIELDS:
+        if field in item:
+            item[field] = pricing[field]
+    if 'total' in item:
+        item['total'] = pricing['final_total']
+    calculations = item.get('calculations') if isinstance(item.get('calculations'), dict) else {}
+    item['calculations'] = {**calculations, **pricing, 'final_price': pricing['final_total']}
+    return item
+
+
+def apply_cart_discount(item, discount_percent):
+    """Set a line's discount and recalculate; returns the discount actually applied."""
+    # Update the discount percentage
+    item['discount_percent'] = discount_percent
+
+    # Recalculate prices based on product type
+    if item.get('type') == 'blanket':
+        blanket_name = item.get('blanket_name') or item.get('name')
+        if is_restricted_blanket(blanket_name):
+            cap = get_restricted_discount_cap(current_user)
+            if discount_percent > cap:
+                discount_percent = cap
+                item['discount_percent'] = discount_percent
+        set_line_pricing(item, price_line(item, discount_percent=discount_percent))
+    elif item.get('type') in ('chemical', 'maintenance'):
+        apply_litre_quantity(item, item.get('quantity_litre') or item.get('quantity'))
+    else:
+        # For mpacks and other product types
+        set_line_pricing(item, price_line(item, discount_percent=discount_percent))
+    return discount_percent
+
+
+def apply_cart_item_edit(item, data):
+    """Copy editable fields from ``data`` onto a line and recalculate its totals; returns the line."""
+    # Update fields from the form data
+    for key in CART_EDITABLE_FIELDS:
+        if key in data:
+            item[key] = data[key]
+
+    if 'calculations' in data and isinstance(data.get('calculations'), dict):
+        item['calculations'] = data['calculations']
+
+    # Recalculate any calculated fields
+    if 'quantity' in data or 'unit_price' in data or 'discount_percent' in data or 'gst_percent' in data:
+        quantity = item.get('quantity', 1)
+        discount_percent = float(item.get('discount_percent', 0))
+        gst_percent = float(item.get('gst_percent', 18))  # Default to 18% GST if not specified
+
+        # Handle blanket vs other product types differently
+        if item.get('type') == 'blanket':
+            # For blankets: keep base_price and bar_price separate for display
+            base_price = float(item.get('base_price', 0)) or float(item.get('unit_price', 0))
+            bar_price = float(item.get('bar_price', 0))
+            unit_price = base_price + bar_price
+
+            # Update the stored values
+            item['base_price'] = base_price
+            item['bar_price'] = bar_price
+            item['unit_price'] = unit_price
+        else:
+            # For other products (mpack, etc.)
+            if item.get('type') == 'rule':
+                apply_rule_catalog_price(item)
+            unit_price = float(item.get('unit_price', 0))
+
+        set_line_pricing(item, price_line(
+            item,
+            unit_price=unit_price,
+            quantity=quantity,
+            discount_percent=discount_percent,
+            gst_percent=gst_percent
+        ))
+    return item
+
 
 @app.route('/remove_from_cart', methods=['POST'])
 @login_required
@@ -4283,26 +5882,20 @@ def remove_from_cart():
         return jsonify({'error': 'Missing item_id'}), 400
 
     try:
-        cart = get_user_cart()
-        products = cart.get('products', [])
+        snapshot = get_cart_snapshot()
         
-        # Find the item by ID
-        initial_count = len(products)
-        products = [p for p in products if p.get('id') != item_id]
-        
-        if len(products) < initial_count:
+        if snapshot.remove_item(item_id):
             # Item was found and removed
-            save_user_cart({'products': products})
             return jsonify({
                 'success': True,
-                'cart_count': len(products),
+                'cart_count': snapshot.count(),
                 'message': 'Item removed from cart'
             })
             
         return jsonify({
             'success': False,
             'error': 'Item not found in cart',
-            'cart_count': len(products)
+            'cart_count': snapshot.count()
         }), 404
         
     except Exception as e:
@@ -4336,111 +5929,31 @@ def update_cart_item():
         }), 400
     
     # Get the current cart
-    cart = get_user_cart()
-    products = cart.get('products', [])
-    
-    # Find the item to update
-    item_index = next((i for i, item in enumerate(products) 
-                      if str(item.get('id')) == str(item_id) or 
-                         str(item.get('_id')) == str(item_id)), None)
-    
-    if item_index is None:
+    snapshot = get_cart_snapshot()
+
+    # Save the updated line; re-applied to a fresh copy if another request changed the cart
+    try:
+        updated_item = snapshot.modify_item(item_id, lambda item: apply_cart_item_edit(item, data))
+    except CartConflictError as e:
+        return cart_conflict_response(e)
+
+    if updated_item is None:
         return jsonify({
             'success': False,
             'error': 'Item not found in cart',
             'message': 'The item you are trying to update was not found in your cart'
         }), 404
     
-    # Update the item with new data
-    item = products[item_index]
-    
-    # Update fields from the form data
-    for key in ['quantity', 'length', 'width', 'thickness', 'size', 'machine', 'bar_type',
-               'discount_percent', 'gst_percent', 'unit_price', 'base_price', 'bar_price', 'name', 'type',
-               'unit', 'blanket_name', 'underpacking_type', 'category', 'format_label',
-               'custom_length_mm', 'custom_width_mm', 'custom_area_sqm',
-               'standard_length_mm', 'standard_width_mm', 'standard_area_sqm',
-               'display_length_mm', 'display_width_mm', 'display_size_label',
-               'standard_size_label', 'custom_size_label', 'cut_to_custom_size',
-               'along_mm', 'across_mm']:
-        if key in data:
-            item[key] = data[key]
-
-    if 'calculations' in data and isinstance(data.get('calculations'), dict):
-        item['calculations'] = data['calculations']
-    
-    # Recalculate any calculated fields
-    if 'quantity' in data or 'unit_price' in data or 'discount_percent' in data or 'gst_percent' in data:
-        quantity = item.get('quantity', 1)
-        discount_percent = float(item.get('discount_percent', 0))
-        gst_percent = float(item.get('gst_percent', 18))  # Default to 18% GST if not specified
-        
-        # Handle blanket vs other product types differently
-        if item.get('type') == 'blanket':
-            # For blankets: keep base_price and bar_price separate for display
-            base_price = float(item.get('base_price', 0)) or float(item.get('unit_price', 0))
-            bar_price = float(item.get('bar_price', 0))
-            
-            # Calculate unit price (base + bar)
-            unit_price = base_price + bar_price
-            
-            # Calculate subtotal (unit_price * quantity)
-            subtotal = unit_price * quantity
-            
-            # Update the stored values
-            item['base_price'] = base_price
-            item['bar_price'] = bar_price
-            item['unit_price'] = unit_price
-        else:
-            # For other products (mpack, etc.)
-            unit_price = float(item.get('unit_price', 0))
-            subtotal = unit_price * quantity
-        
-        # Calculate discount and final amounts
-        discount_amount = (subtotal * discount_percent) / 100
-        discounted_subtotal = subtotal - discount_amount
-        gst_amount = (discounted_subtotal * gst_percent) / 100
-        final_total = discounted_subtotal + gst_amount
-        
-        # Update calculations
-        item['calculations'] = {
-            'unit_price': unit_price,
-            'quantity': quantity,
-            'subtotal': subtotal,
-            'discount_percent': discount_percent,
-            'discount_amount': discount_amount,
-            'discounted_subtotal': discounted_subtotal,
-            'gst_percent': gst_percent,
-            'gst_amount': gst_amount,
-            'final_total': final_total
-        }
-        
-        # Update the item's total_price field
-        item['total_price'] = final_total
-    
-    # Save the updated cart
-    cart['products'][item_index] = item
-    save_user_cart(cart)
-    
     return jsonify({
         'success': True,
         'message': 'Item updated successfully',
-        'cart': cart
+        'cart': snapshot.cart
     })
 
 @app.route('/update_cart_quantity', methods=['POST'])
 @login_required
 def update_cart_quantity():
     """Update the quantity of a product in the user's cart."""
-    def to_float(value):
-        """Safely convert the provided value to float, returning None on failure."""
-        try:
-            if value is None or value == '':
-                return None
-            return float(value)
-        except (TypeError, ValueError):
-            return None
-            
     if not current_user.is_authenticated:
         return jsonify({
             'success': False,
@@ -4456,117 +5969,40 @@ def update_cart_quantity():
                 'message': 'No data provided'
             }), 400
             
-        product_type = data.get('type', 'mpack')
         item_id = data.get('item_id')
-        if product_type in ('chemical', 'maintenance'):
-            quantity_value = to_float(data.get('quantity_litre') or data.get('quantity') or 0)
-            quantity = quantity_value if quantity_value is not None else 0
-        else:
-            quantity = int(data.get('quantity', 1))
 
         # Validate quantity
-        if product_type in ('chemical', 'maintenance'):
-            if quantity <= 0:
-                return jsonify({
-                    'success': False,
-                    'message': 'Quantity must be greater than 0 for chemical items'
-                }), 400
-        elif quantity < 1:
+        try:
+            product_type, quantity = parse_cart_quantity(data)
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'message': 'Quantity must be at least 1'
+                'message': str(e)
             }), 400
             
         # Get current cart
-        cart = get_user_cart()
-        products = cart.get('products', [])
-        
-        # Find the item by ID
-        item_updated = False
-        updated_item = None
-        
-        for item in products:
-            if str(item.get('id')) == str(item_id):
-                # Update the quantity
-                item['quantity'] = quantity
-                if product_type in ('chemical', 'maintenance'):
-                    item['quantity_litre'] = quantity
-
-                # Recalculate prices if needed (for blankets)
-                if item.get('type') == 'blanket':
-                    # Recalculate blanket prices
-                    base_price = item.get('base_price', 0)
-                    bar_price = item.get('bar_price', 0)
-                    discount_percent = item.get('discount_percent', 0)
-                    gst_percent = item.get('gst_percent', 18)
-                    
-                    # Recalculate all values
-                    price_per_unit = base_price + bar_price
-                    subtotal = price_per_unit * quantity
-                    discount_amount = subtotal * (discount_percent / 100)
-                    discounted_subtotal = subtotal - discount_amount
-                    gst_amount = (discounted_subtotal * gst_percent) / 100
-                    final_total = discounted_subtotal + gst_amount
-                    
-                    # Update all price fields
-                    item.update({
-                        'unit_price': round(price_per_unit, 2),
-                        'total_price': round(final_total, 2),
-                        'calculations': {
-                            **item.get('calculations', {}),
-                            'subtotal': round(subtotal, 2),
-                            'discount_amount': round(discount_amount, 2),
-                            'discounted_subtotal': round(discounted_subtotal, 2),
-                            'gst_amount': round(gst_amount, 2),
-                            'final_price': round(final_total, 2)
-                        }
-                    })
-                
-                if item.get('type') in ('chemical', 'maintenance'):
-                    price_per_litre = item.get('price_per_litre') or item.get('unit_price') or 0
-                    discount_percent = item.get('discount_percent', 0)
-                    gst_percent = item.get('gst_percent', 18)
-
-                    subtotal = price_per_litre * quantity
-                    discount_amount = subtotal * (discount_percent / 100)
-                    discounted_subtotal = subtotal - discount_amount
-                    gst_amount = (discounted_subtotal * gst_percent / 100)
-                    final_total = discounted_subtotal + gst_amount
-
-                    item['total_price'] = round(final_total, 2)
-                    item['calculations'] = {
-                        **item.get('calculations', {}),
-                        'unit_price': round(price_per_litre, 2),
-                        'quantity': quantity,
-                        'subtotal': round(subtotal, 2),
-                        'discount_percent': discount_percent,
-                        'discount_amount': round(discount_amount, 2),
-                        'discounted_subtotal': round(discounted_subtotal, 2),
-                        'gst_percent': gst_percent,
-                        'gst_amount': round(gst_amount, 2),
-                        'final_total': round(final_total, 2)
-                    }
+        snapshot = get_cart_snapshot()
 
-                updated_item = item
-                item_updated = True
-                break
-        
-        if item_updated:
-            # Save the updated cart
-            save_user_cart({'products': products})
-            
+        # Save the updated line; re-applied to a fresh copy if another request changed the cart
+        updated_item = snapshot.modify_item(
+            item_id, lambda item: apply_cart_quantity(item, quantity, product_type),
+            CART_QUANTITY_FIELDS)
+
+        if updated_item is not None:
             return jsonify({
                 'success': True,
                 'message': 'Cart quantity updated',
-                'cart_count': sum(1 for _ in products),
+                'cart_count': snapshot.count(),
                 'updated_item': updated_item
             })
         else:
             return jsonify({
                 'success': False,
                 'message': 'Item not found in cart',
-                'cart_count': len(products)
+                'cart_count': snapshot.count()
             }), 404
+    except CartConflictError as e:
+        return cart_conflict_response(e)
     except Exception as e:
         app.logger.error(f'Error updating cart quantity: {str(e)}')
         return jsonify({
@@ -4589,13 +6025,14 @@ def update_cart_discount():
             }), 400
             
         item_id = data.get('item_id')
-        discount_percent = float(data.get('discount_percent', 0))
-        
+
         # Validate discount percentage
-        if discount_percent < 0 or discount_percent > 100:
+        try:
+            discount_percent = parse_cart_discount(data)
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'message': 'Discount percentage must be between 0 and 100'
+                'message': str(e)
             }), 400
             
         if not item_id:
@@ -4605,96 +6042,34 @@ def update_cart_discount():
             }), 400
         
         # Get current cart
-        cart = get_user_cart()
-        products = cart.get('products', [])
-        
-        # Find the item by ID
-        item_updated = False
-        updated_item = None
-        
-        for item in products:
-            if str(item.get('id')) == str(item_id):
-                # Update the discount percentage
-                item['discount_percent'] = discount_percent
-                
-                # Recalculate prices based on product type
-                if item.get('type') == 'blanket':
-                    blanket_name = item.get('blanket_name') or item.get('name')
-                    if is_restricted_blanket(blanket_name):
-                        cap = get_restricted_discount_cap(current_user)
-                        if discount_percent > cap:
-                            discount_percent = cap
-                    base_price = item.get('base_price', 0)
-                    bar_price = item.get('bar_price', 0)
-                    quantity = item.get('quantity', 1)
-                    gst_percent = item.get('gst_percent', 18)
-                    
-                    price_per_unit = base_price + bar_price
-                    subtotal = price_per_unit * quantity
-                    discount_amount = subtotal * (discount_percent / 100)
-                    discounted_subtotal = subtotal - discount_amount
-                    gst_amount = (discounted_subtotal * gst_percent) / 100
-                    final_total = discounted_subtotal + gst_amount
-                    
-                    # Update all price fields
-                    item.update({
-                        'unit_price': round(price_per_unit, 2),
-                        'total_price': round(final_total, 2),
-                        'calculations': {
-                            **item.get('calculations', {}),
-                            'subtotal': round(subtotal, 2),
-                            'discount_amount': round(discount_amount, 2),
-                            'discounted_subtotal': round(discounted_subtotal, 2),
-                            'gst_amount': round(gst_amount, 2),
-                            'final_price': round(final_total, 2)
-                        }
-                    })
-                else:
-                    # For mpacks and other product types
-                    unit_price = item.get('unit_price', 0)
-                    quantity = item.get('quantity', 1)
-                    gst_percent = item.get('gst_percent', 18)
-                    
-                    subtotal = unit_price * quantity
-                    discount_amount = subtotal * (discount_percent / 100)
-                    discounted_subtotal = subtotal - discount_amount
-                    gst_amount = (discounted_subtotal * gst_percent) / 100
-                    final_total = discounted_subtotal + gst_amount
-                    
-                    # Update all price fields
-                    item.update({
-                        'total_price': round(final_total, 2),
-                        'calculations': {
-                            **item.get('calculations', {}),
-                            'subtotal': round(subtotal, 2),
-                            'discount_amount': round(discount_amount, 2),
-                            'discounted_subtotal': round(discounted_subtotal, 2),
-                            'gst_amount': round(gst_amount, 2),
-                            'final_price': round(final_total, 2)
-                        }
-                    })
-                
-                updated_item = item
-                item_updated = True
-                break
-        
-        if item_updated:
-            # Save the updated cart
-            save_user_cart({'products': products})
-            
+        snapshot = get_cart_snapshot()
+
+        # Save the updated line; re-applied to a fresh copy if another request changed the cart
+        applied = {}
+
+        def apply_discount(item):
+            applied['discount_percent'] = apply_cart_discount(item, discount_percent)
+
+        updated_item = snapshot.modify_item(
+            item_id, apply_discount,
+            ('discount_percent', 'unit_price', 'total_price', 'calculations'))
+
+        if updated_item is not None:
             return jsonify({
                 'success': True,
                 'message': 'Cart discount updated',
-                'cart_count': len(products),
+                'cart_count': snapshot.count(),
                 'updated_item': updated_item,
-                'applied_discount_percent': discount_percent
+                'applied_discount_percent': applied.get('discount_percent', discount_percent)
             })
         else:
             return jsonify({
                 'success': False,
                 'message': 'Item not found in cart',
-                'cart_count': len(products)
+                'cart_count': snapshot.count()
             }), 404
+    except CartConflictError as e:
+        return cart_conflict_response(e)
     except Exception as e:
         app.logger.error(f'Error updating cart discount: {str(e)}')
         return jsonify({
@@ -4704,20 +6079,590 @@ def update_cart_discount():
         }), 500
 
 
-@app.route('/get_cart_count')
-def get_cart_count():
-    """Return the number of products currently in the user's cart."""
-    try:
-        if not current_user.is_authenticated:
-            return jsonify({'count': 0})
-            
-        cart = get_user_cart()
-        return jsonify({'count': len(cart.get('products', []))})
-    except Exception as e:
-        print(f"Error in get_cart_count: {e}")
-        return jsonify({'count': 0})
+CART_BATCH_MAX_OPERATIONS = 200
+
+
+def _cart_batch_edit(operation):
+    """Turn one /cart/batch operation into an ``(item_id, mutate)`` edit; ValueError if invalid."""
+    if not isinstance(operation, dict):
+        raise ValueError('Each operation must be an object')
+    op = operation.get('op')
+    item_id = operation.get('item_id')
+    if not item_id:
+        raise ValueError('Item ID is required')
+
+    if op == 'quantity':
+        product_type, quantity = parse_cart_quantity(operation)
+        return item_id, lambda item: apply_cart_quantity(item, quantity, product_type)
+    if op == 'discount':
+        discount_percent = parse_cart_discount(operation)
+
+        def apply_discount(item):
+            applied = apply_cart_discount(item, discount_percent)
+            return {**item, 'applied_discount_percent': applied}
+        return item_id, apply_discount
+    if op == 'update':
+        fields = {key: value for key, value in operation.items() if key not in ('op', 'item_id')}
+        return item_id, lambda item: apply_cart_item_edit(item, fields)
+    if op == 'remove':
+        return item_id, None
+    raise ValueError(f"Unknown operation: {op}")
+
+
+@app.route('/cart/batch', methods=['POST'])
+@login_required
+def cart_batch():
+    """Apply several cart edits with one cart load and one save.
+
+    Expects ``{"operations": [{"op": "quantity" | "discount" | "update" | "remove",
+    "item_id": ..., ...}]}`` where each operation carries the same fields as
+    the matching single-edit route.  Operations run in order and are saved
+    together, so either all of them apply or none do.
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({
+            'success': False,
+            'message': 'operations must be a non-empty list'
+        }), 400
+    if len(operations) > CART_BATCH_MAX_OPERATIONS:
+        return jsonify({
+            'success': False,
+            'message': f'At most {CART_BATCH_MAX_OPERATIONS} operations per batch'
+        }), 400
+
+    try:
+        edits = [_cart_batch_edit(operation) for operation in operations]
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+    try:
+        snapshot = get_cart_snapshot()
+        results = snapshot.apply_edits(edits)
+        return jsonify({
+            'success': True,
+            'message': 'Cart updated',
+            'results': [
+                {'op': operation.get('op'), 'item_id': operation.get('item_id'), 'item': result}
+                for operation, result in zip(operations, results)
+            ],
+            'cart': {'products': snapshot.products, 'version': snapshot.version},
+            'totals': snapshot.totals(),
+            'cart_count': snapshot.count()
+        })
+    except LookupError as e:
+        return jsonify({
+            'success': False,
+            'message': 'Item not found in cart',
+            'item_id': e.args[0] if e.args else None
+        }), 404
+    except CartConflictError as e:
+        return cart_conflict_response(e)
+    except Exception as e:
+        app.logger.error(f'Error applying cart batch: {str(e)}')
+        return jsonify({
+            'success': False,
+            'message': 'An error occurred while updating the cart',
+            'error': str(e)
+        }), 500
+
+
+@app.route('/get_cart_count')
+def get_cart_count():
+    """Return the number of products currently in the user's cart."""
+    try:
+        if not current_user.is_authenticated:
+            return jsonify({'count': 0})
+            
+        count, _total = get_cart_snapshot().summary()
+        return jsonify({'count': count})
+    except Exception as e:
+        print(f"Error in get_cart_count: {e}")
+        return jsonify({'count': 0})
+
+# ----- Company directory cache -----
+# load_companies_data() is hit on nearly every page render and quotation, so the
+# normalized directory is cached per worker.  Writes bump a shared version (a
+# counter document in Mongo, the file mtime for the JSON fallback) so other
+# workers notice changes with a single tiny lookup instead of a full scan.
+
+COMPANY_DIRECTORY_VERSION_ID = 'companies_version'
+COMPANY_DIRECTORY_CHECK_INTERVAL = float(os.getenv('COMPANY_DIRECTORY_CHECK_INTERVAL', '2'))
+COMPANY_DIRECTORY_MAX_AGE = float(os.getenv('COMPANY_DIRECTORY_MAX_AGE', '300'))
+
+_company_directory_lock = threading.Lock()
+_company_search_lock = threading.Lock()
+_company_directory_cache = {
+    'version': None,
+    'directory': None,
+    'loaded_at': 0.0,
+    'checked_at': 0.0,
+    'search': None,  # last typeahead index, kept across reloads
+}
+
+
+def _companies_json_path():
+    return os.path.join(app.root_path, 'static', 'data', 'companies.json')
+
+
+def _companies_directory_source():
+    return 'mongo' if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None else 'json'
+
+
+def _get_companies_directory_version():
+    """Return a cheap token that changes whenever the company directory changes."""
+    if _companies_directory_source() == 'mongo':
+        try:
+            counter = mongo_db.counters.find_one({'_id': COMPANY_DIRECTORY_VERSION_ID}, {'seq': 1})
+            return ('mongo', (counter or {}).get('seq', 0))
+        except Exception as e:
+            app.logger.warning(f"Could not read company directory version: {e}")
+            return None
+    try:
+        return ('json', os.stat(_companies_json_path()).st_mtime_ns)
+    except OSError:
+        return ('json', None)
+
+
+def invalidate_companies_cache():
+    """Drop this worker's cached directory and bump the shared version for other workers."""
+    with _company_directory_lock:
+        _company_directory_cache['version'] = None
+        _company_directory_cache['directory'] = None
+        _company_directory_cache['checked_at'] = 0.0
+
+    if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
+        try:
+            mongo_db.counters.update_one(
+                {'_id': COMPANY_DIRECTORY_VERSION_ID},
+                {'$inc': {'seq': 1}},
+                upsert=True
+            )
+        except Exception as e:
+            app.logger.warning(f"Could not bump company directory version: {e}")
+
+
+class CompanyRecord(Mapping):
+    """Compact, read-only company directory entry.
+
+    Each value is stored once in a slot; the legacy spreadsheet-style keys
+    ('Company Name', 'EmailID', 'Billing City', ...) and the snake_case keys
+    are both readable as mapping keys.  to_dict() produces the dual-keyed dict
+    the directory used to hold, for templates, JSON and the JSON write paths.
+    """
+
+    __slots__ = (
+        'id', 'name', 'email', 'phone', 'billing_attention', 'billing_address',
+        'billing_street', 'billing_city', 'billing_state', 'billing_postal_code',
+        'billing_phone', 'gst_registered', 'gst_number', 'address', 'assigned_to',
+        'created_at', 'created_by'
+    )
+
+    LEGACY_KEYS = {
+        'Company Name': 'name',
+        'EmailID': 'email',
+        'Phone': 'phone',
+        'Billing Attention': 'billing_attention',
+        'Billing Address': 'billing_address',
+        'Billing Street': 'billing_street',
+        'Billing City': 'billing_city',
+        'Billing State': 'billing_state',
+        'Billing Postal Code': 'billing_postal_code',
+        'Billing Phone': 'billing_phone',
+        'GST Registered': 'gst_registered',
+        'GST Number': 'gst_number',
+        'Address': 'address',
+    }
+    _KEY_ORDER = (
+        ('id',), ('Company Name', 'name'), ('EmailID', 'email'), ('Phone', 'phone'),
+        ('Billing Attention', 'billing_attention'), ('Billing Address', 'billing_address'),
+        ('Billing Street', 'billing_street'), ('Billing City', 'billing_city'),
+        ('Billing State', 'billing_state'), ('Billing Postal Code', 'billing_postal_code'),
+        ('Billing Phone', 'billing_phone'), ('GST Registered', 'gst_registered'),
+        ('GST Number', 'gst_number'), ('Address', 'address'), ('assigned_to',),
+        ('created_at',), ('created_by',)
+    )
+
+    def __init__(self, **fields):
+        for slot in self.__slots__:
+            object.__setattr__(self, slot, fields.get(slot))
+        object.__setattr__(self, 'assigned_to', tuple(fields.get('assigned_to') or ()))
+        object.__setattr__(self, 'gst_registered', bool(fields.get('gst_registered')))
+        object.__setattr__(self, 'gst_number', fields.get('gst_number') or '')
+
+    @classmethod
+    def from_mapping(cls, company):
+        """Build a record from a dual-keyed directory dict."""
+        fields = {}
+        for slot in cls.__slots__:
+            value = company.get(slot)
+            if value is None:
+                legacy = cls._LEGACY_BY_SLOT.get(slot)
+                if legacy:
+                    value = company.get(legacy)
+            fields[slot] = value
+        return cls(**fields)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('CompanyRecord is read-only; use to_dict() for a mutable copy')
+
+    def _slot_for(self, key):
+        if key in self.LEGACY_KEYS:
+            return self.LEGACY_KEYS[key]
+        if key in self.__slots__:
+            return key
+        return None
+
+    def __getitem__(self, key):
+        slot = self._slot_for(key)
+        if slot is None:
+            raise KeyError(key)
+        value = getattr(self, slot)
+        return list(value) if slot == 'assigned_to' else value
+
+    def __contains__(self, key):
+        return self._slot_for(key) is not None
+
+    def __iter__(self):
+        for keys in self._KEY_ORDER:
+            yield from keys
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._KEY_ORDER)
+
+    def __repr__(self):
+        return f"CompanyRecord(id={self.id!r}, name={self.name!r})"
+
+    def to_dict(self, style='both'):
+        """Return a mutable dict in 'both' (legacy + snake_case), 'snake' or 'legacy' key style."""
+        result = {}
+        for keys in self._KEY_ORDER:
+            value = getattr(self, keys[-1])
+            if keys[-1] == 'assigned_to':
+                value = list(value)
+            if style == 'snake' or len(keys) == 1:
+                result[keys[-1]] = value
+            elif style == 'legacy':
+                result[keys[0]] = value
+            else:
+                result[keys[0]] = value
+                result[keys[1]] = value
+        return result
+
+
+CompanyRecord._LEGACY_BY_SLOT = {slot: legacy for legacy, slot in CompanyRecord.LEGACY_KEYS.items()}
+
+
+def _copy_company_record(company):
+    if isinstance(company, CompanyRecord):
+        return company.to_dict()
+    record = dict(company)
+    if isinstance(record.get('assigned_to'), list):
+        record['assigned_to'] = list(record['assigned_to'])
+    return record
+
+
+def _company_email_key(value):
+    return str(value or '').strip().lower()
+
+
+def _company_name_key(value):
+    return ' '.join(str(value or '').split()).casefold()
+
+
+def _build_company_directory(companies):
+    """Bundle the directory list with id / email / name indexes into it.
+
+    Indexes map to list positions so callers holding a copy from
+    load_companies_data() can address the same record in their own list.
+    """
+    companies = [
+        company if isinstance(company, CompanyRecord) else CompanyRecord.from_mapping(company)
+        for company in companies
+    ]
+    by_id = {}
+    by_email = {}
+    by_name = {}
+    for position, company in enumerate(companies):
+        for raw_id in (company.get('id'), company.get('_id')):
+            if raw_id:
+                by_id.setdefault(str(raw_id), position)
+        email_key = _company_email_key(company.get('email') or company.get('EmailID'))
+        if email_key:
+            by_email.setdefault(email_key, position)
+        name_key = _company_name_key(company.get('name') or company.get('Company Name'))
+        if name_key:
+            by_name.setdefault(name_key, position)
+    return {
+        'companies': companies,
+        'by_id': by_id,
+        'by_email': by_email,
+        'by_name': by_name,
+    }
+
+
+def _get_company_directory():
+    """Return the cached directory bundle, reloading it when the shared version moved.
+
+    The returned structures are shared between requests and must not be mutated;
+    records are read-only CompanyRecords and load_companies_data() hands out
+    mutable dict copies.
+    """
+    now = time.time()
+    cache = _company_directory_cache
+    directory = cache['directory']
+
+    if directory is not None and now - cache['loaded_at'] < COMPANY_DIRECTORY_MAX_AGE:
+        if now - cache['checked_at'] < COMPANY_DIRECTORY_CHECK_INTERVAL:
+            return directory
+        version = _get_companies_directory_version()
+        if version is not None and version == cache['version']:
+            cache['checked_at'] = now
+            return directory
+    else:
+        version = _get_companies_directory_version()
+
+    with _company_directory_lock:
+        # Another thread may have refreshed the cache while we waited for the lock
+        if cache['directory'] is not None and version is not None and cache['version'] == version:
+            return cache['directory']
+
+        directory = _build_company_directory(_load_companies_data_uncached())
+        # The loader may have fallen back from Mongo to JSON; key the cache on the real source
+        if version is None or version[0] != _companies_directory_source():
+            version = _get_companies_directory_version()
+        loaded_at = time.time()
+        cache['directory'] = directory
+        cache['version'] = version
+        cache['loaded_at'] = loaded_at
+        cache['checked_at'] = loaded_at
+
+    return directory
+
+
+def load_companies_data():
+    """Return the normalized company directory, served from the per-worker cache when current.
+
+    Callers get their own copies of the records so the JSON write paths can keep
+    mutating and saving the list without touching the cached directory.
+    """
+    return [_copy_company_record(company) for company in _get_company_directory()['companies']]
+
+
+def _find_company_position(index_name, key):
+    """Return (directory, position) for a lookup key, position None when missing."""
+    directory = _get_company_directory()
+    if not key:
+        return directory, None
+    return directory, directory[index_name].get(key)
+
+
+def _find_company(index_name, key):
+    """Return the shared, read-only CompanyRecord for a lookup key (or None)."""
+    directory, position = _find_company_position(index_name, key)
+    if position is None:
+        return None
+    return directory['companies'][position]
+
+
+def find_company_by_id(company_id):
+    return _find_company('by_id', str(company_id) if company_id else '')
+
+
+def find_company_by_email(email):
+    return _find_company('by_email', _company_email_key(email))
+
+
+def find_company_by_name(name):
+    return _find_company('by_name', _company_name_key(name))
+
+
+def _get_company_search_index(directory):
+    """Return the typeahead index for a directory snapshot, building it on first use.
+
+    A reload that changed no searched field (a phone or payment-terms write)
+    reuses the previous snapshot's index instead of rebuilding it.
+    """
+    index = directory.get('search')
+    if index is None:
+        with _company_search_lock:
+            index = directory.get('search')
+            if index is None:
+                previous = _company_directory_cache.get('search')
+                if previous is not None and previous.matches(directory['companies']):
+                    index = previous
+                else:
+                    index = CompanySearchIndex(directory['companies'])
+                directory['search'] = index
+                _company_directory_cache['search'] = index
+    return index
+
+
+def search_company_directory(query, limit=10, allowed_ids=None):
+    """Ranked typeahead search over name, email, city and GSTIN.
+
+    ``allowed_ids`` limits results to those company ids (None means no limit).
+    """
+    directory = _get_company_directory()
+    allowed = None
+    if allowed_ids is not None:
+        by_id = directory['by_id']
+        allowed = {by_id[str(cid)] for cid in allowed_ids if str(cid) in by_id}
+        if not allowed:
+            return []
+    positions = _get_company_search_index(directory).search(query, limit=limit, allowed=allowed)
+    return [_copy_company_record(directory['companies'][position]) for position in positions]
+
+
+def load_companies_by_ids(company_ids):
+    """Return directory records for the given ids only, ordered by company name.
+
+    Mongo serves this with a projected ``_id: {$in: ...}`` query so a user with a
+    handful of assigned accounts never pulls the whole collection; the JSON
+    fallback resolves the ids through the directory id index.
+    """
+    global USE_MONGO
+
+    id_list = []
+    seen = set()
+    for cid in company_ids or []:
+        cid = str(cid).strip() if cid else ''
+        if cid and cid not in seen:
+            seen.add(cid)
+            id_list.append(cid)
+    if not id_list:
+        return []
+
+    if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
+        object_ids = [ObjectId(cid) for cid in id_list if ObjectId.is_valid(cid)]
+        if not object_ids:
+            return []
+        try:
+            cursor = mongo_db.companies.find(
+                {'_id': {'$in': object_ids}},
+                COMPANY_DIRECTORY_PROJECTION
+            ).sort('Company Name', 1)
+            companies = []
+            for company in cursor:
+                try:
+                    mapped = _map_mongo_company(company)
+                    if mapped:
+                        companies.append(mapped)
+                except Exception as e:
+                    app.logger.error(f"Error processing company {company.get('_id')}: {str(e)}")
+            return companies
+        except Exception as db_error:
+            app.logger.error(f"MongoDB error in load_companies_by_ids: {str(db_error)}")
+            USE_MONGO = False
+
+    directory = _get_company_directory()
+    positions = sorted({directory['by_id'][cid] for cid in id_list if cid in directory['by_id']})
+    return [_copy_company_record(directory['companies'][position]) for position in positions]
+
 
-def load_companies_data():
+def load_companies_for_user(user):
+    """Return the companies ``user`` may pick from, filtering at query time."""
+    assigned_ids = get_user_assigned_company_ids(user)
+    if assigned_ids is None:
+        return load_companies_data()
+    if not assigned_ids:
+        return []
+    return load_companies_by_ids(assigned_ids)
+
+
+COMPANY_DIRECTORY_PROJECTION = {
+    '_id': 1,
+    'Company Name': 1,
+    'EmailID': 1,
+    'Phone': 1,
+    'Billing Attention': 1,
+    'Billing Address': 1,
+    'Billing Street': 1,
+    'Billing City': 1,
+    'Billing State': 1,
+    'Billing Postal Code': 1,
+    'Billing Phone': 1,
+    'GST Registered': 1,
+    'GST Number': 1,
+    'gst_registered': 1,
+    'gst_number': 1,
+    'created_at': 1,
+    'Created At': 1,
+    'name': 1,
+    'email': 1,
+    'address': 1,
+    'Address': 1,
+    'assigned_to': 1,
+    'created_by': 1
+}
+
+
+def _map_mongo_company(company):
+    """Map a projected Mongo company document to the directory record shape."""
+    company_id = str(company.get('_id'))
+
+    # Get company data (we only store one set of fields now)
+    name = company.get('Company Name') or company.get('name')
+    email = company.get('EmailID') or company.get('email', '')
+
+    # Skip if we don't have a valid name
+    if not name:
+        app.logger.warning(f"Skipping company with missing name: {company_id}")
+        return None
+
+    # Ensure email is a string and properly formatted
+    email = str(email).strip() if email else ''
+
+    gst_registered_raw = company.get('GST Registered')
+    if gst_registered_raw is None:
+        gst_registered_raw = company.get('gst_registered')
+    if isinstance(gst_registered_raw, str):
+        gst_registered = gst_registered_raw.strip().lower() in {'true', '1', 'yes', 'y'}
+    else:
+        gst_registered = bool(gst_registered_raw)
+
+    gst_number_raw = company.get('GST Number') or company.get('gst_number') or ''
+    gst_number = str(gst_number_raw).strip().upper()
+
+    return {
+        'id': company_id,
+        'Company Name': name,
+        'EmailID': email,
+        'name': name,
+        'email': email,
+        'Phone': company.get('Phone'),
+        'phone': company.get('Phone'),
+        'Billing Attention': company.get('Billing Attention'),
+        'billing_attention': company.get('Billing Attention'),
+        'Billing Address': company.get('Billing Address'),
+        'billing_address': company.get('Billing Address'),
+        'Billing Street': company.get('Billing Street'),
+        'billing_street': company.get('Billing Street'),
+        'Billing City': company.get('Billing City'),
+        'billing_city': company.get('Billing City'),
+        'Billing State': company.get('Billing State'),
+        'billing_state': company.get('Billing State'),
+        'Billing Postal Code': company.get('Billing Postal Code'),
+        'billing_postal_code': company.get('Billing Postal Code'),
+        'Billing Phone': company.get('Billing Phone'),
+        'billing_phone': company.get('Billing Phone'),
+        'GST Registered': gst_registered,
+        'gst_registered': gst_registered,
+        'GST Number': gst_number,
+        'gst_number': gst_number,
+        'Address': company.get('Address') or company.get('address', ''),
+        'address': company.get('Address') or company.get('address', ''),
+        'assigned_to': normalize_assigned_companies(company.get('assigned_to', [])),
+        'created_at': company.get('created_at') or company.get('Created At'),
+        'created_by': company.get('created_by')
+    }
+
+
+def _load_companies_data_uncached():
     """Load companies data from MongoDB or fall back to JSON file."""
     global mongo_db, USE_MONGO
     
@@ -4730,94 +6675,15 @@ def load_companies_data():
                 # Test the connection first
                 mongo_db.command('ping')
                 
-                # Get companies from MongoDB with only the fields we need
-                projection = {
-                    '_id': 1,
-                    'Company Name': 1,
-                    'EmailID': 1,
-                    'Phone': 1,
-                    'Billing Attention': 1,
-                    'Billing Address': 1,
-                    'Billing Street': 1,
-                    'Billing City': 1,
-                    'Billing State': 1,
-                    'Billing Postal Code': 1,
-                    'Billing Phone': 1,
-                    'created_at': 1,
-                    'Created At': 1,
-                    'name': 1,
-                    'email': 1,
-                    'address': 1,
-                    'Address': 1,
-                    'assigned_to': 1,
-                    'created_by': 1
-                }
-                
                 # Find all companies and sort by name for consistent ordering
-                companies_cursor = mongo_db.companies.find({}, projection).sort('Company Name', 1)
-                companies = list(companies_cursor)
-                
+                companies_cursor = mongo_db.companies.find({}, COMPANY_DIRECTORY_PROJECTION).sort('Company Name', 1)
+
                 mapped_companies = []
-                for company in companies:
+                for company in companies_cursor:
                     try:
-                        company_id = str(company.pop('_id'))
-                        
-                        # Get company data (we only store one set of fields now)
-                        name = company.get('Company Name') or company.get('name')
-                        email = company.get('EmailID') or company.get('email', '')
-                        
-                        # Skip if we don't have a valid name
-                        if not name:
-                            app.logger.warning(f"Skipping company with missing name: {company_id}")
-                            continue
-                        
-                        # Ensure email is a string and properly formatted
-                        email = str(email).strip() if email else ''
-
-                        gst_registered_raw = company.get('GST Registered')
-                        if gst_registered_raw is None:
-                            gst_registered_raw = company.get('gst_registered')
-                        if isinstance(gst_registered_raw, str):
-                            gst_registered = gst_registered_raw.strip().lower() in {'true', '1', 'yes', 'y'}
-                        else:
-                            gst_registered = bool(gst_registered_raw)
-
-                        gst_number_raw = company.get('GST Number') or company.get('gst_number') or ''
-                        gst_number = str(gst_number_raw).strip().upper()
-                        
-                        mapped_companies.append({
-                            'id': company_id,
-                            'Company Name': name,
-                            'EmailID': email,
-                            'name': name,
-                            'email': email,
-                            'Phone': company.get('Phone'),
-                            'phone': company.get('Phone'),
-                            'Billing Attention': company.get('Billing Attention'),
-                            'billing_attention': company.get('Billing Attention'),
-                            'Billing Address': company.get('Billing Address'),
-                            'billing_address': company.get('Billing Address'),
-                            'Billing Street': company.get('Billing Street'),
-                            'billing_street': company.get('Billing Street'),
-                            'Billing City': company.get('Billing City'),
-                            'billing_city': company.get('Billing City'),
-                            'Billing State': company.get('Billing State'),
-                            'billing_state': company.get('Billing State'),
-                            'Billing Postal Code': company.get('Billing Postal Code'),
-                            'billing_postal_code': company.get('Billing Postal Code'),
-                            'Billing Phone': company.get('Billing Phone'),
-                            'billing_phone': company.get('Billing Phone'),
-                            'GST Registered': gst_registered,
-                            'gst_registered': gst_registered,
-                            'GST Number': gst_number,
-                            'gst_number': gst_number,
-                            'Address': company.get('Address') or company.get('address', ''),
-                            'address': company.get('Address') or company.get('address', ''),
-                            'assigned_to': normalize_assigned_companies(company.get('assigned_to', [])),
-                            'created_at': company.get('created_at') or company.get('Created At'),
-                            'created_by': company.get('created_by')
-                        })
-                        
+                        mapped = _map_mongo_company(company)
+                        if mapped:
+                            mapped_companies.append(mapped)
                     except Exception as e:
                         app.logger.error(f"Error processing company {company.get('_id')}: {str(e)}")
                         continue
@@ -4831,7 +6697,7 @@ def load_companies_data():
                 USE_MONGO = False
                 
         # Fall back to JSON file if MongoDB is not available or there was an error
-        companies_file = os.path.join(app.root_path, 'static', 'data', 'companies.json')
+        companies_file = _companies_json_path()
         app.logger.info(f"Falling back to loading companies from: {companies_file}")
         
         if os.path.exists(companies_file):
@@ -4927,7 +6793,6 @@ def index():
     try:
         set_pricing_mode('standard')
         reset_company_selection_session()
-        companies = load_companies_data()
         
         needs_warning = session.pop('needs_company_warning', False)
         if needs_warning:
@@ -4937,13 +6802,7 @@ def index():
         if not current_user.is_authenticated:
             companies = []
         else:
-            assigned_ids = get_user_assigned_company_ids(current_user)
-            if assigned_ids is not None:
-                if assigned_ids:
-                    assigned_set = {str(cid) for cid in assigned_ids}
-                    companies = [company for company in companies if str(company.get('id')) in assigned_set]
-                else:
-                    companies = []
+            companies = load_companies_for_user(current_user)
 
         # Ensure companies is a list before passing to template
         if not isinstance(companies, list):
@@ -4978,18 +6837,11 @@ def gm_page():
             return redirect(url_for('index'))
 
         set_pricing_mode('gm')
-        companies = load_companies_data()
 
         if not current_user.is_authenticated:
             companies = []
         else:
-            assigned_ids = get_user_assigned_company_ids(current_user)
-            if assigned_ids is not None:
-                if assigned_ids:
-                    assigned_set = {str(cid) for cid in assigned_ids}
-                    companies = [company for company in companies if str(company.get('id')) in assigned_set]
-                else:
-                    companies = []
+            companies = load_companies_for_user(current_user)
 
         if not isinstance(companies, list):
             companies = []
@@ -5217,28 +7069,15 @@ def forgot_password():
 def api_get_companies():
     """Get all companies from the database"""
     try:
-        companies = load_companies_data()  # Use the helper function directly
-        if not companies:
-            return jsonify({'error': 'No companies found'}), 404
-
-        # Convert to list of dicts if it's a dict
-        if isinstance(companies, dict):
-            companies = [
-                normalize_company_record({**v, 'id': k})
-                for k, v in companies.items()
-                if isinstance(v, dict)
-            ]
-        elif isinstance(companies, list):
-            companies = [normalize_company_record(c) for c in companies if isinstance(c, dict)]
-
         assigned_ids = get_user_assigned_company_ids(current_user)
-        if assigned_ids is not None:
-            if assigned_ids:
-                assigned_set = {str(cid) for cid in assigned_ids}
-                companies = [company for company in companies if str(company.get('id')) in assigned_set]
-            else:
-                companies = []
+        if assigned_ids is None:
+            companies = load_companies_data()
+            if not companies:
+                return jsonify({'error': 'No companies found'}), 404
+        else:
+            companies = load_companies_by_ids(assigned_ids)
 
+        companies = [normalize_company_record(c) for c in companies if isinstance(c, dict)]
         return jsonify(companies)
     except Exception as e:
         app.logger.error(f"Error getting companies: {str(e)}")
@@ -5280,6 +7119,69 @@ def api_get_machines():
         app.logger.error(f"Error fetching machines: {str(e)}")
         return jsonify([])
 
+@app.route('/api/rules/price', methods=['GET'])
+@login_required
+def api_rule_price():
+    """Price of one rule profile from the server-side catalogue.
+
+    Takes ``profile_id`` and optionally ``packaging_type``; with ``quantity``
+    (and ``discount_percent`` / ``gst_percent``, both clamped to 0-100) the
+    line totals are included too.
+    """
+    profile = get_rule_catalog().get(request.args.get('profile_id'), request.args.get('packaging_type'))
+    if profile is None:
+        return jsonify({'success': False, 'error': 'Unknown rule profile'}), 404
+
+    result = {'success': True, **profile.as_dict()}
+    quantity = request.args.get('quantity', type=int)
+    if quantity is not None:
+        if quantity < 1:
+            return jsonify({'success': False, 'error': 'Quantity must be at least 1'}), 400
+        discount_percent = max(0.0, min(request.args.get('discount_percent', default=0.0, type=float) or 0.0, 100.0))
+        gst_percent = max(0.0, min(request.args.get('gst_percent', default=18.0, type=float), 100.0))
+        result['calculations'] = price_line(
+            {'type': 'rule', 'unit_price': profile.unit_price},
+            quantity=quantity,
+            discount_percent=discount_percent,
+            gst_percent=gst_percent
+        )
+    return jsonify(result)
+
+@app.route('/api/packs/solve', methods=['GET'])
+@login_required
+def api_solve_packs():
+    """Pack mix for a chemical or spray powder quantity.
+
+    Takes ``product_id``, ``quantity`` (litres or kg) and ``objective``
+    ('cost' or 'surplus'); with ``format_id`` the whole packs of that one
+    format are returned as ``format_solution`` as well.
+    """
+    solver = get_pack_catalog().get(request.args.get('product_id'))
+    if solver is None:
+        return jsonify({'success': False, 'error': 'Unknown product'}), 404
+
+    quantity = request.args.get('quantity', type=float)
+    if quantity is None or not 0 < quantity < float('inf'):
+        return jsonify({'success': False, 'error': 'Quantity must be greater than 0'}), 400
+    objective = request.args.get('objective', 'cost')
+    if objective not in PACK_OBJECTIVES:
+        return jsonify({'success': False, 'error': f'Objective must be one of: {", ".join(PACK_OBJECTIVES)}'}), 400
+
+    result = {
+        'success': True,
+        'product_id': solver.product_id,
+        'unit': solver.unit,
+        'objective': objective,
+        'solution': solver.solve(quantity, objective).as_dict()
+    }
+    format_id = request.args.get('format_id')
+    if format_id:
+        format_solution = solver.single_format(format_id, quantity)
+        if format_solution is None:
+            return jsonify({'success': False, 'error': 'Unknown pack format'}), 404
+        result['format_solution'] = format_solution.as_dict()
+    return jsonify(result)
+
 @app.route('/api/session/update', methods=['POST'])
 @login_required
 def api_update_session():
@@ -5376,42 +7278,18 @@ def api_bar_data():
 @app.route('/api/companies/search', methods=['GET'])
 @login_required
 def search_companies():
-    """Search for companies by name"""
+    """Typeahead search for companies by name, email, city or GSTIN"""
     query = request.args.get('q', '').lower().strip()
     if not query or len(query) < 2:
         return jsonify([])
     
     try:
-        # Search in MongoDB if available
-        if MONGO_AVAILABLE and USE_MONGO:
-            # Search in both name and address fields
-            regex_pattern = f'.*{re.escape(query)}.*'
-            companies = list(mongo_db.companies.find({
-                '$or': [
-                    {'name': {'$regex': regex_pattern, '$options': 'i'}},
-                    {'address': {'$regex': regex_pattern, '$options': 'i'}}
-                ]
-            }).limit(10))
-            
-            # Convert ObjectId to string for JSON serialization
-            for company in companies:
-                company['id'] = str(company.pop('_id'))
-        else:
-            # Fallback to JSON file if needed
-            companies_file = os.path.join('data', 'companies.json')
-            if os.path.exists(companies_file):
-                with open(companies_file, 'r') as f:
-                    all_companies = json.load(f)
-                
-                # Simple case-insensitive search
-                companies = [
-                    {**c, 'id': c['id']} for c in all_companies 
-                    if query in c.get('name', '').lower() or 
-                       query in c.get('address', '').lower()
-                ][:10]
-            else:
-                companies = []
-        
+        limit = min(max(request.args.get('limit', default=10, type=int) or 10, 1), 50)
+        companies = search_company_directory(
+            query,
+            limit=limit,
+            allowed_ids=get_user_assigned_company_ids(current_user)
+        )
         return jsonify(companies)
     except Exception as e:
         app.logger.error(f"Error searching companies: {str(e)}")
@@ -5495,8 +7373,7 @@ def update_user_company():
         session['company_id'] = company_id
         
         # Get company details for response
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
         
         # Update session with company details
         session['company_name'] = company_name
@@ -5835,6 +7712,8 @@ def api_add_company():
             with open(companies_file, 'w', encoding='utf-8') as f:
                 json.dump(companies, f, ensure_ascii=False, indent=2)
 
+        invalidate_companies_cache()
+
         # Log the successful addition
         app.logger.info(f"Company added successfully - Name: {name}, Email: {email}")
         
@@ -6232,6 +8111,115 @@ def api_reset_password():
         return jsonify({'error': 'Internal server error'}), 500
 
 
+def price_quotation_lines(products):
+    """Price every quotation line in one pricing_engine pass and store each line's ``calculations``.
+
+    Chemicals are quoted per litre, everything else per unit.  Returns the
+    PricedLines batch (index i is products[i]).
+    """
+    priced = price_lines(products, litres=True)
+    for index, item in enumerate(products):
+        calculations = priced.calculations(index)
+        if item.get('type') == 'blanket':
+            calculations = {
+                'base_price': round(to_float(item.get('base_price')) or 0.0, 2),
+                'bar_price': round(to_float(item.get('bar_price')) or 0.0, 2),
+                **calculations
+            }
+        elif item.get('type') == 'mpack':
+            calculations['price_after_discount'] = calculations['discounted_subtotal']
+        calculations['taxable_amount'] = calculations['discounted_subtotal']
+        item['calculations'] = calculations
+    return priced
+
+
+QUOTATION_SUMMARY_CACHE_SIZE = int(os.getenv('QUOTATION_SUMMARY_CACHE_SIZE', '256') or 256)
+# user id -> (cache key, line calculations, summary), least recently used first
+_quotation_summaries = OrderedDict()
+_quotation_summaries_lock = threading.Lock()
+
+
+def _quotation_cache_key(cart, products):
+    """Cart version plus a hash of the line ids and their pricing versions.
+
+    A cart that is deleted and re-created restarts its version, so the
+    version alone (or with the line count) can match a different cart.
+    """
+    lines = json.dumps([[item.get('id'), item.get('pricing_version')] for item in products], default=str)
+    return cart.get('version'), hashlib.sha1(lines.encode('utf-8')).hexdigest()
+
+
+def forget_quotation_summary(user_id):
+    """Drop a user's cached quotation summary (their cart was cleared)."""
+    with _quotation_summaries_lock:
+        _quotation_summaries.pop(str(user_id), None)
+
+
+def get_quotation_summary(cart):
+    """Price a cart for a quotation and return its totals.
+
+    Every line gets its ``calculations``; the summary holds the pre-discount
+    subtotal, discount, taxable amount and total, with GST split by rate
+    (``gst_breakdown.by_rate``) and by blanket vs other lines.  It is cached
+    per user on the cart version and its lines (for the
+    QUOTATION_SUMMARY_CACHE_SIZE most recent users), so preview, PDF and send
+    price an unchanged cart once.
+    """
+    products = cart.setdefault('products', [])
+    for item in products:
+        item.setdefault('type', '')
+        item.setdefault('quantity', 1)
+        item.setdefault('discount_percent', 0)
+        item.setdefault('gst_percent', 18)
+        item.setdefault('unit_price', 0)
+        item.setdefault('base_price', 0)
+        item.setdefault('bar_price', 0)
+
+    user_id = str(getattr(current_user, 'id', '') or '') if has_request_context() else ''
+    cacheable = bool(user_id) and cart.get('version') is not None
+    cached = None
+    if cacheable:
+        cache_key = _quotation_cache_key(cart, products)
+        with _quotation_summaries_lock:
+            cached = _quotation_summaries.get(user_id)
+            if cached is not None:
+                _quotation_summaries.move_to_end(user_id)
+    if cached is not None and cached[0] == cache_key:
+        for item, calculations in zip(products, cached[1]):
+            item['calculations'] = dict(calculations)
+        return copy.deepcopy(cached[2])
+
+    priced = price_quotation_lines(products)
+    totals = priced.summary(['blankets' if item.get('type') == 'blanket' else 'mpacks' for item in products])
+    gst_breakdown = {
+        group: {
+            'subtotal': totals['groups'].get(group, {}).get('subtotal', 0.0),
+            'discount': totals['groups'].get(group, {}).get('discount', 0.0),
+            'subtotal_after_discount': totals['groups'].get(group, {}).get('taxable', 0.0),
+            'gst': totals['groups'].get(group, {}).get('gst', 0.0),
+            'rate': totals['groups'].get(group, {}).get('rate')
+        }
+        for group in ('blankets', 'mpacks')
+    }
+    gst_breakdown['by_rate'] = totals['by_rate']
+    gst_breakdown['total_gst'] = totals['gst']
+    summary = {
+        'subtotal_before_discount': totals['subtotal'],
+        'total_discount': totals['discount'],
+        'subtotal_after_discount': totals['taxable'],
+        'total': totals['total'],
+        'gst_breakdown': gst_breakdown
+    }
+
+    if cacheable:
+        with _quotation_summaries_lock:
+            _quotation_summaries[user_id] = (cache_key, [dict(item['calculations']) for item in products], summary)
+            _quotation_summaries.move_to_end(user_id)
+            while len(_quotation_summaries) > QUOTATION_SUMMARY_CACHE_SIZE:
+                _quotation_summaries.popitem(last=False)
+    return copy.deepcopy(summary)
+
+
 @app.route('/quotation_preview')
 @login_required
 @company_required
@@ -6317,175 +8305,12 @@ def quotation_preview():
         
         session['selected_company'] = selected_company
 
-    # Ensure all items have required fields and calculate subtotal
-    subtotal = 0
-    for item in cart.get('products', []):
-        # Ensure all required fields exist with defaults
-        item.setdefault('type', '')
-        item.setdefault('quantity', 1)
-        item.setdefault('discount_percent', 0)
-        item.setdefault('gst_percent', 18)  # Default GST for mpack
-        item.setdefault('unit_price', 0)
-        item.setdefault('base_price', 0)
-        item.setdefault('bar_price', 0)
-
-        raw_quantity = item.get('quantity', 1)
-        if item['type'] == 'chemical':
-            try:
-                quantity_value = float(item.get('quantity_litre') or item.get('total_litre') or raw_quantity or 0)
-            except (TypeError, ValueError):
-                quantity_value = 0.0
-            quantity_value = max(quantity_value, 0.0)
-        else:
-            try:
-                quantity_value = float(raw_quantity or 0)
-            except (TypeError, ValueError):
-                quantity_value = 0.0
-            if quantity_value <= 0:
-                quantity_value = 1.0
-
-        if item['type'] == 'mpack':
-            # Calculate mpack total matching cart template's approach
-            price = float(item['unit_price'])
-            quantity = int(quantity_value) if quantity_value else 1
-            discount_percent = float(item['discount_percent'])
-            gst_percent = float(item['gst_percent'])
-
-            subtotal = price * quantity
-            discount_amount = (subtotal * discount_percent / 100) if discount_percent else 0
-            price_after_discount = subtotal - discount_amount
-            gst_amount = (price_after_discount * gst_percent / 100) if gst_percent else 0
-            final_total = price_after_discount + gst_amount
-            
-            # Store calculations in the item
-            item['calculations'] = {
-                'unit_price': round(price, 2),
-                'quantity': quantity,
-                'subtotal': round(subtotal, 2),
-                'discount_percent': discount_percent,
-                'discount_amount': round(discount_amount, 2),
-                'price_after_discount': round(price_after_discount, 2),
-                'gst_percent': gst_percent,
-                'gst_amount': round(gst_amount, 2),
-                'final_total': round(final_total, 2)
-            }
-            item_subtotal = final_total
-            
-        elif item['type'] == 'blanket':
-            # Calculate blanket total matching cart template's approach
-            base_price = float(item.get('base_price', 0))
-            bar_price = float(item.get('bar_price', 0))
-            quantity = int(quantity_value) if quantity_value else 1
-            discount_percent = float(item.get('discount_percent', 0))
-            gst_percent = float(item.get('gst_percent', 18))
-
-            # Calculate unit price as base + bar price
-            unit_price = base_price + bar_price
-            
-            # Calculate subtotal (unit price * quantity)
-            subtotal = unit_price * quantity
-            
-            # Calculate discount amount
-            discount_amount = (subtotal * discount_percent / 100) if discount_percent else 0
-            
-            # Apply discount to get discounted subtotal
-            discounted_subtotal = subtotal - discount_amount
-            
-            # Calculate GST on discounted amount
-            gst_amount = (discounted_subtotal * gst_percent / 100)
-            
-            # Final total after discount and GST
-            final_total = discounted_subtotal + gst_amount
-            
-            # Store calculations in the item
-            item['calculations'] = {
-                'base_price': round(base_price, 2),
-                'bar_price': round(bar_price, 2),
-                'unit_price': round(unit_price, 2),
-                'quantity': quantity,
-                'subtotal': round(subtotal, 2),
-                'discount_percent': discount_percent,
-                'discount_amount': round(discount_amount, 2),
-                'discounted_subtotal': round(subtotal - discount_amount, 2),
-                'gst_percent': gst_percent,
-                'gst_amount': round(gst_amount, 2),
-                'final_total': round(final_total, 2)
-            }
-            item_subtotal = final_total
-            
-        else:
-            # Handle other product types
-            price = float(item.get('unit_price', 0))
-            quantity = quantity_value
-            discount_percent = float(item.get('discount_percent', 0))
-            gst_percent = float(item.get('gst_percent', 18))
-
-            subtotal = price * quantity
-            discount_amount = (subtotal * discount_percent / 100) if discount_percent else 0
-            discounted_subtotal = subtotal - discount_amount
-            gst_amount = (discounted_subtotal * gst_percent / 100) if gst_percent else 0
-            final_total = discounted_subtotal + gst_amount
-            
-            item['calculations'] = {
-                'unit_price': round(price, 2),
-                'quantity': quantity,
-                'subtotal': round(subtotal, 2),
-                'discount_percent': discount_percent,
-                'discount_amount': round(discount_amount, 2),
-                'gst_percent': gst_percent,
-                'gst_amount': round(gst_amount, 2),
-                'final_total': round(final_total, 2)
-            }
-            item_subtotal = final_total
-        
-        subtotal += item_subtotal
-    
-    # Calculate final totals with appropriate tax rates and discounts
-    subtotal_blankets = 0
-    subtotal_mpacks = 0
-    discount_blankets = 0
-    discount_mpacks = 0
-    
-    for item in cart.get('products', []):
-        item_calc = item.get('calculations', {})
-        item_subtotal = item_calc.get('subtotal', 0)
-        item_discount = item_calc.get('discount_amount', 0)
-        
-        if item.get('type') == 'blanket':
-            subtotal_blankets += item_subtotal
-            discount_blankets += item_discount
-        else:  # Assume mpacks for other types
-            subtotal_mpacks += item_subtotal
-            discount_mpacks += item_discount
-    
-    # Calculate amounts after discount
-    subtotal_after_discount_blankets = max(0, subtotal_blankets - discount_blankets)
-    subtotal_after_discount_mpacks = max(0, subtotal_mpacks - discount_mpacks)
-    
-    # Calculate GST for each category (on discounted amount)
-    gst_blankets = subtotal_after_discount_blankets * 0.18  # 18% GST for blankets
-    gst_mpacks = subtotal_after_discount_mpacks * 0.18      # 18% GST for mpacks
-    
-    # Calculate final totals
-    subtotal_before_discount = subtotal_blankets + subtotal_mpacks
-    total_discount = discount_blankets + discount_mpacks
-    subtotal_after_discount = subtotal_after_discount_blankets + subtotal_after_discount_mpacks
-    total_gst = gst_blankets + gst_mpacks
-    total = subtotal_after_discount + total_gst
-    
-    # Round to 2 decimal places for display
-    subtotal_before_discount = round(subtotal_before_discount, 2)
-    total_discount = round(total_discount, 2)
-    subtotal_after_discount = round(subtotal_after_discount, 2)
-    total = round(total, 2)
-    total_gst = round(total_gst, 2)
+    # Price every line and total the quotation (cached per cart version)
+    calculations = get_quotation_summary(cart)
 
     # Ensure session is saved before rendering the template
     session.modified = True
     
-    # Calculate cart_total as the subtotal after discount but before taxes
-    cart_total = subtotal_after_discount
-    
     context = {
         'cart': cart,
         'quote_date': quote_date,
@@ -6503,30 +8328,8 @@ def quotation_preview():
             }
         ),
         'now': current_datetime,  # Add current datetime object for the template
-        'calculations': {
-            'subtotal_before_discount': subtotal_before_discount,
-            'total_discount': total_discount,
-            'subtotal_after_discount': subtotal_after_discount,
-            'total': total,
-            'gst_breakdown': {
-                'blankets': {
-                    'subtotal': round(subtotal_blankets, 2),
-                    'discount': round(discount_blankets, 2),
-                    'subtotal_after_discount': round(subtotal_after_discount_blankets, 2),
-                    'gst': round(gst_blankets, 2),
-                    'rate': 18
-                },
-                'mpacks': {
-                    'subtotal': round(subtotal_mpacks, 2),
-                    'discount': round(discount_mpacks, 2),
-                    'subtotal_after_discount': round(subtotal_after_discount_mpacks, 2),
-                    'gst': round(gst_mpacks, 2),
-                    'rate': 18
-                },
-                'total_gst': round(total_gst, 2)
-            }
-        },
-        'cart_total': subtotal_after_discount  # cart_total is the subtotal after discount but before taxes
+        'calculations': calculations,
+        'cart_total': calculations['subtotal_after_discount']  # cart_total is the subtotal after discount but before taxes
     }
     
     return render_template('quotation.html', **context)
@@ -6558,85 +8361,8 @@ def quotation_pdf():
     customer_name = selected_company.get('name') or session.get('company_name', '')
     customer_email = selected_company.get('email') or session.get('company_email', '')
 
-    # Reuse the quotation_preview calculation logic so PDF always has complete totals.
-    subtotal_blankets = 0
-    subtotal_mpacks = 0
-    discount_blankets = 0
-    discount_mpacks = 0
-
-    for item in cart.get('products', []):
-        item.setdefault('type', '')
-        item.setdefault('quantity', 1)
-        item.setdefault('discount_percent', 0)
-        item.setdefault('gst_percent', 18)
-        item.setdefault('unit_price', 0)
-        item.setdefault('base_price', 0)
-        item.setdefault('bar_price', 0)
-
-        raw_quantity = item.get('quantity', 1)
-        if item['type'] == 'chemical':
-            try:
-                quantity_value = float(item.get('quantity_litre') or item.get('total_litre') or raw_quantity or 0)
-            except (TypeError, ValueError):
-                quantity_value = 0.0
-            quantity_value = max(quantity_value, 0.0)
-        else:
-            try:
-                quantity_value = float(raw_quantity or 0)
-            except (TypeError, ValueError):
-                quantity_value = 0.0
-            if quantity_value <= 0:
-                quantity_value = 1.0
-
-        price = float(item.get('unit_price', 0) or 0)
-        discount_percent = float(item.get('discount_percent', 0) or 0)
-        gst_percent = float(item.get('gst_percent', 18) or 18)
-
-        subtotal = price * quantity_value
-        discount_amount = (subtotal * discount_percent / 100) if discount_percent else 0
-        discounted_subtotal = subtotal - discount_amount
-        gst_amount = (discounted_subtotal * gst_percent / 100) if gst_percent else 0
-        final_total = discounted_subtotal + gst_amount
-
-        item['calculations'] = item.get('calculations') or {}
-        item['calculations'].update({
-            'unit_price': round(price, 2),
-            'quantity': quantity_value,
-            'subtotal': round(subtotal, 2),
-            'discount_percent': discount_percent,
-            'discount_amount': round(discount_amount, 2),
-            'discounted_subtotal': round(discounted_subtotal, 2),
-            'gst_percent': gst_percent,
-            'gst_amount': round(gst_amount, 2),
-            'final_total': round(final_total, 2)
-        })
-
-        if item.get('type') == 'blanket':
-            subtotal_blankets += subtotal
-            discount_blankets += discount_amount
-        else:
-            subtotal_mpacks += subtotal
-            discount_mpacks += discount_amount
-
-    subtotal_before_discount = subtotal_blankets + subtotal_mpacks
-    total_discount = discount_blankets + discount_mpacks
-    subtotal_after_discount_blankets = max(0, subtotal_blankets - discount_blankets)
-    subtotal_after_discount_mpacks = max(0, subtotal_mpacks - discount_mpacks)
-    subtotal_after_discount = subtotal_after_discount_blankets + subtotal_after_discount_mpacks
-    gst_blankets = subtotal_after_discount_blankets * 0.18
-    gst_mpacks = subtotal_after_discount_mpacks * 0.18
-    total_gst = gst_blankets + gst_mpacks
-    total = subtotal_after_discount + total_gst
-
-    calculations = {
-        'subtotal_before_discount': round(subtotal_before_discount, 2),
-        'total_discount': round(total_discount, 2),
-        'subtotal_after_discount': round(subtotal_after_discount, 2),
-        'total': round(total, 2),
-        'gst_breakdown': {
-            'total_gst': round(total_gst, 2)
-        }
-    }
+    # Same summary as quotation_preview (cached per cart version)
+    calculations = get_quotation_summary(cart)
 
     context = {
         'cart': cart,
@@ -6687,6 +8413,7 @@ def set_payment_terms():
                 {'$set': {'last_payment_terms': payment_terms, 'updated_at': datetime.utcnow()}},
                 upsert=False
             )
+            invalidate_companies_cache()
         except Exception as e:
             app.logger.warning(f"Failed to persist payment terms for company {company_id}: {e}")
 
@@ -6714,6 +8441,7 @@ def set_quotation_phones():
                     {'_id': ObjectId(str(company_id))},
                     {'$set': {'Phone': customer_phone, 'updated_at': datetime.utcnow()}}
                 )
+                invalidate_companies_cache()
                 app.logger.info(f"Updated company {company_id} phone to {customer_phone}")
             except Exception as e:
                 app.logger.error(f"Failed to update company phone: {e}")
@@ -6764,8 +8492,7 @@ def send_quotation():
         customer_email = ''
         # First try to get from user's company_id if available
         if hasattr(current_user, 'company_id') and current_user.company_id:
-            customer_name = get_company_name_by_id(current_user.company_id)
-            customer_email = get_company_email_by_id(current_user.company_id)
+            customer_name, customer_email = get_company_contact_by_id(current_user.company_id)
 
         # If not found in user's company_id, try session
         if customer_name == 'Not specified' or not customer_email:
@@ -6787,18 +8514,17 @@ def send_quotation():
                 )
         
         if (customer_name == 'Not specified' or not customer_name) and customer_email:
-            # Try Mongo lookup by email
-            if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
-                try:
-                    company_doc = mongo_db.companies.find_one({'EmailID': customer_email})
-                    if company_doc:
-                        customer_name = (
-                            company_doc.get('Company Name') or
-                            company_doc.get('name') or
-                            customer_name
-                        )
-                except Exception as lookup_error:
-                    app.logger.error(f"Error looking up company by email: {lookup_error}")
+            # Look up the company directory by email
+            try:
+                company_doc = find_company_by_email(customer_email)
+                if company_doc:
+                    customer_name = (
+                        company_doc.get('Company Name') or
+                        company_doc.get('name') or
+                        customer_name
+                    )
+            except Exception as lookup_error:
+                app.logger.error(f"Error looking up company by email: {lookup_error}")
 
             # JSON fallback lookup
             if (customer_name == 'Not specified' or not customer_name):
@@ -6859,6 +8585,7 @@ def send_quotation():
                         {'_id': ObjectId(str(company_id))},
                         {'$set': {'Phone': customer_phone, 'updated_at': datetime.utcnow()}}
                     )
+                    invalidate_companies_cache()
                     app.logger.info(f"Updated company {company_id} phone to {customer_phone} on send_quotation")
                 except Exception as e:
                     app.logger.error(f"Failed to update company phone on send_quotation: {e}")
@@ -6908,6 +8635,7 @@ def send_quotation():
                         {'$set': {'last_payment_terms': payment_terms, 'updated_at': quote_generated_at}},
                         upsert=False
                     )
+                    invalidate_companies_cache()
                 except Exception as e:
                     app.logger.warning(f"Failed to update company payment terms for company {company_id}: {e}")
         quote_date_display = quote_generated_at.strftime('%d/%m/%Y')
@@ -6936,11 +8664,8 @@ def send_quotation():
             <tbody>
         """
 
-        subtotal = 0
-        subtotal_before_discount = 0.0
-        subtotal_after_discount = 0.0
-        total_discount = 0.0
-        total_gst = 0.0
+        # Line calculations and totals, shared with the preview and PDF
+        summary = get_quotation_summary(cart)
         for idx, p in enumerate(products, start=1):
             machine = p.get('machine', '')
             prod_type = p.get('type', '')
@@ -6978,101 +8703,11 @@ def send_quotation():
                 unit = p.get('unit', '')
                 dimensions = f"{length} x {width} {unit}" if length and width else '----'
             
-            # Calculate total based on product type
             if prod_type == 'mpack':
-                # Always recalculate MPack totals to ensure fresh values after quantity changes
-                unit_price = float(p.get('unit_price', 0))
-                discount_percent = float(p.get('discount_percent', 0))
-                gst_percent = float(p.get('gst_percent', 18))  # 18% GST for MPack
-
-                subtotal_val = unit_price * qty
-                discount_amount = (subtotal_val * discount_percent / 100) if discount_percent else 0
-                taxable_amount = subtotal_val - discount_amount
-                gst_amount = taxable_amount * gst_percent / 100
-                total_val = taxable_amount + gst_amount
-                
                 # Store discount percent for email template
-                p['discount_percent_display'] = discount_percent
-                
-                # Add discount percent to calculations for display
-                p['calculations'] = p.get('calculations', {})
-                p['calculations']['discount_percent'] = discount_percent
-
-                # Update (or create) calculations dict so subsequent routes remain consistent
-                p['calculations'] = {
-                    'unit_price': round(unit_price, 2),
-                    'quantity': qty,
-                    'discount_percent': discount_percent,
-                    'discount_amount': round(discount_amount, 2),
-                    'taxable_amount': round(taxable_amount, 2),
-                    'gst_percent': gst_percent,
-                    'gst_amount': round(gst_amount, 2),
-                    'final_total': round(total_val, 2)
-                }
-                
-            elif prod_type == 'blanket':
-                # Always recalculate Blanket totals as well
-                base_price = float(p.get('base_price', 0))
-                bar_price = float(p.get('bar_price', 0))
-                unit_price = base_price + bar_price
-                discount_percent = float(p.get('discount_percent', 0))
-                gst_percent = float(p.get('gst_percent', 18))
-
-                subtotal_val = unit_price * qty
-                discount_amount = subtotal_val * discount_percent / 100 if discount_percent else 0
-                taxable_amount = subtotal_val - discount_amount
-                gst_amount = taxable_amount * gst_percent / 100
-                total_val = taxable_amount + gst_amount
-
-                # Sync calculations back to product
-                p['calculations'] = {
-                    'unit_price': round(unit_price, 2),
-                    'quantity': qty,
-                    'discount_percent': discount_percent,
-                    'discount_amount': round(discount_amount, 2),
-                    'taxable_amount': round(taxable_amount, 2),
-                    'gst_percent': gst_percent,
-                    'gst_amount': round(gst_amount, 2),
-                    'final_total': round(total_val, 2)
-                }
-            else:
-                unit_price = float(p.get('unit_price', 0))
-                discount_percent = float(p.get('discount_percent', 0))
-                gst_percent = float(p.get('gst_percent', 18))
-
-                subtotal_val = unit_price * qty
-                discount_amount = (subtotal_val * discount_percent / 100) if discount_percent else 0
-                taxable_amount = subtotal_val - discount_amount
-                gst_amount = taxable_amount * gst_percent / 100
-                total_val = taxable_amount + gst_amount
-
-                p['calculations'] = {
-                    'unit_price': round(unit_price, 2),
-                    'quantity': qty,
-                    'subtotal': round(subtotal_val, 2),
-                    'discount_percent': discount_percent,
-                    'discount_amount': round(discount_amount, 2),
-                    'taxable_amount': round(taxable_amount, 2),
-                    'gst_percent': gst_percent,
-                    'gst_amount': round(gst_amount, 2),
-                    'final_total': round(total_val, 2)
-                }
-
-            subtotal += total_val
+                p['discount_percent_display'] = p['calculations']['discount_percent']
+            line_taxable = p['calculations']['taxable_amount']
 
-            calc = p.get('calculations', {})
-            line_unit_price = float(calc.get('unit_price', p.get('unit_price', p.get('base_price', 0) or 0)))
-            line_quantity = float(calc.get('quantity', p.get('quantity', 1) or 0))
-            line_pre_discount = line_unit_price * line_quantity
-            line_discount = float(calc.get('discount_amount', 0) or 0)
-            line_taxable = float(calc.get('taxable_amount', calc.get('subtotal', line_pre_discount - line_discount) or 0))
-            line_gst = float(calc.get('gst_amount', 0) or 0)
-
-            subtotal_before_discount += line_pre_discount
-            total_discount += line_discount
-            subtotal_after_discount += line_taxable
-            total_gst += line_gst
-            
             if prod_type == 'chemical':
                 thickness_display = '&nbsp;'
             elif p.get('thickness'):
@@ -7136,13 +8771,11 @@ def send_quotation():
         # Determine if we should show the discount row
         show_discount = bool(blanket_discounts or mpack_discounts)
 
-        total = subtotal_after_discount + total_gst
-
-        subtotal_before_discount = round(subtotal_before_discount, 2)
-        total_discount = round(total_discount, 2)
-        subtotal_after_discount = round(subtotal_after_discount, 2)
-        total_gst = round(total_gst, 2)
-        total = round(total, 2)
+        subtotal_before_discount = summary['subtotal_before_discount']
+        total_discount = summary['total_discount']
+        subtotal_after_discount = summary['subtotal_after_discount']
+        total_gst = summary['gst_breakdown']['total_gst']
+        total = summary['total']
 
         pdf_attachments = None
         try:
@@ -7160,15 +8793,7 @@ def send_quotation():
                         session.get('company_email'),
                         fallback={'name': customer_name, 'email': customer_email}
                     ),
-                    'calculations': {
-                        'subtotal_before_discount': subtotal_before_discount,
-                        'total_discount': total_discount,
-                        'subtotal_after_discount': subtotal_after_discount,
-                        'total': total,
-                        'gst_breakdown': {
-                            'total_gst': total_gst
-                        }
-                    },
+                    'calculations': summary,
                     'now': quote_generated_at
                 }
                 pdf_html = render_template('quotation_pdf.html', **pdf_context)
@@ -7185,6 +8810,14 @@ def send_quotation():
         except Exception as pdf_err:
             app.logger.warning(f"Failed to generate PDF attachment for email: {pdf_err}")
 
+        gst_rows_html = ''.join(
+            f"""<tr>
+                                            <td style='padding: 8px; text-align: right;'>GST ({row['label']}%):</td>
+                                            <td style='padding: 8px; text-align: right;'>₹{row['gst']:,.2f}</td>
+                                        </tr>"""
+            for row in summary['gst_breakdown']['by_rate']
+        )
+
         logo_src = "https://cgi-logo.tiiny.site/CGI_LOGO.svg"
 
         company_name_display = "Chemo Graphic International (CGI)"
@@ -7334,7 +8967,7 @@ def send_quotation():
                                     <tbody>
                                         <tr>
                                             <td style='padding: 8px; text-align: right; width: 70%;'>Subtotal (Pre-Discount):</td>
-                                            <td style='padding: 8px; text-align: right; width: 30%;'>₹{sum((p.get('unit_price', p.get('base_price', 0))) * p.get('quantity', 1) for p in products):,.2f}</td>
+                                            <td style='padding: 8px; text-align: right; width: 30%;'>₹{subtotal_before_discount:,.2f}</td>
                                         </tr>
                                         {f'''
                                         <tr style="display: {'table-row' if show_discount else 'none'};">
@@ -7344,17 +8977,14 @@ def send_quotation():
                                         ''' if True else ''}
                                         <tr style='border-top: 1px solid #dee2e6;'>
                                             <td style='padding: 8px; text-align: right; font-weight: bold;'>Total (Pre-GST):</td>
-                                            <td style='padding: 8px; text-align: right; font-weight: bold;'>₹{sum(p.get("calculations", {}).get("taxable_amount", p.get("calculations", {}).get("subtotal", 0)) for p in products):,.2f}</td>
+                                            <td style='padding: 8px; text-align: right; font-weight: bold;'>₹{subtotal_after_discount:,.2f}</td>
                                         </tr>
                                     
-                                        <tr>
-                                            <td style='padding: 8px; text-align: right;'>GST (18%):</td>
-                                            <td style='padding: 8px; text-align: right;'>₹{total_gst:,.2f}</td>
-                                        </tr>
+                                        {gst_rows_html}
                                         
                                         <tr style='border-top: 1px solid #dee2e6;'>
                                             <td style='padding: 8px; text-align: right; font-weight: bold;'>Total (After GST):</td>
-                                            <td style='padding: 8px; text-align: right; font-weight: bold;'>₹{sum(p.get("calculations", {}).get("final_total", 0) for p in products):,.2f}</td>
+                                            <td style='padding: 8px; text-align: right; font-weight: bold;'>₹{total:,.2f}</td>
                                         </tr>
                                     </tbody>
                                 </table>
@@ -7406,6 +9036,8 @@ def send_quotation():
                     'gst_amount': total_gst,
                     'total_amount_post_gst': total,
                     'total_gst': total_gst,
+                    'gst_breakdown': summary['gst_breakdown'],
+                    'summary': summary,
                     'discount_text': discount_text,
                     'notes': notes,
                     'generated_at_time_display': quote_time_display,
@@ -8048,8 +9680,7 @@ def mpacks():
     # If company_id is provided in the URL
     if company_id:
         # Try to get company info by ID
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         # Fall back to session data if no company_id in URL
         selected_company = session.get('selected_company', {})
@@ -8085,8 +9716,7 @@ def spray_powder():
     company_email = ''
 
     if company_id:
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         selected_company = session.get('selected_company', {})
         company_name = selected_company.get('name') or session.get('company_name')
@@ -8188,8 +9818,7 @@ def cutting_rule():
     company_email = ''
 
     if company_id:
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         selected_company = session.get('selected_company', {})
         company_name = selected_company.get('name') or session.get('company_name')
@@ -8221,8 +9850,7 @@ def creasing_matrix():
     company_email = ''
 
     if company_id:
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         selected_company = session.get('selected_company', {})
         company_name = selected_company.get('name') or session.get('company_name')
@@ -8258,8 +9886,7 @@ def chemicals_maintenance():
 
     # If company_id is provided in the URL
     if company_id:
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         selected_company = session.get('selected_company', {})
         company_name = selected_company.get('name') or session.get('company_name')
@@ -8298,8 +9925,7 @@ def blankets():
     # If company_id is provided in the URL
     if company_id:
         # Try to get company info by ID
-        company_name = get_company_name_by_id(company_id)
-        company_email = get_company_email_by_id(company_id)
+        company_name, company_email = get_company_contact_by_id(company_id)
     else:
         # Fall back to session data if no company_id in URL
         selected_company = session.get('selected_company', {})
@@ -8343,74 +9969,89 @@ def reset_password_page():
     return render_template('reset_password.html')
 
 # Helper functions to get company name and email by ID
-def get_company_name_by_id(company_id):
-    """Get company name by ID.
-    Priority: MongoDB -> JSON fallback."""
+COMPANY_CONTACT_PROJECTION = {
+    'Company Name': 1,
+    'name': 1,
+    'company_name': 1,
+    'EmailID': 1,
+    'email': 1,
+    'email_id': 1
+}
+
+
+def _fetch_company_contact(company_id):
+    """Resolve (name, email) for a company with at most one projected lookup."""
+    # A warm Mongo-backed directory cache already holds both fields (the JSON
+    # fallback keys companies differently, see company_emails.json below)
+    cached_version = _company_directory_cache['version']
+    if _company_directory_cache['directory'] is not None and cached_version and cached_version[0] == 'mongo':
+        company = find_company_by_id(company_id)
+        if company:
+            return (
+                company.get('Company Name') or company.get('name') or '',
+                company.get('EmailID') or company.get('email') or ''
+            )
+
+    if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
+        try:
+            doc = mongo_db.companies.find_one({'_id': ObjectId(company_id)}, COMPANY_CONTACT_PROJECTION)
+        except Exception:
+            doc = mongo_db.companies.find_one({'_id': company_id}, COMPANY_CONTACT_PROJECTION)
+        if doc:
+            name = doc.get('Company Name') or doc.get('name') or doc.get('company_name') or ''
+            email = doc.get('EmailID') or doc.get('email') or doc.get('email_id') or ''
+            return name, email
+        return '', ''
+
+    # Fallback to JSON file lookup
+    file_path = os.path.join(app.root_path, 'static', 'data', 'company_emails.json')
+    with open(file_path, 'r') as f:
+        companies = json.load(f)
+    # Convert company_id to int if it's a string
     try:
-        # Try MongoDB first
-        if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
-            try:
-                doc = mongo_db.companies.find_one({'_id': ObjectId(company_id)})
-            except Exception:
-                doc = mongo_db.companies.find_one({'_id': company_id})
-            if doc:
-                normalized = {k.lower().replace(' ', ''): v for k, v in doc.items()}
-                for key in ['name', 'companyname', 'company_name']:
-                    if key in normalized and normalized[key]:
-                        return normalized[key]
-        # Skip JSON fallback when MongoDB is enabled
-        if not (MONGO_AVAILABLE and USE_MONGO and mongo_db is not None):
-            # Fallback to JSON file lookup
-            file_path = os.path.join(app.root_path, 'static', 'data', 'company_emails.json')
-            with open(file_path, 'r') as f:
-                companies = json.load(f)
-                # Convert company_id to int if it's a string
-                try:
-                    idx = int(company_id) - 1
-                    if 0 <= idx < len(companies):
-                        return companies[idx].get('Company Name', '')
-                except (ValueError, TypeError):
-                    # If company_id is not a number, try to find by exact match in ID field
-                    for company in companies:
-                        if str(company.get('id', '')).lower() == str(company_id).lower():
-                            return company.get('Company Name', '')
+        idx = int(company_id) - 1
+        if 0 <= idx < len(companies):
+            return companies[idx].get('Company Name', ''), companies[idx].get('EmailID', '')
+    except (ValueError, TypeError):
+        # If company_id is not a number, try to find by exact match in ID field
+        for company in companies:
+            if str(company.get('id', '')).lower() == str(company_id).lower():
+                return company.get('Company Name', ''), company.get('EmailID', '')
+    return '', ''
 
-    except Exception as e:
-        app.logger.error(f"Error getting company name: {e}")
-    return ''
 
-def get_company_email_by_id(company_id):
-    """Get company email by ID.
-    Priority: MongoDB -> JSON fallback."""
+def get_company_contact_by_id(company_id):
+    """Get (company name, company email) by ID, memoized for the current request.
+    Priority: company directory cache -> MongoDB -> JSON fallback."""
+    if not company_id:
+        return '', ''
+
+    memo = None
+    if has_request_context():
+        memo = g.setdefault('company_contacts', {})
+        cached = memo.get(str(company_id))
+        if cached is not None:
+            return cached
+
     try:
-        if MONGO_AVAILABLE and USE_MONGO and mongo_db is not None:
-            try:
-                doc = mongo_db.companies.find_one({'_id': ObjectId(company_id)})
-            except Exception:
-                doc = mongo_db.companies.find_one({'_id': company_id})
-            if doc:
-                normalized = {k.lower().replace(' ', ''): v for k, v in doc.items()}
-                for key in ['email', 'emailid', 'email_id', 'emailid']:
-                    if key in normalized and normalized[key]:
-                        return normalized[key]
-        # Skip JSON fallback when MongoDB is enabled
-        if not (MONGO_AVAILABLE and USE_MONGO and mongo_db is not None):
-            file_path = os.path.join(app.root_path, 'static', 'data', 'company_emails.json')
-            with open(file_path, 'r') as f:
-                companies = json.load(f)
-                # Convert company_id to int if it's a string
-                try:
-                    idx = int(company_id) - 1
-                    if 0 <= idx < len(companies):
-                        return companies[idx].get('EmailID', '')
-                except (ValueError, TypeError):
-                    # If company_id is not a number, try to find by exact match in ID field
-                    for company in companies:
-                        if str(company.get('id', '')).lower() == str(company_id).lower():
-                            return company.get('EmailID', '')
+        contact = _fetch_company_contact(company_id)
     except Exception as e:
-        app.logger.error(f"Error getting company email: {e}")
-        return ''
+        app.logger.error(f"Error getting company contact: {e}")
+        contact = ('', '')
+
+    if memo is not None:
+        memo[str(company_id)] = contact
+    return contact
+
+
+def get_company_name_by_id(company_id):
+    """Get company name by ID."""
+    return get_company_contact_by_id(company_id)[0]
+
+
+def get_company_email_by_id(company_id):
+    """Get company email by ID."""
+    return get_company_contact_by_id(company_id)[1]
 
 # Error handling
 @app.errorhandler(404)
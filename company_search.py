@@ -0,0 +1,169 @@
+"""In-memory typeahead index over the company directory.
+
+Names, their word suffixes and the secondary fields (email, billing city,
+GSTIN) are kept in sorted arrays, so prefix lookups are a bisect and results
+come out already in name order.  Substring matches are found with str.find
+over a newline-joined copy of the sorted keys, which stops as soon as enough
+hits are collected.  app.py builds one index per cached directory snapshot and
+carries it over to the next snapshot when none of the searched fields changed
+(``CompanySearchIndex.matches``), so phone or payment-terms writes do not
+trigger a rebuild.
+"""
+import re
+from bisect import bisect_left, bisect_right
+from typing import Iterator, List, Optional, Sequence, Set, Tuple
+
+
+_NON_WORD = re.compile(r'[^0-9a-z@.]+')
+
+# Below this many allowed companies it is cheaper to rank them directly
+DIRECT_SCAN_LIMIT = 2000
+
+
+def search_fields(company) -> Tuple[Optional[str], ...]:
+    """Raw (name, email, billing city, GSTIN) of a directory record, the only fields the index reads."""
+    return (
+        company.get('name') or company.get('Company Name'),
+        company.get('email') or company.get('EmailID'),
+        company.get('billing_city') or company.get('Billing City'),
+        company.get('gst_number') or company.get('GST Number'),
+    )
+
+
+def normalize_search_text(value: Optional[str]) -> str:
+    """Casefold ``value`` and collapse everything except letters, digits, '@' and '.' to single spaces."""
+    if not value:
+        return ''
+    return _NON_WORD.sub(' ', str(value).casefold()).strip()
+
+
+class _SortedKeys:
+    """Sorted (key, position) pairs with prefix and substring iteration."""
+
+    def __init__(self, pairs: List[Tuple[str, int]]):
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.positions = [position for _, position in pairs]
+        self.blob = '\n'.join(self.keys)
+        self.offsets = []
+        offset = 0
+        for key in self.keys:
+            self.offsets.append(offset)
+            offset += len(key) + 1
+
+    def prefixed(self, query: str) -> Iterator[int]:
+        keys = self.keys
+        index = bisect_left(keys, query)
+        while index < len(keys) and keys[index].startswith(query):
+            yield self.positions[index]
+            index += 1
+
+    def containing(self, query: str) -> Iterator[int]:
+        blob, offsets = self.blob, self.offsets
+        start = 0
+        while True:
+            found = blob.find(query, start)
+            if found < 0:
+                return
+            row = bisect_right(offsets, found) - 1
+            yield self.positions[row]
+            # Skip to the next key so each key is reported once
+            start = offsets[row + 1] if row + 1 < len(offsets) else len(blob)
+
+
+class CompanySearchIndex:
+    """Prefix / substring index over a list of directory records.
+
+    Positions refer to the list the index was built from.  Results are ranked
+    in tiers: name prefix, name word prefix, name substring, then the same
+    for email / city / GSTIN.  Within a tier results are in alphabetical order.
+    """
+
+    def __init__(self, companies: Sequence[dict]):
+        self.fields: List[Tuple[Optional[str], ...]] = [search_fields(company) for company in companies]
+        self.names: List[str] = []
+        self.others: List[Tuple[str, ...]] = []
+        name_pairs = []
+        word_pairs = []
+        other_pairs = []
+
+        for position, (raw_name, *raw_others) in enumerate(self.fields):
+            name = normalize_search_text(raw_name)
+            others = tuple(filter(None, map(normalize_search_text, raw_others)))
+            self.names.append(name)
+            self.others.append(others)
+            if name:
+                name_pairs.append((name, position))
+                for match in re.finditer(r' (?=\S)', name):
+                    word_pairs.append((name[match.end():], position))
+            for value in others:
+                other_pairs.append((value, position))
+
+        self._names = _SortedKeys(name_pairs)
+        self._words = _SortedKeys(word_pairs)
+        self._others = _SortedKeys(other_pairs)
+
+    def __len__(self):
+        return len(self.names)
+
+    def matches(self, companies: Sequence[dict]) -> bool:
+        """True if ``companies`` has the same searched fields at the same positions, so this index serves it too."""
+        return len(companies) == len(self.fields) and all(
+            search_fields(company) == fields for company, fields in zip(companies, self.fields)
+        )
+
+    def _tier(self, query: str, position: int) -> Optional[int]:
+        name = self.names[position]
+        if name.startswith(query):
+            return 0
+        if (' ' + query) in name:
+            return 1
+        substring = len(query) >= 3
+        if substring and query in name:
+            return 2
+        others = self.others[position]
+        if any(value.startswith(query) for value in others):
+            return 3
+        if substring and any(query in value for value in others):
+            return 4
+        return None
+
+    def _scan(self, query: str, limit: int, allowed: Set[int]) -> List[int]:
+        ranked = []
+        for position in allowed:
+            tier = self._tier(query, position)
+            if tier is not None:
+                ranked.append((tier, self.names[position], position))
+        ranked.sort()
+        return [position for _, _, position in ranked[:limit]]
+
+    def search(self, query: str, limit: int = 10, allowed: Optional[Set[int]] = None) -> List[int]:
+        """Return up to ``limit`` ranked positions matching ``query``.
+
+        ``allowed`` restricts results to the given positions (e.g. a user's
+        assigned companies).
+        """
+        query = normalize_search_text(query)
+        if len(query) < 2 or limit <= 0:
+            return []
+        if allowed is not None and len(allowed) <= DIRECT_SCAN_LIMIT:
+            return self._scan(query, limit, allowed)
+
+        tiers = [self._names.prefixed(query), self._words.prefixed(query)]
+        if len(query) >= 3:
+            tiers.append(self._names.containing(query))
+        tiers.append(self._others.prefixed(query))
+        if len(query) >= 3:
+            tiers.append(self._others.containing(query))
+
+        results = []
+        seen = set()
+        for tier in tiers:
+            for position in tier:
+                if position in seen or (allowed is not None and position not in allowed):
+                    continue
+                seen.add(position)
+                results.append(position)
+                if len(results) >= limit:
+                    return results
+        return results
@@ -0,0 +1,38 @@
+"""
+Compact the carts collection: remove duplicate carts per user, strip line
+fields that only repeat `calculations`, stamp `updated_at` where missing, then
+create the unique `user_id` index and the `updated_at` TTL index.
+Safe to re-run; run it periodically (e.g. from cron) to keep carts small.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['CART_PRICING_MIGRATION'] = 'false'  # don't start the background re-pricing too
+
+import app as app_module  # noqa: E402
+
+
+def run_migration():
+    """Compact carts and (re)create the cart indexes."""
+    ttl = f"{app_module.CART_TTL_DAYS} days" if app_module.CART_TTL_DAYS > 0 else "disabled"
+    print(f"Starting migration: Compacting carts (TTL {ttl})...")
+
+    app_module.ensure_mongo_connection_initialized()
+    if not app_module.MONGO_AVAILABLE or app_module.mongo_db is None:
+        print("❌ Error: MongoDB is not available")
+        sys.exit(1)
+
+    try:
+        stats = app_module.compact_carts()
+        print(f"✅ Migration complete. Removed {stats['duplicates_removed']} duplicate carts, "
+              f"compacted {stats['carts_compacted']} carts.")
+    except Exception as e:
+        print(f"❌ Migration failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_migration()
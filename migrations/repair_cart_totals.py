@@ -0,0 +1,36 @@
+"""
+Check every cart's maintained `totals` sub-document against a recomputation
+from its lines and rebuild the ones that drifted.
+Pass --dry-run to only report drifted carts. Safe to re-run.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['CART_PRICING_MIGRATION'] = 'false'  # don't start the background re-pricing too
+
+import app as app_module  # noqa: E402
+
+
+def run_migration(dry_run=False):
+    """Report and (unless dry_run) repair drifted cart totals."""
+    print(f"Starting migration: Checking cart totals{' (dry run)' if dry_run else ''}...")
+
+    app_module.ensure_mongo_connection_initialized()
+    if not app_module.MONGO_AVAILABLE or app_module.mongo_db is None:
+        print("❌ Error: MongoDB is not available")
+        sys.exit(1)
+
+    try:
+        stats = app_module.repair_cart_totals(dry_run=dry_run)
+        print(f"✅ Migration complete. Checked {stats['carts_checked']} carts, "
+              f"{stats['carts_drifted']} drifted, repaired {stats['carts_repaired']}.")
+    except Exception as e:
+        print(f"❌ Migration failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_migration(dry_run='--dry-run' in sys.argv[1:])
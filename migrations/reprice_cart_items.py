@@ -0,0 +1,35 @@
+"""
+Migration script to bring stored cart lines up to the current pricing version.
+The app also runs this once in the background on startup; use the script to run
+it on demand (e.g. with CART_PRICING_MIGRATION=false on the web workers).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['CART_PRICING_MIGRATION'] = 'false'  # don't start the background copy too
+
+import app as app_module  # noqa: E402
+
+
+def run_migration():
+    """Re-price every cart line whose pricing_version is older than CART_PRICING_VERSION."""
+    print(f"Starting migration: Re-pricing cart lines to version {app_module.CART_PRICING_VERSION}...")
+
+    app_module.ensure_mongo_connection_initialized()
+    if not app_module.MONGO_AVAILABLE or app_module.mongo_db is None:
+        print("❌ Error: MongoDB is not available")
+        sys.exit(1)
+
+    try:
+        updated = app_module.migrate_cart_pricing()
+        print(f"✅ Migration complete. Updated {updated} carts.")
+    except Exception as e:
+        print(f"❌ Migration failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_migration()
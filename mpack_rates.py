@@ -0,0 +1,153 @@
+"""Compiled MPack rate table.
+
+static/data/mpack.json lists the stocked thicknesses and sheet sizes; the
+per-sq.m rates are fixed per underpacking family (they mirror
+static/user/js/mpack.js).  ``compile_mpack_rows`` joins the two into flat rows
+keyed by (underpacking type, adhesive flag, thickness micron, size id) with the
+sheet area and rate per sq.m worked out once, and ``MpackRateTable`` indexes
+those rows so pricing a cart line is a dictionary lookup.
+
+``write_compiled_table`` stores the rows next to the catalogue as
+``<name>.compiled.json`` together with a hash of the catalogue it was built
+from; ``load_mpack_rate_table`` uses that file when the hash still matches
+and compiles the catalogue otherwise.
+"""
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+BASE_RATE_PER_100_MICRON = 75.0
+POLIPACK_AA_BASE_RATE = 925.0  # self adhesive
+POLIPACK_WA_BASE_RATE = 425.0  # non adhesive
+
+# (underpacking type, adhesive flag) -> rate per sq.m at 100 micron.
+# Every underpacking type other than polipack prices at the standard rate.
+RATE_FAMILIES: Dict[Tuple[str, bool], float] = {
+    ('', False): BASE_RATE_PER_100_MICRON,
+    ('polipack', True): POLIPACK_AA_BASE_RATE,
+    ('polipack', False): POLIPACK_WA_BASE_RATE,
+}
+
+COMPILED_FORMAT = 1
+
+
+def compiled_path(source_path: str) -> str:
+    return os.path.splitext(source_path)[0] + '.compiled.json'
+
+
+def polipack_adhesive_flag(format_label: Optional[str], name: Optional[str] = None) -> Optional[bool]:
+    """True for self adhesive, False for non adhesive, None when the line does not say."""
+    label = (format_label or '').strip().lower()
+    name = (name or '').strip().lower()
+    # 'non adhesive' contains 'adhesive', so the non-adhesive markers go first
+    if 'non' in label or 'wa' in label:
+        return False
+    if 'self' in label or 'adhesive' in label:
+        return True
+    if 'non' in name:
+        return False
+    if 'self' in name:
+        return True
+    return None
+
+
+def rate_family(underpacking_type: Optional[str], adhesive: Optional[bool]) -> Tuple[str, bool]:
+    """RATE_FAMILIES key for a line; polipack of unknown format prices at the standard rate."""
+    if (underpacking_type or '').strip().lower() == 'polipack' and adhesive is not None:
+        return ('polipack', adhesive)
+    return ('', False)
+
+
+def parse_thickness_micron(value) -> float:
+    """200 for '200 micron', 0.0 when no number can be read."""
+    digits = ''.join(ch for ch in str(value or '') if ch.isdigit() or ch == '.')
+    try:
+        return float(digits) if digits else 0.0
+    except ValueError:
+        return 0.0
+
+
+def compile_mpack_rows(catalog: dict) -> List[list]:
+    """Rows of [underpacking, adhesive, thickness, size id, width, length, sqm per sheet, rate per sq.m]."""
+    rows = []
+    for entry in catalog.get('mpack') or []:
+        thickness = parse_thickness_micron(entry.get('thickness', entry.get('id')))
+        if thickness <= 0:
+            continue
+        for size in entry.get('sizes') or []:
+            width = float(size.get('width') or 0)
+            length = float(size.get('length') or 0)
+            sqm_per_sheet = round(width * length / 1_000_000, 6)
+            for (underpacking, adhesive), base_rate in RATE_FAMILIES.items():
+                rows.append([
+                    underpacking, adhesive, thickness, size.get('id'), width, length,
+                    sqm_per_sheet, round(base_rate * thickness / 100.0, 4)
+                ])
+    return rows
+
+
+class MpackRateTable:
+    """Rate and sheet-area lookups over compiled rows."""
+
+    def __init__(self, rows: List[list]):
+        self.entries: Dict[tuple, Tuple[float, float]] = {}
+        self.size_ids: Dict[Tuple[float, float, float], object] = {}
+        for underpacking, adhesive, thickness, size_id, width, length, sqm_per_sheet, rate_per_sqm in rows:
+            self.entries[(underpacking, adhesive, thickness, size_id)] = (sqm_per_sheet, rate_per_sqm)
+            self.size_ids[(thickness, width, length)] = size_id
+
+    def __len__(self):
+        return len(self.entries)
+
+    def size_id(self, thickness: float, width, length):
+        try:
+            return self.size_ids.get((float(thickness), float(width), float(length)))
+        except (TypeError, ValueError):
+            return None
+
+    def lookup(self, underpacking_type: Optional[str], adhesive: Optional[bool], thickness: float,
+               width=None, length=None) -> Tuple[float, Optional[float]]:
+        """(rate per sq.m, sqm per sheet) for a line.
+
+        The area is None when width x length is not a stocked size for the
+        thickness; the rate is still worked out for unstocked thicknesses.
+        """
+        family = rate_family(underpacking_type, adhesive)
+        entry = self.entries.get(family + (thickness, self.size_id(thickness, width, length)))
+        if entry is not None:
+            return entry[1], entry[0]
+        return RATE_FAMILIES[family] * thickness / 100.0, None
+
+
+def _source_hash(raw: bytes) -> str:
+    return hashlib.sha1(raw).hexdigest()
+
+
+def write_compiled_table(source_path: str) -> str:
+    """Compile ``source_path`` and write it next to the catalogue; returns the compiled path."""
+    with open(source_path, 'rb') as f:
+        raw = f.read()
+    target = compiled_path(source_path)
+    with open(target, 'w', encoding='utf-8') as f:
+        json.dump({
+            'format': COMPILED_FORMAT,
+            'source_hash': _source_hash(raw),
+            'rows': compile_mpack_rows(json.loads(raw))
+        }, f)
+    return target
+
+
+def load_mpack_rate_table(source_path: str) -> MpackRateTable:
+    """Table for ``source_path``, from its compiled file when that is current."""
+    with open(source_path, 'rb') as f:
+        raw = f.read()
+    try:
+        with open(compiled_path(source_path), 'r', encoding='utf-8') as f:
+            compiled = json.load(f)
+        if compiled.get('format') == COMPILED_FORMAT and compiled.get('source_hash') == _source_hash(raw):
+            return MpackRateTable(compiled['rows'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return MpackRateTable(compile_mpack_rows(json.loads(raw)))
@@ -0,0 +1,195 @@
+"""Pack-combination solver for chemicals and spray powder.
+
+static/data/chemicals/products.json sells each product in a few pack formats
+(5L bottle, 25L can, ...) at a price per litre; spray_powder/products.json
+does the same per kg.  ``PackSolver`` precomputes, per product, two
+unbounded-knapsack tables over exact fill amounts -- cheapest (cost, packs)
+and fewest (packs, cost) -- so a requested volume is answered by scanning at
+most one largest-pack's worth of amounts above it.  Answers are memoized per
+target, and volumes beyond the tables are first covered with whole largest
+packs.  ``PackCatalog`` holds one solver per product id.
+"""
+import math
+from functools import reduce
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+OBJECTIVES = ('cost', 'surplus')
+TABLE_PACKS = 8  # the tables cover this many of a product's largest pack
+UNIT_SCALE = 1000  # sizes are solved in thousandths of a litre / kg
+
+# unit -> (format size key, product price key)
+PACK_UNITS = {
+    'litre': ('size_litre', 'price_per_litre'),
+    'kg': ('size_kg', 'price_per_kg'),
+}
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class PackFormat(NamedTuple):
+    format_id: str
+    label: str
+    size: float
+    pack_price: float
+
+
+class PackSolution(NamedTuple):
+    quantity: float
+    packs: Tuple[Tuple[PackFormat, int], ...]
+
+    @property
+    def pack_count(self) -> int:
+        return sum(count for _, count in self.packs)
+
+    @property
+    def total(self) -> float:
+        return round(sum(fmt.size * count for fmt, count in self.packs), 3)
+
+    @property
+    def surplus(self) -> float:
+        return round(self.total - self.quantity, 3)
+
+    @property
+    def price(self) -> float:
+        return round(sum(fmt.pack_price * count for fmt, count in self.packs), 2)
+
+    def as_dict(self) -> dict:
+        return {
+            'quantity': self.quantity,
+            'total': self.total,
+            'surplus': self.surplus,
+            'pack_count': self.pack_count,
+            'price': self.price,
+            'packs': [
+                {'format_id': fmt.format_id, 'label': fmt.label, 'size': fmt.size, 'count': count}
+                for fmt, count in self.packs
+            ]
+        }
+
+
+class PackSolver:
+    """Cheapest or least-surplus pack mixes for one product."""
+
+    def __init__(self, product_id: str, name: str, unit: str, formats: List[PackFormat]):
+        self.product_id = product_id
+        self.name = name
+        self.unit = unit
+        self.formats = sorted(formats, key=lambda fmt: fmt.size)
+        self.by_format = {fmt.format_id: fmt for fmt in self.formats}
+
+        scaled = [int(round(fmt.size * UNIT_SCALE)) for fmt in self.formats]
+        self._step = reduce(math.gcd, scaled)
+        self._sizes = [size // self._step for size in scaled]
+        self._costs = [int(round(fmt.pack_price * 100)) for fmt in self.formats]
+        self._largest = self._sizes[-1]
+        self._limit = (TABLE_PACKS + 1) * self._largest
+        self._tables = {
+            'cost': self._build(fewest_packs=False),
+            'surplus': self._build(fewest_packs=True),
+        }
+        self._memo: Dict[Tuple[int, str], Tuple[int, ...]] = {}
+
+    def _build(self, fewest_packs: bool):
+        """best[v] = (cost, packs) of the best exact fill of v units; choice[v] = format index of its last pack."""
+        rank = (lambda entry: (entry[1], entry[0])) if fewest_packs else (lambda entry: entry)
+        best: List[Optional[Tuple[int, int]]] = [None] * (self._limit + 1)
+        choice = [-1] * (self._limit + 1)
+        best[0] = (0, 0)
+        for amount in range(1, self._limit + 1):
+            for index, size in enumerate(self._sizes):
+                previous = best[amount - size] if size <= amount else None
+                if previous is None:
+                    continue
+                candidate = (previous[0] + self._costs[index], previous[1] + 1)
+                if best[amount] is None or rank(candidate) < rank(best[amount]):
+                    best[amount] = candidate
+                    choice[amount] = index
+        return best, choice
+
+    def _counts(self, target: int, objective: str) -> Tuple[int, ...]:
+        """Pack counts per format for ``target`` units (target within the tables)."""
+        memo_key = (target, objective)
+        counts = self._memo.get(memo_key)
+        if counts is not None:
+            return counts
+
+        best, choice = self._tables[objective]
+        chosen = None
+        for amount in range(target, target + self._largest):
+            if best[amount] is None:
+                continue
+            cost, packs = best[amount]
+            surplus = amount - target
+            rank = (cost, surplus, packs) if objective == 'cost' else (surplus, packs, cost)
+            if chosen is None or rank < chosen[0]:
+                chosen = (rank, amount)
+
+        tally = [0] * len(self._sizes)
+        amount = chosen[1]
+        while amount > 0:
+            index = choice[amount]
+            tally[index] += 1
+            amount -= self._sizes[index]
+        counts = self._memo[memo_key] = tuple(tally)
+        return counts
+
+    def _target_units(self, quantity: float) -> int:
+        return max(math.ceil(round(quantity * UNIT_SCALE / self._step, 6)), 0)
+
+    def solve(self, quantity: float, objective: str = 'cost') -> Optional[PackSolution]:
+        """Pack mix covering ``quantity``; None for a quantity of 0 or less."""
+        if objective not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective!r}")
+        quantity = _number(quantity)
+        if quantity <= 0:
+            return None
+        target = self._target_units(quantity)
+        peeled = max(0, math.ceil((target - self._limit + self._largest) / self._largest))
+        counts = list(self._counts(target - peeled * self._largest, objective))
+        counts[-1] += peeled
+        return PackSolution(quantity, tuple((fmt, count) for fmt, count in zip(self.formats, counts) if count))
+
+    def single_format(self, format_id: str, quantity: float) -> Optional[PackSolution]:
+        """Whole packs of one format covering ``quantity``; None if the format is unknown."""
+        fmt = self.by_format.get(format_id)
+        quantity = _number(quantity)
+        if fmt is None or quantity <= 0:
+            return None
+        return PackSolution(quantity, ((fmt, math.ceil(round(quantity / fmt.size, 6))),))
+
+
+class PackCatalog:
+    """Pack solvers by product id over one or more product catalogues."""
+
+    def __init__(self, *catalogs: Tuple[dict, str]):
+        self.by_product: Dict[str, PackSolver] = {}
+        for catalog, unit in catalogs:
+            size_key, price_key = PACK_UNITS[unit]
+            for category in catalog.get('categories') or []:
+                for product in category.get('products') or []:
+                    product_id = product.get('id')
+                    price = _number(product.get(price_key))
+                    formats = [
+                        PackFormat(
+                            format_id=fmt.get('id'),
+                            label=fmt.get('label') or '',
+                            size=_number(fmt.get(size_key)),
+                            pack_price=_number(fmt.get(price_key) or price) * _number(fmt.get(size_key))
+                        )
+                        for fmt in product.get('formats') or []
+                    ]
+                    formats = [fmt for fmt in formats if fmt.format_id and fmt.size > 0]
+                    if product_id and formats:
+                        self.by_product[product_id] = PackSolver(product_id, product.get('name') or '', unit, formats)
+
+    def __len__(self):
+        return len(self.by_product)
+
+    def get(self, product_id: Optional[str]) -> Optional[PackSolver]:
+        return self.by_product.get(product_id) if product_id else None
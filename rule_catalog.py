@@ -0,0 +1,88 @@
+"""Index over the cutting / creasing rule catalogue.
+
+Creasing_cutting_rule/cutting_creasing_rules.json groups rule profiles by
+category ('cutting', 'creasing') and packaging type ('packets', 'coils'); each
+profile may carry its own ``pricing`` and otherwise uses the file's top-level
+one.  ``RuleCatalogIndex`` flattens the file once, resolving every profile's
+length per unit and rate per meter, so pricing a rule is a dictionary lookup
+by profile id (optionally checked against the packaging type).
+"""
+from typing import Dict, NamedTuple, Optional
+
+
+DEFAULT_LENGTH_PER_UNIT_M = 100.0
+DEFAULT_RATE_PER_METER = 21.0
+RULE_CATEGORIES = ('cutting', 'creasing')
+
+
+def _positive(value, fallback: float) -> float:
+    """Like the client's ``Number(value) || fallback``."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return fallback
+    return number if number > 0 else fallback
+
+
+class RuleProfile(NamedTuple):
+    profile_id: str
+    rule_category: str
+    packaging_type: str
+    label: str
+    code: str
+    thickness: str
+    finish: str
+    length_per_unit_m: float
+    rate_per_meter: float
+
+    @property
+    def unit_price(self) -> float:
+        return round(self.length_per_unit_m * self.rate_per_meter, 2)
+
+    def as_dict(self) -> dict:
+        return dict(self._asdict(), unit_price=self.unit_price)
+
+
+class RuleCatalogIndex:
+    """Rule profiles by id and by packaging type."""
+
+    def __init__(self, catalog: dict):
+        default_pricing = catalog.get('pricing') or {}
+        default_length = _positive(default_pricing.get('length_per_unit_m'), DEFAULT_LENGTH_PER_UNIT_M)
+        default_rate = _positive(default_pricing.get('rate_per_meter'), DEFAULT_RATE_PER_METER)
+
+        self.by_profile: Dict[str, RuleProfile] = {}
+        self.by_packaging: Dict[str, Dict[str, RuleProfile]] = {}
+        for category in RULE_CATEGORIES:
+            for packaging_type, entries in (catalog.get(category) or {}).items():
+                if not isinstance(entries, list):
+                    continue
+                for entry in entries:
+                    profile_id = entry.get('profile_id')
+                    if not profile_id:
+                        continue
+                    pricing = entry.get('pricing') or {}
+                    profile = RuleProfile(
+                        profile_id=profile_id,
+                        rule_category=category,
+                        packaging_type=packaging_type,
+                        label=(entry.get('label') or '').strip(),
+                        code=(entry.get('code') or '').strip(),
+                        thickness=(entry.get('thickness') or '').strip(),
+                        finish=(entry.get('finish') or '').strip(),
+                        length_per_unit_m=_positive(pricing.get('length_per_unit_m'), default_length),
+                        rate_per_meter=_positive(pricing.get('rate_per_meter'), default_rate),
+                    )
+                    self.by_profile[profile_id] = profile
+                    self.by_packaging.setdefault(packaging_type, {})[profile_id] = profile
+
+    def __len__(self):
+        return len(self.by_profile)
+
+    def get(self, profile_id: Optional[str], packaging_type: Optional[str] = None) -> Optional[RuleProfile]:
+        """The profile, or None if it is unknown or not sold in ``packaging_type``."""
+        if not profile_id:
+            return None
+        if packaging_type:
+            return self.by_packaging.get(packaging_type, {}).get(profile_id)
+        return self.by_profile.get(profile_id)
@@ -0,0 +1,100 @@
+"""
+Benchmark the company picker for a regular (assigned-accounts) user.
+
+Generates synthetic company directories of growing size, then times
+load_companies_for_user() and a full render of the index page for a user with
+20 assigned companies, plus typeahead search over the whole directory.
+Latency should stay flat as the directory grows.
+
+Runs against the JSON fallback so it needs no database:
+
+    python scripts/bench_company_directory.py
+    python scripts/bench_company_directory.py --sizes 1000 10000 50000 --assigned 20
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['USE_MONGO'] = 'false'
+
+import app as app_module  # noqa: E402
+from flask_login import login_user  # noqa: E402
+
+
+def write_directory(path, size):
+    companies = []
+    for i in range(size):
+        companies.append({
+            'id': f'bench-{i}',
+            'Company Name': f'Bench Company {i:06d}',
+            'EmailID': f'bench{i}@example.com',
+            'Billing City': 'Mumbai',
+            'assigned_to': []
+        })
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'companies': companies}, f)
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1], samples[int(len(samples) * 0.99) - 1]
+
+
+def run(sizes, assigned, iterations):
+    flask_app = app_module.app
+    tmp_dir = tempfile.mkdtemp(prefix='company-bench-')
+    companies_file = os.path.join(tmp_dir, 'companies.json')
+    app_module._companies_json_path = lambda: companies_file
+
+    print(f"{'companies':>10} {'lookup p50':>11} {'lookup p95':>11} {'page p50':>10} {'page p95':>10} "
+          f"{'index build':>12} {'search p50':>11} {'search p99':>11}")
+    for size in sizes:
+        write_directory(companies_file, size)
+        app_module.invalidate_companies_cache()
+
+        step = max(size // assigned, 1)
+        user = app_module.User(
+            id='bench-user',
+            email='bench@example.com',
+            username='bench',
+            password_hash='',
+            role='user',
+            assigned_companies=[f'bench-{i}' for i in range(0, size, step)][:assigned]
+        )
+
+        with flask_app.test_request_context('/index'):
+            login_user(user)
+            # Warm the per-worker directory cache once, as a running worker would be
+            app_module.load_companies_for_user(user)
+            lookup = timed(lambda: app_module.load_companies_for_user(user), iterations)
+            page = timed(lambda: app_module.index(), iterations)
+
+        build_start = time.perf_counter()
+        app_module.search_company_directory('bench')
+        build_ms = (time.perf_counter() - build_start) * 1000
+        queries = ['be', 'ben', 'bench co', 'mumbai', 'example.com']
+        queries += [f'{random.randrange(size):06d}'[:4] for _ in range(20)]
+        search = timed(lambda: app_module.search_company_directory(random.choice(queries)), iterations * 5)
+
+        print(f"{size:>10} {lookup[0]:>9.2f}ms {lookup[1]:>9.2f}ms {page[0]:>8.2f}ms {page[1]:>8.2f}ms "
+              f"{build_ms:>10.0f}ms {search[0]:>9.2f}ms {search[2]:>9.2f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000])
+    parser.add_argument('--assigned', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    run(args.sizes, args.assigned, args.iterations)
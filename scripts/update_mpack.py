@@ -1,6 +1,12 @@
 import json
+import os
+import sys
 from collections import defaultdict
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mpack_rates import write_compiled_table  # noqa: E402
+
 raw_data = """mic l1 l2
 500 795 1050
 500 780 1050
@@ -306,3 +312,6 @@ for thickness in sorted(by_thickness):
 
 with open('static/data/mpack.json', 'w', encoding='utf-8') as f:
     json.dump({"mpack": mpack}, f, indent=2)
+
+# Pre-built rate table so workers skip compiling the catalogue on startup
+write_compiled_table('static/data/mpack.json')
@@ -1867,6 +1867,11 @@ function updateCartItemDiscount(index, discountPercent, itemId) {
         })
     })
     .then(response => {
+        if (response.status === 409) {
+            // Another request changed the cart first; show the current one
+            window.location.reload();
+            throw new Error('Your cart was changed elsewhere. Refreshing...');
+        }
         if (!response.ok) {
             throw new Error('Network response was not ok');
         }
@@ -1999,6 +2004,11 @@ function updateCartItemQuantity(index, newQuantity, type) {
         })
     })
     .then(response => {
+        if (response.status === 409) {
+            // Another request changed the cart first; show the current one
+            window.location.reload();
+            throw new Error('Your cart was changed elsewhere. Refreshing...');
+        }
         if (!response.ok) {
             throw new Error('Network response was not ok');
         }
@@ -57,7 +57,8 @@
     selectedFormat: null,
     quantityLitres: null,
     quantityConfirmed: false,
-    discountPercent: 0
+    discountPercent: 0,
+    packSuggestion: null
   };
 
   function detectEditContext() {
@@ -372,6 +373,7 @@
         state.quantityConfirmed = true;
         confirmQuantityBtn.blur();
         updateSummary();
+        refreshPackSuggestion();
       });
     }
   }
@@ -626,6 +628,11 @@
       const totalLitres = size > 0 ? containers * size : quantityLitresValue;
       const packagingDisplay = `${formatLabel} × ${containers} = ${formatNumber(totalLitres)} L`;
       items.push(summaryItem('Packaging', packagingDisplay));
+
+      const suggestion = state.packSuggestion;
+      if (suggestion && suggestion.key === packSuggestionKey() && suggestion.surplus < totalLitres - quantityLitresValue) {
+        items.push(summaryItem('Least surplus mix', suggestion.text, `${formatNumber(suggestion.surplus)} L surplus`));
+      }
     }
 
     const hasCompleteSelection = Boolean(
@@ -766,6 +773,34 @@
     }
   }
 
+  function packSuggestionKey() {
+    return state.selectedProduct ? `${state.selectedProduct.id}|${state.quantityLitres}` : '';
+  }
+
+  async function refreshPackSuggestion() {
+    const key = packSuggestionKey();
+    if (!key) return;
+    const params = new URLSearchParams({
+      product_id: state.selectedProduct.id,
+      quantity: String(state.quantityLitres),
+      objective: 'surplus'
+    });
+    try {
+      const response = await fetch(`/api/packs/solve?${params.toString()}`);
+      const data = await response.json();
+      if (!response.ok || !data.success || key !== packSuggestionKey()) return;
+      const solution = data.solution;
+      state.packSuggestion = {
+        key,
+        surplus: Number(solution.surplus) || 0,
+        text: solution.packs.map(pack => `${pack.label} × ${pack.count}`).join(' + ')
+      };
+      updateSummary();
+    } catch (error) {
+      console.warn('chemicals.js: pack suggestion unavailable', error);
+    }
+  }
+
   function updatePricingBreakdown() {
     if (!pricingSection || !pricingBreakdown || !state.selectedFormat || !state.quantityConfirmed) {
       return;
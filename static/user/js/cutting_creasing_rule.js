@@ -266,6 +266,7 @@
         state.selectedPackaging = options.find(option => option.id === event.target.value) || null;
         state.selectedPricing = normalizeRulePricing(state.selectedPackaging?.pricing, state.rulePricing);
         if (state.selectedPackaging) {
+          refreshPackagingPricing(state.selectedPackaging);
           showSection(quantitySection, quantityInput);
           quantityInput.disabled = false;
           quantityInput.placeholder = 'Enter required quantity';
@@ -745,9 +746,28 @@
     }
   }
 
+  // The server prices rules from its own copy of the catalogue; use its figures
+  // for the chosen profile so the summary matches what the cart will charge.
+  async function refreshPackagingPricing(packaging) {
+    if (!packaging?.profileId) return;
+    const params = new URLSearchParams({ profile_id: packaging.profileId, packaging_type: packaging.packagingId });
+    try {
+      const response = await fetch(`/api/rules/price?${params}`);
+      if (!response.ok) return;
+      const data = await response.json();
+      if (data?.success && state.selectedPackaging === packaging) {
+        state.selectedPricing = normalizeRulePricing(data, state.rulePricing);
+        updateSummary();
+      }
+    } catch (error) {
+      console.warn('cutting_creasing_rule.js: unable to refresh rule pricing', error);
+    }
+  }
+
   async function loadRuleSizes() {
     try {
-      const response = await fetch(DATA_SOURCE, { cache: 'no-store' });
+      // Let the browser revalidate its cached copy instead of downloading it on every visit
+      const response = await fetch(DATA_SOURCE);
       if (!response.ok) {
         throw new Error(`Failed to fetch rule catalog (${response.status})`);
       }
@@ -0,0 +1,260 @@
+import copy
+import os
+import sys
+import tempfile
+import threading
+
+os.environ.setdefault('USE_MONGO', 'false')
+os.environ.setdefault('CART_PRICING_MIGRATION', 'false')
+
+# Add the current directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from app import (  # noqa: E402
+    CartStore, apply_cart_discount, apply_cart_item_edit, apply_cart_quantity, apply_litre_quantity,
+    cart_item_fingerprint, cart_totals_increments, check_cart_totals, compute_cart_totals, merge_cart_line,
+    price_line, set_line_pricing
+)
+
+
+def chemical_line(litres, format_id='wash-cs-10l'):
+    """A WASH CS cart line (135/litre, 18% GST) as add_to_cart stores it."""
+    line = {
+        'type': 'chemical',
+        'name': 'WASH CS',
+        'product_id': 'wash-cs',
+        'format_id': format_id,
+        'unit_price': 135.0,
+        'price_per_litre': 135.0,
+        'discount_percent': 0.0,
+        'gst_percent': 18.0
+    }
+    return apply_litre_quantity(line, litres)
+
+
+def test_chemical_line_is_priced_in_litres():
+    line = chemical_line(20)
+    assert line['quantity_litre'] == 20
+    assert line['packs_needed'] == 2
+    assert line['quantity'] == 2
+    assert line['total_price'] == 3186.0
+
+
+def test_merge_chemical_lines_prices_combined_litres():
+    merged = merge_cart_line(chemical_line(20), chemical_line(20))
+    assert merged['quantity_litre'] == 40
+    assert merged['packs_needed'] == 4
+    assert merged['quantity'] == 4
+    assert merged['total_litre'] == 40
+    assert merged['surplus_litre'] == 0
+    assert merged['total_price'] == 6372.0
+    assert merged['calculations']['final_total'] == 6372.0
+
+
+def test_merge_chemical_lines_resolves_packs_for_combined_volume():
+    merged = merge_cart_line(chemical_line(5), chemical_line(5))
+    assert merged['quantity_litre'] == 10
+    assert merged['packs_needed'] == 1
+    assert merged['surplus_litre'] == 0
+    assert merged['total_price'] == 1593.0
+
+
+def test_merge_maintenance_lines_uses_line_pack_size():
+    def maintenance_line(litres):
+        return apply_litre_quantity({
+            'type': 'maintenance',
+            'product_id': 'not-in-catalogue',
+            'pack_size_litre': 5,
+            'unit_price': 100.0,
+            'gst_percent': 18.0
+        }, litres)
+
+    merged = merge_cart_line(maintenance_line(3), maintenance_line(4))
+    assert merged['quantity_litre'] == 7
+    assert merged['packs_needed'] == 2
+    assert merged['surplus_litre'] == 3
+    assert merged['total_price'] == 826.0
+
+
+def spray_powder_line(kg, format_id='px-100-1kg', discount_percent=0.0):
+    """A PX 100 cart line (350/kg, 18% GST) priced the way the write path prices it."""
+    line = {
+        'type': 'spray_powder',
+        'name': 'Image Anti Set-Off Spray Powder - PX 100',
+        'machine': 'SM 74',
+        'product_id': 'px-100',
+        'format_id': format_id,
+        'quantity': kg,
+        'quantity_kg': kg,
+        'unit_price': 350.0,
+        'price_per_kg': 350.0,
+        'discount_percent': discount_percent,
+        'gst_percent': 18.0
+    }
+    return set_line_pricing(line, price_line(line))
+
+
+def test_spray_powder_fingerprint_covers_format_and_discount():
+    one_kg = cart_item_fingerprint(spray_powder_line(23))
+    assert cart_item_fingerprint(spray_powder_line(3)) == one_kg
+    assert cart_item_fingerprint(spray_powder_line(20, 'px-100-20kg')) != one_kg
+    assert cart_item_fingerprint(spray_powder_line(23, discount_percent=10)) != one_kg
+    assert cart_item_fingerprint(spray_powder_line(20, 'px-100-20kg', 10)) != one_kg
+
+
+def test_quantity_edit_on_chemical_line_is_litres():
+    line = apply_cart_quantity(chemical_line(20), 25, 'chemical')
+    assert line['quantity_litre'] == 25
+    assert line['packs_needed'] == 3
+    assert line['total_price'] == 3982.5
+
+
+def blanket_line(quantity=1):
+    """A 1000 + 0 bar blanket line (18% GST) as add_to_cart stores it."""
+    line = {
+        'type': 'blanket',
+        'name': 'Test Blanket',
+        'base_price': 1000.0,
+        'bar_price': 0.0,
+        'quantity': quantity,
+        'discount_percent': 0.0,
+        'gst_percent': 18.0,
+        'calculations': {'areaSqM': 0.5}
+    }
+    return set_line_pricing(line, price_line(line))
+
+
+def mpack_line(quantity=2):
+    """A 200/sheet MPack line (18% GST) with the flat amounts add_to_cart copies out."""
+    line = {'type': 'mpack', 'unit_price': 200.0, 'quantity': quantity, 'discount_percent': 0.0, 'gst_percent': 18.0}
+    calculations = price_line(line)
+    line.update({field: calculations[field] for field in ('discount_amount', 'discounted_subtotal', 'gst_amount')})
+    line['total'] = calculations['final_total']
+    return set_line_pricing(line, calculations)
+
+
+def assert_line_total(line, expected):
+    assert line['total_price'] == expected
+    assert line['calculations']['final_total'] == expected
+    assert line['calculations']['final_price'] == expected
+
+
+def test_blanket_edits_keep_final_total_current():
+    line = apply_cart_quantity(blanket_line(), 3, 'blanket')
+    assert_line_total(line, 3540.0)
+    assert line['calculations']['areaSqM'] == 0.5
+
+    apply_cart_discount(line, 10)
+    assert_line_total(line, 3186.0)
+    assert line['calculations']['discount_percent'] == 10
+
+
+def test_mpack_edits_keep_final_total_current():
+    line = mpack_line()
+    apply_cart_discount(line, 10)
+    assert_line_total(line, 424.8)
+    assert line['total'] == 424.8
+    assert line['gst_amount'] == 64.8
+
+    apply_cart_item_edit(line, {'quantity': 5})
+    assert_line_total(line, 1062.0)
+    assert line['total'] == 1062.0
+
+
+def test_merge_spray_powder_lines_reprices_combined_kg():
+    merged = merge_cart_line(spray_powder_line(3), spray_powder_line(2))
+    assert merged['quantity_kg'] == 5
+    assert merged['packs_needed'] == 5
+    assert merged['surplus_kg'] == 0
+    assert_line_total(merged, 2065.0)
+
+
+def test_merge_blanket_and_mpack_lines_keeps_final_total_current():
+    assert_line_total(merge_cart_line(blanket_line(1), blanket_line(2)), 3540.0)
+
+    merged = merge_cart_line(mpack_line(2), mpack_line(3))
+    assert merged['quantity'] == 5
+    assert_line_total(merged, 1180.0)
+    assert merged['total'] == 1180.0
+
+
+def apply_increments(totals, increments):
+    """What MongoDB's $inc does to a cart's totals sub-document."""
+    totals = {**totals, 'gst': dict(totals['gst'])}
+    for key, amount in increments.items():
+        path = key.split('.')[1:]
+        if path[0] == 'gst':
+            totals['gst'][path[1]] = totals['gst'].get(path[1], 0.0) + amount
+        else:
+            totals[path[0]] += amount
+    return totals
+
+
+def test_maintained_cart_totals_match_recomputation():
+    first, second = chemical_line(20), chemical_line(5)
+    totals = compute_cart_totals([])
+    totals = apply_increments(totals, cart_totals_increments(added=first))
+    totals = apply_increments(totals, cart_totals_increments(added=second))
+    edited = apply_cart_quantity(dict(second), 25, 'chemical')
+    totals = apply_increments(totals, cart_totals_increments(added=edited, removed=second))
+
+    cart = {'products': [first, edited], 'totals': totals}
+    assert check_cart_totals(cart) == {}
+    assert compute_cart_totals(cart['products'])['grand_total'] == 3186.0 + 3982.5
+
+
+def test_blanket_and_mpack_edits_keep_maintained_totals_in_step():
+    blanket, mpack = blanket_line(), mpack_line()
+    totals = compute_cart_totals([])
+    totals = apply_increments(totals, cart_totals_increments(added=blanket))
+    totals = apply_increments(totals, cart_totals_increments(added=mpack))
+
+    edited_blanket = apply_cart_quantity(copy.deepcopy(blanket), 3, 'blanket')
+    totals = apply_increments(totals, cart_totals_increments(added=edited_blanket, removed=blanket))
+    edited_mpack = copy.deepcopy(mpack)
+    apply_cart_discount(edited_mpack, 10)
+    totals = apply_increments(totals, cart_totals_increments(added=edited_mpack, removed=mpack))
+
+    cart = {'products': [edited_blanket, edited_mpack], 'totals': totals}
+    assert check_cart_totals(cart) == {}
+    assert compute_cart_totals(cart['products'])['grand_total'] == 3540.0 + 424.8
+
+
+def test_stale_final_total_is_read_from_total_price():
+    line = apply_cart_quantity(blanket_line(), 3, 'blanket')
+    apply_cart_discount(line, 10)
+    line['calculations']['final_total'] = 1180.0  # as edits left it before final_total was kept current
+
+    assert compute_cart_totals([line]) == {
+        'subtotal': 3000.0, 'discount': 300.0, 'grand_total': 3186.0, 'gst': {'18': 486.0}
+    }
+
+
+def test_check_cart_totals_reports_drift():
+    products = [chemical_line(20)]
+    totals = compute_cart_totals(products)
+    totals['grand_total'] += 100
+    totals['gst'] = {}
+
+    mismatches = check_cart_totals({'products': products, 'totals': totals})
+    assert mismatches['grand_total'] == (3286.0, 3186.0)
+    assert mismatches['gst.18'] == (0.0, 486.0)
+    assert 'subtotal' not in mismatches
+
+
+def test_json_cart_store_lock_is_per_user():
+    with tempfile.TemporaryDirectory() as base_dir:
+        store = CartStore(base_dir=base_dir, write_behind=0)
+        done = threading.Event()
+
+        def other_user():
+            store.add_item('bob', chemical_line(5))
+            store.get_cart('bob')
+            done.set()
+
+        with store._user_lock('alice'):
+            worker = threading.Thread(target=other_user)
+            worker.start()
+            assert done.wait(5), "another user's cart waited on alice's lock"
+        worker.join()
+        assert len(store.get_cart('bob')) == 1